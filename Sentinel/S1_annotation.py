@@ -0,0 +1,132 @@
+"""
+
+Streaming reader for Sentinel-1 annotation files
+
+Overview
+========
+
+Reads the information needed to catalogue a Sentinel-1 measurement file from its annotation xml file. Only the adsHeader, the pass direction, the swath timing information and the geolocation grid points of the first and last pixel are extracted. Burst times and geolocation points are returned as NumPy arrays.
+
+The annotation file is memory mapped, and the byte ranges of the adsHeader, productInformation, swathTiming and geolocationGrid sections are located with a plain search. Only these sections are parsed with iterparse, and each element is cleared as soon as its contents have been read, so memory use and parse time do not depend on the size of the (large) antenna pattern, doppler and noise sections. If a section cannot be located this way, the whole file is parsed with iterparse instead.
+
+Functions
+=========
+
+Main functions
+--------------
+
+  read_annotation:
+    Extracts header, swath timing and first/last pixel geolocation from an
+    annotation file
+
+Aux functions
+-------------
+
+  iter_sections:
+    Yields the elements of the required sections of an annotation file as
+    soon as they are complete
+
+"""
+
+import mmap
+from cStringIO import StringIO
+import numpy as np
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+SECTIONS = ('adsHeader', 'productInformation', 'swathTiming', 'geolocationGrid')
+# Elements read through their parent, these are cleared with the parent
+LEAF_TAGS = frozenset(('polarisation', 'swath', 'startTime', 'pass',
+                       'linesPerBurst', 'samplesPerBurst', 'burstList', 'burst',
+                       'azimuthAnxTime', 'line', 'pixel', 'latitude',
+                       'longitude'))
+
+def read_annotation(annotfile):
+    """
+    Returns a dictionary containing:
+
+      polarisation, swath, start_time, pass:
+        Strings as given in the annotation file
+      lines_per_burst, samples_per_burst:
+        Integers
+      azimuth_anx_time:
+        float32 array with the time since ascending node of each burst
+      first_line, last_line:
+        Line numbers of the geolocation points in the first and last pixel
+      first_latlon, last_latlon:
+        float32 arrays of shape (n,2) with the latitude and longitude of these
+        points
+    """
+    header = {}
+    productpass = None
+    timing = {}
+    anxtimes = []
+    points = []
+
+    for elem in iter_sections(annotfile):
+        tag = elem.tag
+        if tag in LEAF_TAGS:
+            continue
+        if tag == 'geolocationGridPoint':
+            points.append((elem.findtext('line'), elem.findtext('pixel'),
+                           elem.findtext('latitude'), elem.findtext('longitude')))
+        elif tag == 'adsHeader':
+            for t in ('polarisation', 'swath', 'startTime'):
+                header[t] = elem.findtext(t)
+        elif tag == 'productInformation':
+            productpass = elem.findtext('pass')
+        elif tag == 'swathTiming':
+            timing['linesPerBurst'] = int(elem.findtext('linesPerBurst'))
+            timing['samplesPerBurst'] = int(elem.findtext('samplesPerBurst'))
+            anxtimes = [b.findtext('azimuthAnxTime')
+                        for b in elem.iterfind('burstList/burst')]
+        elem.clear()
+
+    samples = timing['samplesPerBurst']
+    # Points are kept as float32, which is the precision stored in the
+    # database, and only for the first and last pixel of each line
+    line = np.int32([p[0] for p in points])
+    pixel = np.int32([p[1] for p in points])
+    latlon = np.float32([[float(p[2]), float(p[3])] for p in points]).reshape(-1, 2)
+    firstix = pixel == 0
+    lastix = pixel == samples-1
+
+    return {'polarisation': header['polarisation'],
+            'swath': header['swath'],
+            'start_time': header['startTime'],
+            'pass': productpass,
+            'lines_per_burst': timing['linesPerBurst'],
+            'samples_per_burst': samples,
+            'azimuth_anx_time': np.float32([float(t) for t in anxtimes]),
+            'first_line': line[firstix],
+            'first_latlon': latlon[firstix],
+            'last_line': line[lastix],
+            'last_latlon': latlon[lastix]}
+
+def iter_sections(annotfile):
+    with open(annotfile, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            ranges = []
+            for s in SECTIONS:
+                start = m.find('<{0}>'.format(s))
+                end = m.find('</{0}>'.format(s), start)
+                if start < 0 or end < 0:
+                    ranges = None
+                    break
+                ranges.append((start, end+len(s)+3))
+            if ranges is not None:
+                sections = [m[start:end] for start, end in ranges]
+        finally:
+            m.close()
+
+    if ranges is None:
+        for event, elem in ET.iterparse(annotfile):
+            yield elem
+        return
+    for section in sections:
+        for event, elem in ET.iterparse(StringIO(section)):
+            yield elem
@@ -0,0 +1,362 @@
+"""
+
+Computes perpendicular and temporal baselines of all dates in a processing directory
+
+Overview
+========
+
+Computes the perpendicular, parallel and temporal baseline of every date in the SLC directory with respect to a reference date (the master), from the state vectors and scene centre in the .slc.par files. The baselines between any pair of dates follow as differences of these, as all of them are projected on the line of sight of the reference.
+
+For each date the satellite position at zero Doppler with respect to the scene centre of the reference is found by a few Newton iterations. The state vectors of all dates are stacked into arrays, so that each iteration interpolates the orbits of all dates at once (cubic Hermite, see S1_orbit.py). The perpendicular baseline is the component of the difference in position perpendicular to the line of sight and to the flight direction of the reference, positive when the other date is above the line of sight of the reference, away from the earth centre. The parallel baseline is the component along the line of sight, positive away from the scene.
+
+The result is cached in baselines.npz in the processing directory, together with the modification times of the .slc.par files used. It is only computed again if dates are added, removed or their .slc.par file changes, or when the -f option is given. The table is printed to screen, and written to baselines.txt.
+
+The baselines are used to order the slaves and to choose their auxiliary images (see S1_process_slaves.py), using the distance between two dates with a temporal baseline of TEMPORAL_SCALE days or a perpendicular baseline of PERPENDICULAR_SCALE metres counting as one. The auxiliary images follow from the minimum spanning tree of these distances, grown from the master, optionally with a maximum depth.
+
+Functions
+=========
+
+Main functions
+--------------
+
+  get_baselines:
+    Returns the baselines of all dates, from the cache if up to date
+  compute_baselines:
+    Computes the baselines of all dates with respect to a reference date
+  pair_baselines:
+    Returns the temporal and perpendicular baselines between all pairs of
+    dates
+  baseline_distance:
+    Returns the combined distance between all pairs of dates
+  date_distance:
+    Returns a function giving the combined distance between two dates
+  distance_matrix:
+    Returns the combined distance between all pairs of a list of dates
+  baseline_tree:
+    Returns the minimum spanning tree of a distance matrix
+
+Aux functions
+-------------
+
+  read_orbits:
+    Reads and stacks the state vectors of the .slc.par files of all dates
+  interpolate_stack:
+    Interpolates the stacked state vectors of all dates at once
+  llh2xyz:
+    Converts geodetic coordinates to earth centred cartesian coordinates
+  get_dates:
+    Lists the dates with an .slc.par file in the SLC directory
+  get_masterdate:
+    Returns the master date of a processing directory
+
+Usage
+=====
+
+S1_baseline.py -d </path/to/processing/directory> [-m <reference date>] [-f]
+
+    -d      Defines path to processing directory
+    -m      Reference date, defaults to the master of the processing directory
+    -f      Compute the baselines again, even if the cache is up to date
+"""
+
+import sys
+import getopt
+import os
+import datetime as dt
+import numpy as np
+
+from RIMoDe.utils import read_par, WGS84_A
+
+# WGS84 first eccentricity squared
+WGS84_E2 = 6.69437999014e-3
+
+CACHE = 'baselines.npz'
+TABLE = 'baselines.txt'
+
+# Temporal (days) and perpendicular (m) baselines counting as distance 1
+TEMPORAL_SCALE = 60.
+PERPENDICULAR_SCALE = 150.
+
+# Newton iterations for the zero Doppler time, converging to well below a
+# microsecond
+ITERATIONS = 6
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv
+
+    datadir = []
+    refdate = []
+    force = False
+
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "hd:m:f", ["help"])
+        except getopt.error, msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print __doc__
+                return 0
+            elif o == '-d':
+                datadir = a
+            elif o == '-m':
+                refdate = a
+            elif o == '-f':
+                force = True
+
+        if not datadir:
+            raise Usage('No data directory given, -d option is not optional!')
+        if not os.path.exists(os.path.join(datadir,'SLC')):
+            raise Usage('Did not find SLC directory in {0}'.format(datadir))
+        if not refdate:
+            refdate = get_masterdate(datadir)
+            if not refdate:
+                raise Usage('No master found in {0}, give reference date with -m option'.format(os.path.join(datadir,'Geo')))
+        if refdate not in get_dates(datadir):
+            raise Usage('No .slc.par file found for reference date {0}'.format(refdate))
+
+    except Usage, err:
+        print >>sys.stderr, "\nWoops, something went wrong:"
+        print >>sys.stderr, "  "+str(err.msg)
+        print >>sys.stderr, "\nFor help, use -h or --help.\n"
+        return 2
+
+    table = get_baselines(datadir,refdate,force)
+    print '\nDate:       Btemp (days):   Bperp (m):   Bpar (m):'
+    print '--------------------------------------------------'
+    for date, btemp, bperp, bpar in zip(table['dates'],table['btemp'],table['bperp'],table['bpar']):
+        print '{0}{1:14.0f}{2:13.1f}{3:12.1f}'.format(date,btemp,bperp,bpar)
+    print '\nBaselines written to {0}'.format(os.path.join(datadir,TABLE))
+
+def get_masterdate(datadir):
+    geodir = os.path.join(datadir,'Geo')
+    if os.path.isdir(geodir):
+        for f in os.listdir(geodir):
+            if f[-4:] == '.dem' and f[0] == '2':
+                return f.split('.')[0]
+    return None
+
+def get_dates(datadir):
+    slcdir = os.path.join(datadir,'SLC')
+    return sorted(d for d in os.listdir(slcdir)
+                  if len(d) == 8 and d[0] == '2' and
+                  os.path.exists(os.path.join(slcdir,d,'{0}.slc.par'.format(d))))
+
+def get_parfile(datadir,date):
+    return os.path.join(datadir,'SLC',date,'{0}.slc.par'.format(date))
+
+def get_baselines(datadir,refdate=None,force=False):
+    """
+    Returns the baselines of all dates in datadir with respect to refdate
+    (default: the master), see compute_baselines. The cache in datadir is
+    used if it holds the same dates and .slc.par files, and updated otherwise
+    """
+    if refdate is None:
+        refdate = get_masterdate(datadir)
+    dates = get_dates(datadir)
+    mtimes = np.array([os.path.getmtime(get_parfile(datadir,d)) for d in dates])
+    cachefile = os.path.join(datadir,CACHE)
+    if not force and os.path.exists(cachefile):
+        try:
+            with np.load(cachefile) as npz:
+                table = dict((k, npz[k]) for k in npz.files)
+            if (str(table['refdate']) == refdate and list(table['dates']) == dates and
+                np.array_equal(table['mtimes'],mtimes)):
+                table['dates'] = [str(d) for d in table['dates']]
+                table['refdate'] = str(table['refdate'])
+                return table
+        except (IOError, KeyError, ValueError):
+            pass
+    table = compute_baselines([get_parfile(datadir,d) for d in dates],dates,refdate)
+    table['mtimes'] = mtimes
+    tmpfile = '{0}.{1}.tmp.npz'.format(cachefile[:-4],os.getpid())
+    np.savez(tmpfile,refdate=refdate,**table)
+    os.rename(tmpfile,cachefile)
+    with open(os.path.join(datadir,TABLE),'w') as f:
+        f.write('# Baselines with respect to {0}: date, Btemp (days), Bperp (m), Bpar (m)\n'.format(refdate))
+        for date, btemp, bperp, bpar in zip(dates,table['btemp'],table['bperp'],table['bpar']):
+            f.write('{0} {1:.0f} {2:.2f} {3:.2f}\n'.format(date,btemp,bperp,bpar))
+    table['refdate'] = refdate
+    return table
+
+def read_orbits(parfiles):
+    """
+    Reads the state vectors of all parfiles into stacked arrays: time of
+    the first state vector and interval (s), number of state vectors, and
+    positions and velocities (ndates, max number of state vectors, 3),
+    padded with NaN. Also returns the centre time of each date
+    """
+    pars = [read_par(p) for p in parfiles]
+    nsv = np.array([p['number_of_state_vectors'] for p in pars])
+    pos = np.full((len(pars),nsv.max(),3),np.nan)
+    vel = np.full((len(pars),nsv.max(),3),np.nan)
+    for i, p in enumerate(pars):
+        for k in range(nsv[i]):
+            pos[i,k] = p['state_vector_position_{0}'.format(k+1)][:3]
+            vel[i,k] = p['state_vector_velocity_{0}'.format(k+1)][:3]
+    return {'t0': np.array([p['time_of_first_state_vector'] for p in pars],dtype=np.float64),
+            'dt': np.array([p['state_vector_interval'] for p in pars],dtype=np.float64),
+            'nsv': nsv, 'position': pos, 'velocity': vel,
+            'center_time': np.array([p['center_time'] for p in pars],dtype=np.float64)}, pars
+
+def interpolate_stack(orbits,t):
+    """
+    Returns the positions and velocities (ndates, 3) of all dates at their
+    times t (s of day), using cubic Hermite interpolation
+    """
+    n = np.arange(len(t))
+    x = (t-orbits['t0'])/orbits['dt']
+    i = np.clip(np.floor(x).astype(np.int64),0,orbits['nsv']-2)
+    s = (x-i)[:,None]
+    h = orbits['dt'][:,None]
+    p0, p1 = orbits['position'][n,i], orbits['position'][n,i+1]
+    m0, m1 = orbits['velocity'][n,i]*h, orbits['velocity'][n,i+1]*h
+    s2 = s*s
+    s3 = s2*s
+    pos = (2*s3-3*s2+1)*p0+(s3-2*s2+s)*m0+(-2*s3+3*s2)*p1+(s3-s2)*m1
+    vel = ((6*s2-6*s)*p0+(3*s2-4*s+1)*m0+(-6*s2+6*s)*p1+(3*s2-2*s)*m1)/h
+    return pos, vel
+
+def llh2xyz(lat,lon,hgt=0.):
+    """Converts latitude and longitude (degrees) and height (m) to ECEF (m)"""
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    n = WGS84_A/np.sqrt(1-WGS84_E2*np.sin(lat)**2)
+    return np.array([(n+hgt)*np.cos(lat)*np.cos(lon),
+                     (n+hgt)*np.cos(lat)*np.sin(lon),
+                     (n*(1-WGS84_E2)+hgt)*np.sin(lat)])
+
+def compute_baselines(parfiles,dates,refdate):
+    """
+    Computes the temporal (days), perpendicular and parallel (m) baselines
+    of the dates, given with their .slc.par files, with respect to refdate.
+    Returns a dictionary with the dates and the three baselines as arrays
+    """
+    orbits, pars = read_orbits(parfiles)
+    ref = dates.index(refdate)
+    target = llh2xyz(pars[ref]['center_latitude'],pars[ref]['center_longitude'])
+
+    # Zero Doppler time of every date with respect to the reference target
+    t = orbits['center_time'].copy()
+    for it in range(ITERATIONS):
+        pos, vel = interpolate_stack(orbits,t)
+        t -= np.sum((pos-target)*vel,axis=1)/np.sum(vel*vel,axis=1)
+    pos, vel = interpolate_stack(orbits,t)
+
+    los = pos[ref]-target
+    los /= np.linalg.norm(los)
+    along = vel[ref]/np.linalg.norm(vel[ref])
+    # Perpendicular to line of sight and flight direction, pointing up, away
+    # from the earth centre
+    perp = np.cross(along,los)
+    perp /= np.linalg.norm(perp)
+    if np.dot(perp,pos[ref]) < 0:
+        perp = -perp
+    baseline = pos-pos[ref]
+    bperp = baseline.dot(perp)
+    bpar = baseline.dot(los)
+
+    todate = lambda d: dt.date(int(d[:4]),int(d[4:6]),int(d[6:8]))
+    btemp = np.array([(todate(d)-todate(refdate)).days for d in dates],dtype=np.float64)
+    return {'dates': list(dates), 'btemp': btemp, 'bperp': bperp, 'bpar': bpar}
+
+def pair_baselines(table):
+    """
+    Returns the temporal (days) and perpendicular (m) baselines between all
+    pairs of dates in table, as (ndates, ndates) arrays of second minus first
+    """
+    btemp = table['btemp'][None,:]-table['btemp'][:,None]
+    bperp = table['bperp'][None,:]-table['bperp'][:,None]
+    return btemp, bperp
+
+def baseline_distance(table):
+    """
+    Returns the distance between all pairs of dates in table, combining their
+    temporal and perpendicular baselines using TEMPORAL_SCALE and
+    PERPENDICULAR_SCALE
+    """
+    btemp, bperp = pair_baselines(table)
+    return np.hypot(btemp/TEMPORAL_SCALE,bperp/PERPENDICULAR_SCALE)
+
+def date_distance(table=None):
+    """
+    Returns a function giving the distance between two dates (yyyymmdd), see
+    baseline_distance. Dates that are not in table, or all dates if table
+    is None, only use their temporal baseline
+    """
+    todate = lambda d: dt.date(int(d[:4]),int(d[4:6]),int(d[6:8]))
+    index = {}
+    if table is not None:
+        index = dict((d, i) for i, d in enumerate(table['dates']))
+        distance = baseline_distance(table)
+    def get_distance(date1,date2):
+        date1, date2 = str(date1), str(date2)
+        if date1 in index and date2 in index:
+            return distance[index[date1],index[date2]]
+        return abs((todate(date2)-todate(date1)).days)/TEMPORAL_SCALE
+    return get_distance
+
+def distance_matrix(dates,table=None):
+    """
+    Returns the distance between all pairs of dates (yyyymmdd) as an (n,n)
+    array, see date_distance
+    """
+    todate = lambda d: dt.date(int(d[:4]),int(d[4:6]),int(d[6:8]))
+    days = np.array([todate(str(d)).toordinal() for d in dates],dtype=np.float64)
+    distance = np.abs(days[None,:]-days[:,None])/TEMPORAL_SCALE
+    if table is not None:
+        index = dict((d, i) for i, d in enumerate(table['dates']))
+        ix = np.array([index.get(str(d),-1) for d in dates],dtype=np.int64)
+        inside = np.flatnonzero(ix >= 0)
+        distance[np.ix_(inside,inside)] = baseline_distance(table)[np.ix_(ix[inside],ix[inside])]
+    return distance
+
+def baseline_tree(distance,depth,maxdepth=None,exclude=()):
+    """
+    Returns the parent and depth of each node in the minimum spanning tree of
+    the (n,n) distance matrix (Prim). The tree is grown from the nodes with a
+    depth of 0 or more in the array depth, which keep parent -1. Nodes in
+    exclude are not used as parent, and if maxdepth is given neither are
+    nodes of depth maxdepth, so each node is attached to the closest node
+    that can still be a parent. Only if there is no such node yet, the
+    first node is attached to the closest node in the tree. The tree takes
+    O(n^2) operations
+    """
+    n = len(distance)
+    depth = np.array(depth,dtype=np.int64)
+    parent = -np.ones(n,dtype=np.int64)
+    intree = depth >= 0
+    if maxdepth is None:
+        maxdepth = n
+    canparent = intree & (depth < maxdepth)
+    canparent[list(exclude)] = False
+    candidates = np.flatnonzero(canparent)
+    fallback = not len(candidates)
+    if fallback:
+        candidates = np.flatnonzero(intree)
+    # Closest possible parent of each node, and its distance
+    nearest = candidates[np.argmin(distance[candidates],axis=0)]
+    best = distance[nearest,np.arange(n)]
+    for k in range(n-intree.sum()):
+        node = np.argmin(np.where(intree,np.inf,best))
+        parent[node] = nearest[node]
+        depth[node] = depth[parent[node]]+1
+        intree[node] = True
+        if depth[node] < maxdepth:
+            if fallback:
+                # First possible parent, stop using the other tree nodes
+                best[:] = np.inf
+                fallback = False
+            closer = distance[node] < best
+            best[closer] = distance[node,closer]
+            nearest[closer] = node
+    return parent, depth
+
+
+if __name__ == "__main__":
+    sys.exit(main())
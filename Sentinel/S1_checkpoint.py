@@ -0,0 +1,128 @@
+"""
+
+Keeps track of the finished processing steps of each date
+
+Overview
+========
+
+The checkpoint manifest is a SQLite database, checkpoint.sql, in the processing directory. For each date it holds the processing steps that finished, in order, together with the size and modification time of the files each step produced. A step counts as finished on a rerun as long as its record exists and its files have not changed since, so processing of a date can resume from its first unfinished step after a crash or preemption.
+
+Sizes and modification times are used instead of checksums, as checksumming the (multi-GB) resampled SLCs would take about as long as the step itself. The manifest does not use write-ahead logging, as processing directories may be on NFS. Each call opens its own short-lived connection, so the functions can be used from worker processes.
+
+Functions
+=========
+
+Main functions
+--------------
+
+  init_manifest:
+    Creates or migrates the manifest of a processing directory
+  get_done:
+    Returns the finished steps of a date
+  record_step:
+    Records a finished step with the state of its files
+  clear_steps:
+    Forgets finished steps of a date
+
+Aux functions
+-------------
+
+  file_state:
+    Returns size and modification time of files
+  unchanged:
+    Checks whether files still have their recorded state
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+
+from RIMoDe.Sentinel.S1_db_schema import migrate
+
+MANIFEST = 'checkpoint.sql'
+
+CHECKPOINT_MIGRATIONS = [
+    # Version 1: finished steps per date
+    ['CREATE TABLE IF NOT EXISTS steps ('
+     '    date TEXT,'
+     '    step TEXT,'
+     '    seq INTEGER,'
+     '    finished REAL,'
+     '    files TEXT,'
+     '    PRIMARY KEY (date, step))'],
+]
+
+def connect(manifest):
+    # Workers may record steps at the same time, wait for each other's locks
+    return sqlite3.connect(manifest, timeout=60)
+
+def init_manifest(datadir):
+    """Creates or migrates the manifest in datadir, returns its filename"""
+    manifest = os.path.join(datadir, MANIFEST)
+    conn = connect(manifest)
+    try:
+        migrate(conn, CHECKPOINT_MIGRATIONS, wal=False)
+    finally:
+        conn.close()
+    return manifest
+
+def file_state(paths):
+    """
+    Returns a dictionary with [size, mtime] of each path, None if the path
+    does not exist
+    """
+    state = {}
+    for p in paths:
+        try:
+            st = os.stat(p)
+            state[p] = [st.st_size, st.st_mtime]
+        except OSError:
+            state[p] = None
+    return state
+
+def unchanged(recorded, paths=None):
+    """
+    Checks whether paths (default: all recorded paths) still exist with
+    their recorded size and modification time
+    """
+    if paths is None:
+        paths = recorded.keys()
+    current = file_state(paths)
+    return all(recorded.get(p) is not None and current[p] == recorded[p]
+               for p in paths)
+
+def get_done(manifest, date):
+    """
+    Returns a dictionary with the recorded file states of each finished step
+    of date
+    """
+    conn = connect(manifest)
+    try:
+        rows = conn.execute('SELECT step, files FROM steps WHERE date = ? ORDER BY seq',
+                            (date,)).fetchall()
+    finally:
+        conn.close()
+    return dict((step, json.loads(files)) for step, files in rows)
+
+def record_step(manifest, date, step, seq, paths):
+    """Records step number seq of date as finished, producing paths"""
+    files = json.dumps(file_state(paths))
+    conn = connect(manifest)
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO steps VALUES (?,?,?,?,?)',
+                         (date, step, seq, time.time(), files))
+    finally:
+        conn.close()
+
+def clear_steps(manifest, date, fromseq=0):
+    """Forgets the finished steps of date from step number fromseq on"""
+    conn = connect(manifest)
+    try:
+        with conn:
+            conn.execute('DELETE FROM steps WHERE date = ? AND seq >= ?',
+                         (date, fromseq))
+    finally:
+        conn.close()
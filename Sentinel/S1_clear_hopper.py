@@ -1,15 +1,77 @@
+"""
+
+Distributes downloaded Sentinel-1 data from the hopper to the track directories
+
+Overview
+========
+
+Extracts the .zip files downloaded to the hopper directory (see S1_find_data.py), moves the .SAFE directories to the directory of their track in the output data directory, and inserts them into the database. If the -p option is given, new images are set up and processed in the processing directories of their track. To process new data continuously as it arrives, use S1_hopper_daemon.py instead.
+
+The zip files are extracted by a pool of worker processes, set with the -j option. Only the members used by the processing chain are extracted: the manifest, and the annotation (including calibration and noise) and measurement files, optionally of a single polarisation given with the -l option. The manifest is read from the zip file first to find the track, after which the other members are streamed straight into the track directory. Members are extracted to a .SAFE.part directory which is renamed once all members are extracted and their CRCs have been checked. As the other members (previews, support files, and other polarisations) are not extracted, extracted zip files are moved to the extracted directory in the hopper rather than removed, and can be deleted from there once they are no longer needed. Zip files that could not be extracted are added to failed.list in the hopper directory and left in place. .SAFE directories already in the hopper are moved as before.
+
+Functions
+=========
+
+Main functions
+--------------
+
+  unzip_files:
+    Extracts all zip files in the hopper using a pool of workers
+  extract_zip:
+    Extracts the members of a single zip file needed for processing
+  distribute_data:
+    Moves .SAFE directories to their track directory and inserts them into
+    the database
+  setup_image:
+    Sets up the SLC of a new date in a processing directory
+  coreg_image:
+    Coregisters a new date in a processing directory and forms its
+    interferogram
+
+Aux functions
+-------------
+
+  move_safe:
+    Moves a .SAFE directory to the directory of its track
+  get_procdirs:
+    Returns the processing directories of a track
+  get_orbit:
+    Reads the relative orbit number from the manifest file
+  read_orbit:
+    Reads the relative orbit number from an open manifest file
+  wanted_member:
+    Checks whether a zip member is needed for processing
+  archive_zip:
+    Removes or archives a zip file after extraction
+
+Usage
+=====
+
+S1_clear_hopper.py -i </path/to/hopper/directory> -d </path/to/data/directory> [-l <polarisation>] [-j <no of processes>] [-p]
+
+    -i        Hopper directory containing the downloaded zip files
+    -d        Output data directory containing the track directories
+    -l        Only extract files of the given polarisation, e.g. vv. The
+              other polarisations are only kept in the zip file, in the
+              extracted directory of the hopper
+    -j        Number of zip files to extract at the same time, default 2
+    -p        Set up and process the new images in the processing directories
+              of their tracks
+"""
+
 import sys
 import getopt
 import os
 import shutil
-import subprocess as subp
+import zipfile
 import sqlite3
 import datetime as dt
 import numpy as np
+from multiprocessing import Pool
 from RIMoDe.Sentinel.S1_insert_db import db_insert
 from RIMoDe.Sentinel.S1_setup_images import make_image
 from RIMoDe.Sentinel.S1_process_slaves import process_slave, get_swath_pol
-from RIMoDe.utils import grep
+from RIMoDe.utils import read_par
 
 try:
     import xml.etree.cElementTree as ET
@@ -22,17 +84,15 @@ class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
 
-class cd:
-    """Context manager for changing the current working directory"""
-    def __init__(self, newPath):
-        self.newPath = os.path.expanduser(newPath)
+# BEWARE: database filenames hardcoded below!!!!
+DBFILENAME = '/nfs/a1/raw/sentinel/iceland/S1_iceland.sql'
+ORBITDBFILENAME = '/nfs/a1/raw/sentinel/iceland/S1_orbits.sql'
 
-    def __enter__(self):
-        self.savedPath = os.getcwd()
-        os.chdir(self.newPath)
+# Block size used when streaming zip members to disk
+CHUNKSIZE = 2**20
 
-    def __exit__(self, etype, value, traceback):
-        os.chdir(self.savedPath)
+# Directory in the hopper keeping zip files that were not extracted completely
+ARCHIVEDIR = 'extracted'
 
 def main(argv=None):
     if argv == None:
@@ -40,11 +100,14 @@ def main(argv=None):
     queryfile = []
     xmlfile = []
     datadir = []
+    hopperdir = []
     procflag = False
+    pol = None
+    nproc = 2
     
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hd:i:p", ["help"])
+            opts, args = getopt.getopt(argv[1:], "hd:i:pl:j:", ["help"])
         except getopt.error, msg:
             raise Usage(msg)
         for o, a in opts:
@@ -57,11 +120,25 @@ def main(argv=None):
                 hopperdir = a
             elif o == '-p':
                 procflag = True
+            elif o == '-l':
+                pol = a.lower()
+            elif o == '-j':
+                try:
+                    nproc = int(a)
+                except ValueError:
+                    raise Usage('Number of processes {0} given with -j is not an integer.'.format(a))
+                if nproc < 1:
+                    raise Usage('Number of processes given with -j should be at least 1.')
+
+        if not hopperdir:
+            raise Usage('No hopper directory given, -i option is not optional!')
+        if not datadir:
+            raise Usage('No output data directory given, -d option is not optional!')
 
         if not os.path.exists(hopperdir):
-            raise Usage('Hopper directory {0} does not exist.'.format(datadir))
+            raise Usage('Hopper directory {0} does not exist.'.format(hopperdir))
         elif not os.path.isdir(hopperdir):
-            raise Usage('Given hopper directory {0} is not a directory.'.format(datadir))
+            raise Usage('Given hopper directory {0} is not a directory.'.format(hopperdir))
 
         if not os.path.exists(datadir):
             raise Usage('Output data directory {0} does not exist.'.format(datadir))
@@ -75,66 +152,100 @@ def main(argv=None):
         print >>sys.stderr, "\nFor help, use -h or --help.\n"
         return 2
         
-    failed_list = unzip_files(hopperdir)
+    failed_list, safelist = unzip_files(hopperdir,datadir,pol,nproc)
     with open(os.path.join(hopperdir,'failed.list'),'a') as f:
         for l in failed_list:
             f.write('{0}\n'.format(l))
 
-    # BEWARE: database filenames hardcoded below!!!!
-    dbfilename = '/nfs/a1/raw/sentinel/iceland/S1_iceland.sql'
-    orbitdbfilename = '/nfs/a1/raw/sentinel/iceland/S1_orbits.sql'
-
-    conn = sqlite3.connect(dbfilename)
+    conn = sqlite3.connect(DBFILENAME)
     c = conn.cursor()
-    tracklist, datelist = distribute_data(datadir,hopperdir,c,conn)
+    tracklist, datelist = distribute_data(datadir,hopperdir,c,conn,safelist)
 
     if procflag:
         for t in set(tracklist):
             slavedate = [sd for tt,sd in zip(tracklist,datelist) if tt == t][0]
-            query = 'SELECT proc_dir FROM tracks_procdirs WHERE track = {0}'.format(t)
-            c.execute(query)
-            res = c.fetchall()
-            slavedate_dt = dt.datetime(int(slavedate[:4]),int(slavedate[4:6]),int(slavedate[6:]))
-            if res:
-                for procdir in res[0]:
-                    with open(os.path.join(procdir,'burstid.list')) as f:
-                        burstidlist = f.read().strip().split('\n')
-                    make_image(procdir,burstidlist,slavedate,c,orbitdbfilename)
-                    for f in os.listdir(os.path.join(procdir,'Geo')):
-                        if f[-4:] == '.dem' and f[0] == '2':
-                            masterdate = f.split('.')[0]
-                            masterdate_dt = dt.datetime(int(masterdate[:4]),int(masterdate[4:6]),int(masterdate[6:]))
-                            break
-                    masterbaseline = abs(masterdate_dt-slavedate_dt)
-                    swathlist, pol = get_swath_pol(procdir,masterdate)
-                    res = grep('range_samples',os.path.join(procdir,'SLC',masterdate,'{md}.mli.par'.format(md=masterdate)))
-                    mliwidth = np.int32(res.split(':')[1].strip())
-                    process_slave(procdir,masterdate,slavedate,masterbaseline,swathlist,pol,mliwidth)
+            for procdir in get_procdirs(c,t):
+                if setup_image(procdir,slavedate,c,ORBITDBFILENAME):
+                    coreg_image(procdir,slavedate)
     conn.close()
 
-def distribute_data(datadir,hopperdir,c,conn):
+def distribute_data(datadir,hopperdir,c,conn,safelist=[]):
+    """
+    Moves the .SAFE directories in hopperdir to their track directory in
+    datadir, and inserts these and the .SAFE directories in safelist, already
+    extracted to their track directory, into the database
+    """
     datalist = os.listdir(hopperdir)
     tracklist = []
     datelist = []
     for d in datalist:
         if os.path.isdir(os.path.join(hopperdir,d)) and d[-5:] == '.SAFE':
-            orbnumber = get_orbit(os.path.join(hopperdir,d))
-            orbdir = os.path.join(datadir,'T'+orbnumber)
-            if not os.path.exists(orbdir):
-                os.mkdir(orbdir)
-            if not os.path.exists(os.path.join(orbdir,d)):
-                shutil.move(os.path.join(hopperdir,d),orbdir)
-            else:
-                print 'WARNING: Data directory {0} already in destination directory {1}'.format(d,orbdir)
-            sensdate = db_insert(os.path.join(orbdir,d),c,conn)
+            safedir, orbnumber = move_safe(datadir,os.path.join(hopperdir,d))
+            sensdate = db_insert(safedir,c,conn)
             datelist.append(sensdate)
             tracklist.append(orbnumber)
+    for safedir, orbnumber in safelist:
+        sensdate = db_insert(safedir,c,conn)
+        datelist.append(sensdate)
+        tracklist.append(orbnumber)
     return tracklist, datelist
             
 
+def move_safe(datadir,safedir):
+    """
+    Moves safedir to the directory of its track in datadir, returns its new
+    location and the track
+    """
+    d = os.path.basename(safedir.rstrip('/'))
+    orbnumber = get_orbit(safedir)
+    orbdir = os.path.join(datadir,'T'+orbnumber)
+    try:
+        os.mkdir(orbdir)
+    except OSError:
+        if not os.path.isdir(orbdir):
+            raise
+    if not os.path.exists(os.path.join(orbdir,d)):
+        shutil.move(safedir,orbdir)
+    else:
+        print 'WARNING: Data directory {0} already in destination directory {1}'.format(d,orbdir)
+    return os.path.join(orbdir,d), orbnumber
+
+def get_procdirs(c,track):
+    c.execute('SELECT proc_dir FROM tracks_procdirs WHERE track = ?',(int(track),))
+    return [r[0] for r in c.fetchall()]
+
+def setup_image(procdir,slavedate,c,orbitdb):
+    """
+    Sets up the SLC of slavedate in processing directory procdir. Returns
+    False if bursts are missing for this date
+    """
+    with open(os.path.join(procdir,'burstid.list')) as f:
+        burstidlist = f.read().strip().split('\n')
+    return make_image(procdir,burstidlist,slavedate,c,orbitdb)
+
+def coreg_image(procdir,slavedate):
+    """
+    Coregisters slavedate to the master of processing directory procdir and
+    forms its interferogram
+    """
+    for f in os.listdir(os.path.join(procdir,'Geo')):
+        if f[-4:] == '.dem' and f[0] == '2':
+            masterdate = f.split('.')[0]
+            break
+    masterdate_dt = dt.datetime(int(masterdate[:4]),int(masterdate[4:6]),int(masterdate[6:]))
+    slavedate_dt = dt.datetime(int(slavedate[:4]),int(slavedate[4:6]),int(slavedate[6:]))
+    masterbaseline = abs(masterdate_dt-slavedate_dt)
+    swathlist, pol = get_swath_pol(procdir,masterdate)
+    mliwidth = np.int32(read_par(os.path.join(procdir,'SLC',masterdate,'{md}.mli.par'.format(md=masterdate)))['range_samples'])
+    process_slave(procdir,masterdate,slavedate,masterbaseline,swathlist,pol,mliwidth)
+
 def get_orbit(datadir):
     manifestfile = os.path.join(datadir,'manifest.safe')
-    tree = ET.ElementTree(file=manifestfile)
+    with open(manifestfile) as f:
+        return read_orbit(f)
+
+def read_orbit(f):
+    tree = ET.ElementTree(file=f)
     root = tree.getroot()
     metadatasection = root.find('metadataSection')
     for el in metadatasection:
@@ -144,23 +255,129 @@ def get_orbit(datadir):
                     orbnumber = orbel.text
                     return orbnumber
 
-def unzip_files(datadir):
-    ziplist = os.listdir(datadir)
+def wanted_member(name,pol=None):
+    """
+    Checks whether zip member name is needed for processing: the manifest,
+    annotation, calibration and noise files, and measurement files, of
+    polarisation pol only if given
+    """
+    parts = name.split('/')
+    if len(parts) < 2 or not parts[0].endswith('.SAFE') or '..' in parts:
+        return False
+    if parts[1:] == ['manifest.safe']:
+        return True
+    if (parts[1] == 'annotation' and name.endswith('.xml')) or \
+       (parts[1] == 'measurement' and name.endswith('.tiff')):
+        return pol is None or '-{0}-'.format(pol) in parts[-1]
+    return False
+
+def extract_zip(args):
+    """
+    Extracts the members of zipfile needed for processing to
+    datadir/T<track>/<name>.SAFE, or to the directory of zipfile if datadir
+    is None. Returns the zip file name, the status, the .SAFE directory, the
+    track and whether all members of zipfile were extracted
+    """
+    zipname, datadir, pol = args
+    safedir = None
+    orbnumber = None
+    try:
+        with zipfile.ZipFile(zipname) as zf:
+            allmembers = [m for m in zf.infolist() if not m.filename.endswith('/')]
+            members = [m for m in allmembers if wanted_member(m.filename,pol)]
+            complete = len(members) == len(allmembers)
+            manifest = [m for m in members if m.filename.endswith('/manifest.safe')]
+            if len(manifest) != 1:
+                return zipname, 'failed, no manifest.safe found', None, None, False
+            safename = manifest[0].filename.split('/')[0]
+            with zf.open(manifest[0]) as f:
+                orbnumber = read_orbit(f)
+            if orbnumber is None:
+                return zipname, 'failed, no relative orbit number in manifest.safe', None, None, False
+            if datadir is None:
+                outdir = os.path.dirname(zipname)
+            else:
+                outdir = os.path.join(datadir,'T'+orbnumber)
+            safedir = os.path.join(outdir,safename)
+            if os.path.exists(safedir):
+                return zipname, 'exists', safedir, orbnumber, complete
+            partdir = safedir+'.part'
+            if os.path.exists(partdir):
+                shutil.rmtree(partdir)
+            for m in members:
+                filename = os.path.join(partdir,*m.filename.split('/')[1:])
+                try:
+                    os.makedirs(os.path.dirname(filename))
+                except OSError:
+                    # Other workers may create the track directory meanwhile
+                    if not os.path.isdir(os.path.dirname(filename)):
+                        raise
+                # Reading a member to its end checks its CRC
+                with zf.open(m) as src:
+                    with open(filename,'wb') as dst:
+                        shutil.copyfileobj(src,dst,CHUNKSIZE)
+            os.rename(partdir,safedir)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile, IOError, OSError, SyntaxError), err:
+        if safedir and os.path.exists(safedir+'.part'):
+            shutil.rmtree(safedir+'.part')
+        return zipname, 'failed, {0}'.format(err), None, None, False
+    return zipname, 'done', safedir, orbnumber, complete
+
+def archive_zip(zipname,complete):
+    """
+    Removes zipname if all its members were extracted, otherwise moves it to
+    the ARCHIVEDIR directory next to it. Returns the new location, None if
+    removed
+    """
+    if complete:
+        os.remove(zipname)
+        return None
+    archivedir = os.path.join(os.path.dirname(zipname),ARCHIVEDIR)
+    try:
+        os.makedirs(archivedir)
+    except OSError:
+        if not os.path.isdir(archivedir):
+            raise
+    archivename = os.path.join(archivedir,os.path.basename(zipname))
+    os.rename(zipname,archivename)
+    return archivename
+
+def unzip_files(hopperdir,datadir=None,pol=None,nproc=2):
+    """
+    Extracts all zip files in hopperdir using nproc processes, to their track
+    directory in datadir if given (see extract_zip). Successfully extracted
+    zip files are removed, or moved to the ARCHIVEDIR directory in hopperdir
+    if not all members were extracted. Returns the list of failed zip files and a list of
+    the extracted .SAFE directories and their tracks
+    """
+    ziplist = sorted(os.path.join(hopperdir,f) for f in os.listdir(hopperdir) if f[-4:] == '.zip')
     faillist = []
-    for f in ziplist:
-        if f[-4:] == '.zip':
-            unzipcall = ['jar','xvf',f]
-            with cd(datadir):
-                rc = subp.call(unzipcall)
-            if rc == 0:
-                os.remove(os.path.join(datadir,f))
+    safelist = []
+    if not ziplist:
+        return faillist, safelist
+    pool = Pool(min(nproc,len(ziplist)))
+    try:
+        for zipname, status, safedir, orbnumber, complete in pool.imap_unordered(extract_zip,
+                                                                                 [(z,datadir,pol) for z in ziplist]):
+            f = os.path.basename(zipname)
+            if status == 'done':
+                print 'Extracted {0} to {1}'.format(f,safedir)
+                archivename = archive_zip(zipname,complete)
+                if archivename:
+                    print 'Kept {0} in {1}, not all its files were extracted'.format(f,os.path.dirname(archivename))
+            elif status == 'exists':
+                print 'WARNING: Data directory {0} already in destination directory {1}'.format(os.path.basename(safedir),
+                                                                                                os.path.dirname(safedir))
             else:
-                print 'WARNING: Could not unpack {0}, adding to failed list'.format(f)
-                if os.path.exists(os.path.join(datadir,f[:-4]+'.SAFE')):
-                     shutil.rmtree(os.path.join(datadir,f[:-4]+'.SAFE'))
-                                  
+                print 'WARNING: Could not unpack {0} ({1}), adding to failed list'.format(f,status)
                 faillist.append(f)
-    return faillist
+                continue
+            if datadir is not None:
+                safelist.append((safedir,orbnumber))
+    finally:
+        pool.close()
+        pool.join()
+    return faillist, safelist
 
 
 
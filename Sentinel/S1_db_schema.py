@@ -0,0 +1,284 @@
+"""
+
+Creates and migrates the Sentinel-1 burst database
+
+Overview
+========
+
+Keeps the schema of the burst database up to date. The schema version of a database is stored in its user_version pragma, and every migration in S1_MIGRATIONS that has not yet been applied is run in its own transaction. New databases are created from scratch, databases created with init_S1_db.sql (version 0) are migrated in place.
+
+Version 1 creates the files, bursts, files_bursts and tracks_procdirs tables. Version 2 adds indexes for the lookups done during insertion, querying and image setup, and a unique constraint on files_bursts(file_id, burst_id). Duplicate relations are removed before the constraint is added. As this deletes rows, it is only done when migrating explicitly with this script, which prints the number of relations removed. Other scripts migrating a database with duplicate relations stop and point to this script instead. Version 3 adds the bursts_rtree R*Tree index holding the bounding box of the four corners of each burst. Its id is derived from track, swath and burstid (see RTREE_ID), so it does not depend on rowids, which may change on VACUUM. Triggers on the bursts table keep the R*Tree in sync with every insert, update and delete. Version 4 adds the catalogue of products found on SciHub (see S1_find_data.py), keyed by product identifier, the searches done with the last ingestion date seen for each, and the products found by each search.
+
+The orbit database is migrated in the same way using ORBIT_MIGRATIONS, with the -b option. Version 1 creates the porbits and rorbits tables as created by init_orbit_db.sql. Version 2 adds the begin and end of the validity of each orbit file as integer unix epochs, with an index, so orbit files can be looked up by time without converting the time strings of every row (see S1_orbit.py).
+
+After migrating, the database is switched to write-ahead logging, which allows reading while a single process is inserting. WAL relies on shared memory between processes, and should not be used for a database that is accessed from several hosts over NFS. Use the -r option to keep the rollback journal in that case.
+
+Functions
+=========
+
+Main functions
+--------------
+
+  migrate:
+    Applies all outstanding migrations to the database
+  MigrationError:
+    Raised when a migration needs to be run explicitly
+
+Aux functions
+-------------
+
+  get_version:
+    Returns the schema version of the database
+
+Usage
+=====
+
+S1_db_schema.py -d </path/to/database/file> [-r] [-b]
+
+    -d        Defines path and name of SQLite database file to be created or
+              migrated
+    -r        Keep the rollback journal instead of switching to WAL mode
+    -b        The database is an orbit database (see S1_insert_orbit_db.py)
+"""
+
+import sys
+import getopt
+import os
+import sqlite3
+
+class MigrationError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.msg = msg
+
+# Unique integer id of a burst for the R*Tree, burstid is below 1e6 
+RTREE_ID = '{0}track*10000000+{0}swath*1000000+{0}burstid'
+RTREE_JOIN = 'bursts.track = bursts_rtree.id/10000000 AND '+\
+             'bursts.swath = (bursts_rtree.id/1000000)%10 AND '+\
+             'bursts.burstid = bursts_rtree.id%1000000'
+RTREE_BOX = 'min({0}corner1_lat,{0}corner2_lat,{0}corner3_lat,{0}corner4_lat), '+\
+            'max({0}corner1_lat,{0}corner2_lat,{0}corner3_lat,{0}corner4_lat), '+\
+            'min({0}corner1_lon,{0}corner2_lon,{0}corner3_lon,{0}corner4_lon), '+\
+            'max({0}corner1_lon,{0}corner2_lon,{0}corner3_lon,{0}corner4_lon)'
+
+S1_MIGRATIONS = [
+    # Version 1: tables as created by init_S1_db.sql
+    ['CREATE TABLE IF NOT EXISTS files ('
+     '    id TEXT PRIMARY KEY,'
+     '    directory TEXT,'
+     '    track INTEGER,'
+     '    orbit_direction TEXT,'
+     '    swath INTEGER,'
+     '    pol TEXT,'
+     '    date INTEGER)',
+     'CREATE TABLE IF NOT EXISTS bursts ('
+     '    id TEXT PRIMARY KEY,'
+     '    track INTEGER,'
+     '    orbit_direction TEXT,'
+     '    swath INTEGER,'
+     '    burstid INTEGER,'
+     '    center_lat REAL,'
+     '    center_lon REAL,'
+     '    corner1_lat REAL,'
+     '    corner1_lon REAL,'
+     '    corner2_lat REAL,'
+     '    corner2_lon REAL,'
+     '    corner3_lat REAL,'
+     '    corner3_lon REAL,'
+     '    corner4_lat REAL,'
+     '    corner4_lon REAL)',
+     'CREATE TABLE IF NOT EXISTS files_bursts ('
+     '    file_id TEXT,'
+     '    burst_id TEXT,'
+     '    burst_no INTEGER)',
+     'CREATE TABLE IF NOT EXISTS tracks_procdirs ('
+     '    track INTEGER,'
+     '    proc_dir TEXT)'],
+    # Version 2: indexes and unique file/burst relations
+    ['CREATE INDEX IF NOT EXISTS bursts_track_swath_burstid '
+     'ON bursts (track, swath, burstid)',
+     'CREATE INDEX IF NOT EXISTS bursts_center '
+     'ON bursts (center_lon, center_lat)',
+     'CREATE INDEX IF NOT EXISTS files_date_pol ON files (date, pol)',
+     'CREATE INDEX IF NOT EXISTS files_track_pol ON files (track, pol)',
+     'DELETE FROM files_bursts WHERE rowid NOT IN '
+     '(SELECT min(rowid) FROM files_bursts GROUP BY file_id, burst_id)',
+     'CREATE UNIQUE INDEX IF NOT EXISTS files_bursts_file_burst '
+     'ON files_bursts (file_id, burst_id)',
+     'CREATE INDEX IF NOT EXISTS files_bursts_burst '
+     'ON files_bursts (burst_id, file_id)',
+     'CREATE INDEX IF NOT EXISTS tracks_procdirs_track '
+     'ON tracks_procdirs (track)',
+     'ANALYZE'],
+    # Version 3: R*Tree on the burst footprints
+    ['CREATE VIRTUAL TABLE IF NOT EXISTS bursts_rtree USING rtree('
+     '    id, min_lat, max_lat, min_lon, max_lon)',
+     'INSERT OR REPLACE INTO bursts_rtree SELECT {0}, {1} FROM bursts'.format(RTREE_ID.format(''),
+                                                                           RTREE_BOX.format('')),
+     'CREATE TRIGGER IF NOT EXISTS bursts_rtree_insert AFTER INSERT ON bursts '
+     'BEGIN INSERT OR REPLACE INTO bursts_rtree VALUES ({0}, {1}); END'.format(RTREE_ID.format('new.'),
+                                                                            RTREE_BOX.format('new.')),
+     'CREATE TRIGGER IF NOT EXISTS bursts_rtree_update AFTER UPDATE ON bursts '
+     'BEGIN DELETE FROM bursts_rtree WHERE id = {0}; '
+     'INSERT OR REPLACE INTO bursts_rtree VALUES ({1}, {2}); END'.format(RTREE_ID.format('old.'),
+                                                                      RTREE_ID.format('new.'),
+                                                                      RTREE_BOX.format('new.')),
+     'CREATE TRIGGER IF NOT EXISTS bursts_rtree_delete AFTER DELETE ON bursts '
+     'BEGIN DELETE FROM bursts_rtree WHERE id = {0}; END'.format(RTREE_ID.format('old.'))],
+    # Version 4: catalogue of SciHub search results
+    ['CREATE TABLE IF NOT EXISTS catalogue ('
+     '    id TEXT PRIMARY KEY,'
+     '    uuid TEXT,'
+     '    link TEXT,'
+     '    ingestion_date TEXT,'
+     '    begin_position TEXT,'
+     '    size TEXT)',
+     'CREATE TABLE IF NOT EXISTS searches ('
+     '    query TEXT PRIMARY KEY,'
+     '    last_ingestion TEXT,'
+     '    last_run REAL)',
+     'CREATE TABLE IF NOT EXISTS searches_catalogue ('
+     '    query TEXT,'
+     '    id TEXT,'
+     '    PRIMARY KEY (query, id))'],
+]
+
+# Rows deleted by a migration, per resulting schema version: a query
+# counting them and what they are. Only deleted when migrating explicitly
+S1_DELETIONS = {
+    2: ('SELECT count(*) FROM files_bursts WHERE rowid NOT IN '
+        '(SELECT min(rowid) FROM files_bursts GROUP BY file_id, burst_id)',
+        'duplicate file/burst relations'),
+}
+
+ORBIT_EPOCH = "CAST(strftime('%s',{0}) AS INTEGER)"
+
+ORBIT_MIGRATIONS = [
+    # Version 1: tables as created by init_orbit_db.sql
+    ['CREATE TABLE IF NOT EXISTS porbits ('
+     '    id TEXT PRIMARY KEY,'
+     '    directory TEXT,'
+     '    begintime TIME,'
+     '    endtime TIME)',
+     'CREATE TABLE IF NOT EXISTS rorbits ('
+     '    id TEXT PRIMARY KEY,'
+     '    directory TEXT,'
+     '    begintime TIME,'
+     '    endtime TIME)'],
+    # Version 2: validity as indexed unix epochs
+    ['ALTER TABLE porbits ADD COLUMN begin_epoch INTEGER',
+     'ALTER TABLE porbits ADD COLUMN end_epoch INTEGER',
+     'UPDATE porbits SET begin_epoch = {0}, end_epoch = {1}'.format(ORBIT_EPOCH.format('begintime'),
+                                                                 ORBIT_EPOCH.format('endtime')),
+     'CREATE INDEX IF NOT EXISTS porbits_epoch ON porbits (begin_epoch, end_epoch)',
+     'ALTER TABLE rorbits ADD COLUMN begin_epoch INTEGER',
+     'ALTER TABLE rorbits ADD COLUMN end_epoch INTEGER',
+     'UPDATE rorbits SET begin_epoch = {0}, end_epoch = {1}'.format(ORBIT_EPOCH.format('begintime'),
+                                                                 ORBIT_EPOCH.format('endtime')),
+     'CREATE INDEX IF NOT EXISTS rorbits_epoch ON rorbits (begin_epoch, end_epoch)'],
+]
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv
+
+    dbfilename = []
+    wal = True
+    migrations = S1_MIGRATIONS
+
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "hd:rb", ["help"])
+        except getopt.error, msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print __doc__
+                return 0
+            elif o == '-d':
+                dbfilename = a
+            elif o == '-r':
+                wal = False
+            elif o == '-b':
+                migrations = ORBIT_MIGRATIONS
+
+        if not dbfilename:
+            raise Usage('No SQLite database file name given, -d option is not optional!')
+        if os.path.dirname(dbfilename) and not os.path.isdir(os.path.dirname(dbfilename)):
+            raise Usage('Directory of database file {0} does not exist.'.format(dbfilename))
+
+    except Usage, err:
+        print >>sys.stderr, "\nWoops, something went wrong:"
+        print >>sys.stderr, "  "+str(err.msg)
+        print >>sys.stderr, "\nFor help, use -h or --help.\n"
+        return 2
+
+    conn = sqlite3.connect(dbfilename)
+    oldversion = get_version(conn)
+    newversion = migrate(conn,migrations,wal=wal,delete=True)
+    if newversion == oldversion:
+        print 'Database {0} is up to date (version {1}).'.format(dbfilename,newversion)
+    else:
+        print 'Migrated database {0} from version {1} to {2}.'.format(dbfilename,oldversion,newversion)
+    conn.close()
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn,migrations=S1_MIGRATIONS,target=None,wal=True,delete=False):
+    """
+    Applies the migrations of conn up to version target (default: all).
+    Migrations of S1_MIGRATIONS that delete rows (S1_DELETIONS) raise a
+    MigrationError if there are rows to delete, unless delete is True, in
+    which case the number of rows deleted is printed. Returns the version
+    """
+    deletions = S1_DELETIONS if migrations is S1_MIGRATIONS else {}
+    if target is None:
+        target = len(migrations)
+    version = get_version(conn)
+    if version > len(migrations):
+        raise ValueError('Database schema version {0} is newer than this software supports ({1})'.format(version,len(migrations)))
+
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        while version < target:
+            # Take the write lock before reading the version, so that other
+            # processes migrating the same database wait and skip the
+            # migrations applied meanwhile
+            c.execute('BEGIN IMMEDIATE')
+            version = get_version(conn)
+            if version >= target:
+                c.execute('COMMIT')
+                break
+            try:
+                if version+1 in deletions:
+                    query, description = deletions[version+1]
+                    ndelete = c.execute(query).fetchone()[0]
+                    if ndelete and not delete:
+                        raise MigrationError('Migrating to schema version {0} removes {1} {2}, migrate '
+                                             'explicitly with: S1_db_schema.py -d <database> -r'.format(version+1,ndelete,description))
+                    elif ndelete:
+                        print 'Removing {0} {1}'.format(ndelete,description)
+                for statement in migrations[version]:
+                    c.execute(statement)
+                c.execute('PRAGMA user_version = {0}'.format(version+1))
+            except:
+                c.execute('ROLLBACK')
+                raise
+            c.execute('COMMIT')
+            version += 1
+        if wal:
+            c.execute('PRAGMA journal_mode = WAL')
+    finally:
+        conn.isolation_level = isolation_level
+    return version
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,7 +5,11 @@ Search and/or download data from Sentinel SciHub
 Overview
 ========
 
-This script handles the searching and downloading of data from the Sentinel SciHub. When searching the data, and .qry file is used to give the search parameters. The search results in an .xml file being download from the SciHub. If an output directory is given, the data found will be downloaded. Alternatively, the .xml file can be reviewed first. If no .qry file is given, the .xml file is assumed to exist, and the data contained in it will be downloaded instead of searching for new data.
+This script handles the searching and downloading of data from the Sentinel SciHub. When searching the data, and .qry file is used to give the search parameters. If an output directory is given, the data found will be downloaded. Alternatively, the search results can be written to an .xml file using the -x option, and reviewed first. If no .qry file is given, the .xml file is assumed to exist, and the data contained in it will be downloaded instead of searching for new data.
+
+Search results are requested from the hub in pages of 100 products, ordered by ingestion date, and each page is parsed as it is received. The products found are stored in a catalogue in the local database, keyed by product identifier, together with the last ingestion date seen for the query. Later runs of the same query only ask for products ingested since then, and download from the catalogue. The hub can be changed with the -s option, for instance to test against a local server.
+
+Products are downloaded by a pool of threads, set with the -j option. Products that are already in the local database are found with a single query before downloading starts. Each product is downloaded to a .zip.part file, which is renamed once complete. An interrupted download is resumed from the end of the .part file using an HTTP range request, on retry or on the next run. Completed downloads are verified against the MD5 checksum that the hub provides for each product, and downloaded again if it does not match.
 
 Functions
 =========
@@ -14,15 +18,31 @@ Main functions
 --------------
   
   do_query:
-    Performs the search query on SciHub, resulting in an .xm file with query results
+    Performs the search query on SciHub page by page, storing the results in 
+    the local catalogue
   get_data:
     Downloads the data contained in .xml file to destination directory
+  download_product:
+    Downloads a single product, resuming partial downloads and verifying 
+    its checksum
 
 Aux functions
 -------------
 
   parse_query_file:
     Parses the .qry file and sets up query to SciHub
+  parse_feed:
+    Parses a page of search results incrementally
+  store_entries:
+    Stores a page of search results in the catalogue
+  get_catalogue:
+    Returns the products in the catalogue found by a query
+  write_xml:
+    Writes products to an .xml file
+  get_ingested:
+    Returns the ids of all products in the local database
+  get_checksum_url:
+    Returns the url of the MD5 checksum of a product
 
 Contributors
 ============
@@ -34,7 +54,7 @@ October 2015: Original implementation
 Usage
 =====
 
-S1_find_data.py -d </path/to/target/directory/> -q </path/to/query/file> -u <scihub username> -p <scihub password> -x </path/to/xmlfile>
+S1_find_data.py -d </path/to/target/directory/> -q </path/to/query/file> -u <scihub username> -p <scihub password> [-x </path/to/xmlfile>] [-j <no of downloads>] [-o </path/to/database/file>] [-s <hub url>]
 
     -d        Defines path to target directory for download. If omitted, data will
               not be downloaded
@@ -43,7 +63,12 @@ S1_find_data.py -d </path/to/target/directory/> -q </path/to/query/file> -u <sci
               This xml file will then be used to download
     -u        SciHub username
     -p        SciHub password
-    -x        Path and name of SciHub query result .xml file
+    -x        Path and name of SciHub query result .xml file. Written if -q is
+              given, read otherwise
+    -j        Number of products to download at the same time, default 2
+    -o        Path and name of the database holding the catalogue, default
+              /nfs/a1/raw/sentinel/iceland/S1_iceland.sql
+    -s        Url of the hub, default https://scihub.esa.int/dhus
 """
 
 
@@ -51,16 +76,35 @@ S1_find_data.py -d </path/to/target/directory/> -q </path/to/query/file> -u <sci
 import sys
 import getopt
 import os
-import subprocess as subp
 import sqlite3
+import time
+import base64
+import hashlib
+import socket
+import urllib
+import urllib2
+from multiprocessing.pool import ThreadPool
 
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
 
+from RIMoDe.Sentinel.S1_db_schema import migrate
+
 import pdb
 
+SCIHUB_URL = 'https://scihub.esa.int/dhus'
+ATOM = '{http://www.w3.org/2005/Atom}'
+
+# Size of the blocks read from the network, and network timeout in seconds
+CHUNKSIZE = 2**20
+TIMEOUT = 120
+
+# Number of search results per page, and characters left as is in the query
+ROWS = 100
+QUERY_SAFE = '+:()[]",.*-'
+
 class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -71,10 +115,13 @@ def main(argv=None):
     queryfile = []
     xmlfile = []
     datadir = []
+    nproc = 2
+    dbfilename = '/nfs/a1/raw/sentinel/iceland/S1_iceland.sql'
+    huburl = SCIHUB_URL
 
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hd:q:u:p:x:", ["help"])
+            opts, args = getopt.getopt(argv[1:], "hd:q:u:p:x:j:o:s:", ["help"])
         except getopt.error, msg:
             raise Usage(msg)
         for o, a in opts:
@@ -91,6 +138,17 @@ def main(argv=None):
                 password = a
             elif o == '-x':
                 xmlfile = a
+            elif o == '-j':
+                try:
+                    nproc = int(a)
+                except ValueError:
+                    raise Usage('Number of downloads {0} given with -j is not an integer.'.format(a))
+                if nproc < 1:
+                    raise Usage('Number of downloads given with -j should be at least 1.')
+            elif o == '-o':
+                dbfilename = a
+            elif o == '-s':
+                huburl = a.rstrip('/')
         
         if datadir:
             if not os.path.exists(datadir):
@@ -102,8 +160,10 @@ def main(argv=None):
             if not os.path.exists(queryfile):
                 raise Usage('Given query file {0} does not exist.'.format(queryfile))     
 
-        if not xmlfile:
-            raise Usage('No xml query file location given, -x option is not optional!')
+        if not queryfile and not xmlfile:
+            raise Usage('No query file or xml file given, either -q or -x option is required!')
+        if not queryfile and not os.path.exists(xmlfile):
+            raise Usage('Given xml file {0} does not exist.'.format(xmlfile))
     
     except Usage, err:
         print >>sys.stderr, "\nWoops, something went wrong:"
@@ -113,40 +173,173 @@ def main(argv=None):
     
     if queryfile:
         query = parse_query_file(queryfile)
-        rc = do_query(query,xmlfile,username,password)
-        if rc > 0:
-            print 'Something went wrong performing the query, exiting.'
+        try:
+            nnew = do_query(query,dbfilename,username,password,huburl)
+        except (urllib2.URLError, IOError, socket.error, SyntaxError), err:
+            print 'Something went wrong performing the query ({0}), exiting.'.format(err)
             return 1
-    dbfilename = '/nfs/a1/raw/sentinel/iceland/S1_iceland.sql'
-    downloadlist = parse_xml(xmlfile)
+        downloadlist = get_catalogue(dbfilename,query)
+        print '{0} new products, {1} products in total found by query'.format(nnew,len(downloadlist))
+        if xmlfile:
+            write_xml(downloadlist,xmlfile)
+    else:
+        downloadlist = parse_xml(xmlfile)
     if datadir:
-        get_data(datadir,downloadlist,username,password,dbfilename)
+        results = get_data(datadir,downloadlist,username,password,dbfilename,nproc)
+        if [r for r in results if r[1].startswith('failed')]:
+            return 1
 
 
-def get_data(ddir,dl,un,pw,dbfile):
-    total = len(dl)
-    dllist = []
-    for i,e in enumerate(dl):
-        filename = ddir+'/'+e['id']+'.zip'
+def get_data(ddir,dl,un,pw,dbfile,nproc=2):
+    """
+    Downloads the products in dl to ddir using nproc threads, skipping 
+    products that are already downloaded or in the database dbfile. Returns
+    a list of (id, status, bytes, elapsed time)
+    """
+    ingested = get_ingested(dbfile)
+    todo = []
+    for e in dl:
+        filename = os.path.join(ddir,e['id']+'.zip')
         if os.path.exists(filename):
             print '{0} already exists.'.format(filename)
-            continue
-        conn = sqlite3.connect(dbfile)
-        c = conn.cursor()
-        query = 'SELECT * FROM files WHERE directory LIKE \"%{0}.SAFE\"'.format(e['id'])
-        c.execute(query)
-        res = c.fetchall()
-        if res:
+        elif e['id'] in ingested:
             print '{0}.SAFE is already in the database!'.format(e['id'])
+        else:
+            todo.append(e)
+    if not todo:
+        return []
+
+    print '\nDownloading {0} of {1} products using {2} threads\n'.format(len(todo),len(dl),nproc)
+    auth = 'Basic '+base64.b64encode('{0}:{1}'.format(un,pw))
+    pool = ThreadPool(min(nproc,len(todo)))
+    try:
+        results = pool.map(lambda e: download_product(e,ddir,auth),todo,chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    print '\nProduct:                                                                 Size (MB):  Time (s):  Status:'
+    print '-'*110
+    for ident, status, nbytes, elapsed in results:
+        print '{0:73s}{1:10.1f}{2:11.1f}  {3}'.format(ident,nbytes/1024.**2,elapsed,status)
+    return results
+
+def get_ingested(dbfile):
+    """Returns the set of product ids in the files table of dbfile"""
+    if not dbfile or not os.path.exists(dbfile):
+        return set()
+    conn = sqlite3.connect(dbfile)
+    try:
+        res = conn.execute('SELECT DISTINCT directory FROM files').fetchall()
+    finally:
+        conn.close()
+    ingested = set()
+    for (d,) in res:
+        name = os.path.basename(str(d).rstrip('/'))
+        if name.endswith('.SAFE'):
+            ingested.add(name[:-5])
+    return ingested
+
+def get_checksum_url(link):
+    """
+    Returns the url of the MD5 checksum of a product, given its download link
+    .../Products('<uuid>')/$value
+    """
+    link = link.strip('"')
+    if link.endswith('/$value'):
+        link = link[:-len('/$value')]
+    return link+'/Checksum/Value/$value'
+
+def open_url(url,auth,offset=0):
+    request = urllib2.Request(url)
+    request.add_header('Authorization',auth)
+    if offset:
+        request.add_header('Range','bytes={0}-'.format(offset))
+    return urllib2.urlopen(request,timeout=TIMEOUT)
+
+def get_range_start(response):
+    """Returns the first byte in the Content-Range of response, None if absent"""
+    content_range = response.info().getheader('Content-Range')
+    try:
+        return int(content_range.split()[1].split('-')[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def download_product(e,ddir,auth,retries=3):
+    """
+    Downloads a single product to ddir/<id>.zip via ddir/<id>.zip.part. An
+    existing .part file is resumed with an HTTP range request. If the hub
+    answers that the range is not satisfiable, the .part file is taken to be
+    complete. A range that does not start at the end of the .part file
+    starts the download from scratch. The download is verified against the MD5 checksum given by the hub, if available.
+    Returns (id, status, bytes downloaded, elapsed time)
+    """
+    filename = os.path.join(ddir,e['id']+'.zip')
+    partname = filename+'.part'
+    url = e['link'].strip('"')
+    t1 = time.time()
+    nbytes = 0
+    try:
+        f = open_url(get_checksum_url(url),auth)
+        checksum = f.read().strip().lower()
+        f.close()
+    except (urllib2.URLError, IOError), err:
+        print 'No checksum available for {0} ({1}), not verifying.'.format(e['id'],err)
+        checksum = None
+
+    status = 'failed'
+    for attempt in range(retries):
+        offset = os.path.getsize(partname) if os.path.exists(partname) else 0
+        md5 = hashlib.md5()
+        try:
+            try:
+                response = open_url(url,auth,offset)
+            except urllib2.HTTPError, err:
+                # Nothing left after offset, killed before the .part file
+                # was renamed. Verified against the checksum below
+                if not offset or err.code != 416:
+                    raise
+                response = None
+            if response is not None and offset:
+                if response.getcode() != 206:
+                    # Server ignored the range request, start from scratch
+                    offset = 0
+                elif get_range_start(response) != offset:
+                    response.close()
+                    os.remove(partname)
+                    raise IOError('hub returned range starting at {0} instead of {1}'.format(
+                        get_range_start(response),offset))
+            if offset:
+                with open(partname,'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNKSIZE),''):
+                        md5.update(chunk)
+            if response is not None:
+                length = response.info().getheader('Content-Length')
+                received = 0
+                with open(partname,'ab' if offset else 'wb') as f:
+                    for chunk in iter(lambda: response.read(CHUNKSIZE),''):
+                        f.write(chunk)
+                        md5.update(chunk)
+                        received += len(chunk)
+                response.close()
+                nbytes += received
+                # A dropped connection can look like a normal end of the data
+                if length and received < int(length):
+                    raise IOError('connection closed after {0} of {1} bytes'.format(received,length))
+        except (urllib2.URLError, IOError, socket.error), err:
+            status = 'failed, {0}'.format(err)
+            print 'Download of {0} interrupted ({1}), attempt {2} of {3}'.format(e['id'],err,attempt+1,retries)
             continue
-        url = e['link'].strip('\"')
-        dlcall = ['wget','--no-check-certificate','--user',un,'--password',pw,'-O',filename,url]
-        print '\nDownloading {0} ({1} of {2})\n'.format(e['id'],i+1,total)
-        rc = subp.call(dlcall)
-        dllist.append(e['id'])
-    return dllist
-
-
+        if checksum and md5.hexdigest() != checksum:
+            status = 'failed, checksum mismatch'
+            print 'Checksum of {0} does not match, downloading again'.format(e['id'])
+            os.remove(partname)
+            continue
+        os.rename(partname,filename)
+        status = 'done' if checksum else 'done, not verified'
+        break
+    print 'Finished {0}: {1}'.format(e['id'],status)
+    return e['id'], status, nbytes, time.time()-t1
 
 def parse_xml(xmlfile):
     tree = ET.ElementTree(file=xmlfile)
@@ -192,12 +385,103 @@ def parse_query_file(queryfile):
     query = query[:-5] #Remove final +AND+
     return query
 
-def do_query(query,outputfile,un,pw):
-    url = 'https://scihub.esa.int/dhus/search?q={0}&rows=200000'.format(query)
-    qcall = ['wget','--no-check-certificate','--user',un,'--password',pw,'-O',outputfile,url]
-    returncode = subp.call(qcall)
-    return returncode
-
+def do_query(query,dbfile,un,pw,huburl=SCIHUB_URL,rows=ROWS):
+    """
+    Searches the hub for query, page by page, and stores the products found
+    in the catalogue of dbfile. Only products ingested since the last search
+    for the same query are asked for. Returns the number of new products
+    """
+    auth = 'Basic '+base64.b64encode('{0}:{1}'.format(un,pw))
+    conn = sqlite3.connect(dbfile)
+    try:
+        migrate(conn,wal=False)
+        res = conn.execute('SELECT last_ingestion FROM searches WHERE query = ?',(query,)).fetchone()
+        q = query
+        if res and res[0]:
+            print 'Searching for products ingested since {0}'.format(res[0])
+            q += '+AND+(ingestionDate:[{0}+TO+NOW])'.format(res[0])
+        start = 0
+        nnew = 0
+        while True:
+            url = '{0}/search?q={1}&start={2}&rows={3}&orderby=ingestiondate%20asc'.format(huburl,urllib.quote(q,safe=QUERY_SAFE),start,rows)
+            response = open_url(url,auth)
+            try:
+                entries = list(parse_feed(response))
+            finally:
+                response.close()
+            nnew += store_entries(conn,query,entries)
+            print 'Found {0} products ({1} new) at {2} to {3}'.format(len(entries),nnew,start,start+len(entries))
+            if len(entries) < rows:
+                break
+            start += rows
+        with conn:
+            conn.execute('UPDATE searches SET last_run = ? WHERE query = ?',(time.time(),query))
+    finally:
+        conn.close()
+    return nnew
+
+def store_entries(conn,query,entries):
+    """
+    Stores a page of search results in the catalogue, together with the last
+    ingestion date seen for query. Returns the number of new products
+    """
+    with conn:
+        nbefore = conn.execute('SELECT count(*) FROM searches_catalogue WHERE query = ?',(query,)).fetchone()[0]
+        conn.executemany('INSERT OR REPLACE INTO catalogue VALUES (?,?,?,?,?,?)',
+                         [(e['id'],e['uuid'],e['link'],e['ingestiondate'],e['beginposition'],e['size'])
+                          for e in entries])
+        conn.executemany('INSERT OR IGNORE INTO searches_catalogue VALUES (?,?)',
+                         [(query,e['id']) for e in entries])
+        nafter = conn.execute('SELECT count(*) FROM searches_catalogue WHERE query = ?',(query,)).fetchone()[0]
+        dates = [e['ingestiondate'] for e in entries if e['ingestiondate']]
+        res = conn.execute('SELECT last_ingestion FROM searches WHERE query = ?',(query,)).fetchone()
+        if res and res[0]:
+            dates.append(res[0])
+        conn.execute('INSERT OR REPLACE INTO searches VALUES (?,?,?)',
+                     (query,max(dates) if dates else None,None))
+    return nafter-nbefore
+
+def parse_feed(f):
+    """
+    Parses an Atom page of search results from file object f incrementally,
+    yielding a dictionary per product
+    """
+    for event, elem in ET.iterparse(f):
+        if elem.tag != ATOM+'entry':
+            continue
+        entry = dict.fromkeys(['id','uuid','link','ingestiondate','beginposition','size'])
+        for node in elem:
+            if node.tag == ATOM+'id':
+                entry['uuid'] = node.text
+            elif node.tag == ATOM+'link' and not 'rel' in node.attrib:
+                entry['link'] = node.attrib['href']
+            elif node.attrib.get('name') == 'identifier':
+                entry['id'] = node.text
+            elif node.attrib.get('name') in ('ingestiondate','beginposition','size'):
+                entry[node.attrib['name']] = node.text
+        elem.clear()
+        yield entry
+
+def get_catalogue(dbfile,query):
+    """Returns all products in the catalogue of dbfile found by query"""
+    conn = sqlite3.connect(dbfile)
+    try:
+        res = conn.execute('SELECT catalogue.id, link FROM catalogue '
+                           'JOIN searches_catalogue ON catalogue.id = searches_catalogue.id '
+                           'WHERE query = ? ORDER BY begin_position',(query,)).fetchall()
+    finally:
+        conn.close()
+    return [{'id': ident, 'link': link} for ident, link in res]
+
+def write_xml(entries,xmlfile):
+    """Writes products to an Atom file that can be read with parse_xml"""
+    feed = ET.Element(ATOM+'feed')
+    for e in entries:
+        entry = ET.SubElement(feed,ATOM+'entry')
+        ET.SubElement(entry,ATOM+'title').text = e['id']
+        ET.SubElement(entry,ATOM+'link',href=e['link'])
+        ET.SubElement(entry,'str',name='identifier').text = e['id']
+    ET.ElementTree(feed).write(xmlfile)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,389 @@
+"""
+
+Processes data arriving in the hopper directory as soon as it is downloaded
+
+Overview
+========
+
+Long-running alternative to S1_clear_hopper.py. The hopper directory is polled for new .zip files and .SAFE directories every few seconds, set with the -t option. Each new file is added to a work queue, which then passes it through a pipeline of stages:
+
+  unzip:       extracts a zip file straight into its track directory, and
+               moves it to the extracted directory of the hopper (see
+               S1_clear_hopper.py)
+  distribute:  moves a .SAFE directory from the hopper to its track directory
+  ingest:      inserts a .SAFE directory into the database
+  image:       sets up the SLC of the new date in each processing directory
+               of its track (only with the -p option)
+  coreg:       coregisters the new date and forms its interferogram
+
+Each stage has its own pool of worker processes, so a new acquisition can be coregistered while the next one is still being extracted. The number of workers of a stage is set with the -w option, for instance -w unzip=4. As SQLite allows a single writer only, the ingest stage always has a single worker. Coregistration may use any processed date as auxiliary image, so only one date per processing directory is coregistered at a time. Workers of the image and coregistration stages are replaced after every job, so the caches they build up (orbit state vectors, database connections) do not grow over the lifetime of the daemon.
+
+The work queue is a SQLite database, queue.sql, in the hopper directory. It holds every job with its stage, status and number of attempts, so the daemon can be stopped and restarted at any time: jobs that were running are started again. Failed jobs are retried up to three times. If the image of a date is skipped because bursts are missing, for instance when the second slice of an acquisition has not arrived yet, it is set up again when the next .SAFE directory of that date is ingested. Only polling is used, as inotify is not available from the standard library.
+
+Functions
+=========
+
+Main functions
+--------------
+
+  run_daemon:
+    Polls the hopper and runs the jobs in the queue until stopped
+  run_job:
+    Runs a single job in a worker process
+  init_worker:
+    Sets the signal handlers of a worker process
+
+Aux functions
+-------------
+
+  init_queue:
+    Creates or migrates the work queue
+  add_job:
+    Adds a job to the queue
+  claim_job:
+    Takes the next job of a stage from the queue
+  finish_job:
+    Records the result of a job and queues its follow-up jobs
+  scan_hopper:
+    Queues the new files in the hopper
+  unzip_job, distribute_job, ingest_job, image_job, coreg_job:
+    The work done by each stage
+
+Usage
+=====
+
+S1_hopper_daemon.py -i </path/to/hopper/directory> -d </path/to/data/directory> [-l <polarisation>] [-w <stage>=<no of workers>] [-t <seconds>] [-p] [-s]
+
+    -i        Hopper directory containing the downloaded zip files
+    -d        Output data directory containing the track directories
+    -l        Only extract files of the given polarisation, e.g. vv. The
+              other polarisations are only kept in the zip file, in the
+              extracted directory of the hopper
+    -w        Number of worker processes of a stage, can be given more than
+              once. Defaults are unzip=2, distribute=1, ingest=1, image=2,
+              coreg=2
+    -t        Interval in seconds at which the hopper is polled, default 10
+    -p        Set up and process the new images in the processing directories
+              of their tracks
+    -s        Stop once all jobs are finished, instead of waiting for new data
+"""
+
+import sys
+import getopt
+import os
+import time
+import json
+import signal
+import sqlite3
+from multiprocessing import Pool
+
+from RIMoDe.Sentinel.S1_db_schema import migrate
+from RIMoDe.Sentinel.S1_clear_hopper import extract_zip, archive_zip, move_safe, get_procdirs, \
+    setup_image, coreg_image, DBFILENAME, ORBITDBFILENAME
+from RIMoDe.Sentinel.S1_insert_db import db_insert
+from RIMoDe.steplog import open_log
+from RIMoDe.runner import clear_history
+
+QUEUE = 'queue.sql'
+
+STAGES = ['unzip', 'distribute', 'ingest', 'image', 'coreg']
+WORKERS = {'unzip': 2, 'distribute': 1, 'ingest': 1, 'image': 2, 'coreg': 2}
+
+# Jobs per worker process before it is replaced by a new one. Processing
+# jobs fill module caches (orbit state vectors and databases), so their
+# workers only run a single job; None keeps workers for good
+TASKS_PER_WORKER = {'unzip': None, 'distribute': None, 'ingest': None, 'image': 1, 'coreg': 1}
+
+# Number of attempts per job, and seconds between checks of running jobs
+MAXTRIES = 3
+TICK = 1
+
+QUEUE_MIGRATIONS = [
+    # Version 1: jobs of all stages. Jobs of the same stage and group are not
+    # run at the same time
+    ['CREATE TABLE IF NOT EXISTS jobs ('
+     '    id INTEGER PRIMARY KEY,'
+     '    stage TEXT,'
+     '    key TEXT,'
+     '    grp TEXT,'
+     '    args TEXT,'
+     '    status TEXT,'
+     '    tries INTEGER,'
+     '    queued REAL,'
+     '    started REAL,'
+     '    finished REAL,'
+     '    message TEXT,'
+     '    UNIQUE (stage, key))',
+     'CREATE INDEX IF NOT EXISTS jobs_stage_status ON jobs (stage, status, id)'],
+]
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv
+
+    hopperdir = []
+    datadir = []
+    pol = None
+    workers = dict(WORKERS)
+    interval = 10.
+    procflag = False
+    once = False
+
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "hi:d:l:w:t:ps", ["help"])
+        except getopt.error, msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print __doc__
+                return 0
+            elif o == '-i':
+                hopperdir = a
+            elif o == '-d':
+                datadir = a
+            elif o == '-l':
+                pol = a.lower()
+            elif o == '-w':
+                try:
+                    stage, n = a.split('=')
+                    n = int(n)
+                except ValueError:
+                    raise Usage('Workers given with -w should be <stage>=<number>, not {0}.'.format(a))
+                if stage not in STAGES:
+                    raise Usage('Unknown stage {0} given with -w, should be one of {1}.'.format(stage,', '.join(STAGES)))
+                if n < 1:
+                    raise Usage('Number of workers given with -w should be at least 1.')
+                workers[stage] = n
+            elif o == '-t':
+                try:
+                    interval = float(a)
+                except ValueError:
+                    raise Usage('Interval {0} given with -t is not a number.'.format(a))
+            elif o == '-p':
+                procflag = True
+            elif o == '-s':
+                once = True
+
+        if not hopperdir:
+            raise Usage('No hopper directory given, -i option is not optional!')
+        if not datadir:
+            raise Usage('No output data directory given, -d option is not optional!')
+        for d in (hopperdir, datadir):
+            if not os.path.isdir(d):
+                raise Usage('Given directory {0} does not exist or is not a directory.'.format(d))
+        if workers['ingest'] != 1:
+            raise Usage('The ingest stage can only have a single worker.')
+
+    except Usage, err:
+        print >>sys.stderr, "\nWoops, something went wrong:"
+        print >>sys.stderr, "  "+str(err.msg)
+        print >>sys.stderr, "\nFor help, use -h or --help.\n"
+        return 2
+
+    config = {'datadir': os.path.abspath(datadir), 'pol': pol, 'procflag': procflag,
+              'dbfile': DBFILENAME, 'orbitdbfile': ORBITDBFILENAME}
+    logfile = open_log(hopperdir,'hopper_daemon')
+    print 'Timing of all steps is logged in {0}'.format(logfile)
+    failed = run_daemon(hopperdir,config,workers,interval,once)
+    if failed:
+        return 1
+
+def init_queue(hopperdir):
+    """
+    Creates or migrates the queue in hopperdir, returns a connection to it.
+    Jobs left running by a previous run are queued again
+    """
+    conn = sqlite3.connect(os.path.join(hopperdir,QUEUE), timeout=60)
+    migrate(conn, QUEUE_MIGRATIONS, wal=False)
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'todo' WHERE status = 'running'")
+    return conn
+
+def add_job(conn,stage,key,args,grp=None):
+    """
+    Adds a job to the queue, unless it is already in it. A job that was
+    skipped before is queued again
+    """
+    conn.execute('INSERT OR IGNORE INTO jobs (stage, key, grp, args, status, tries, queued) '
+                 "VALUES (?,?,?,?,'todo',0,?)",(stage,key,grp,json.dumps(args),time.time()))
+    conn.execute("UPDATE jobs SET status = 'todo', tries = 0, args = ?, queued = ? "
+                 "WHERE stage = ? AND key = ? AND status = 'skipped'",
+                 (json.dumps(args),time.time(),stage,key))
+
+def claim_job(conn,stage,busy=()):
+    """
+    Marks the oldest queued job of stage whose group is not in busy as
+    running, and returns its id, key, group and arguments, or None
+    """
+    rows = conn.execute("SELECT id, key, grp, args FROM jobs WHERE stage = ? AND status = 'todo' "
+                        'ORDER BY id',(stage,)).fetchall()
+    for jobid, key, grp, args in rows:
+        if grp is None or grp not in busy:
+            with conn:
+                conn.execute("UPDATE jobs SET status = 'running', tries = tries+1, started = ? "
+                             'WHERE id = ?',(time.time(),jobid))
+            return jobid, key, grp, json.loads(args)
+    return None
+
+def finish_job(conn,jobid,status,message,followups):
+    """
+    Records the status of a finished job and queues its follow-up jobs in a
+    single transaction. Failed jobs are queued again until they have been
+    tried MAXTRIES times
+    """
+    with conn:
+        if status == 'failed':
+            tries = conn.execute('SELECT tries FROM jobs WHERE id = ?',(jobid,)).fetchone()[0]
+            if tries < MAXTRIES:
+                status = 'todo'
+        conn.execute('UPDATE jobs SET status = ?, message = ?, finished = ? WHERE id = ?',
+                     (status,message,time.time(),jobid))
+        for stage, key, args, grp in followups:
+            add_job(conn,stage,key,args,grp)
+    return status
+
+def scan_hopper(conn,hopperdir,config):
+    """Queues the zip files and .SAFE directories in hopperdir"""
+    with conn:
+        for f in sorted(os.listdir(hopperdir)):
+            path = os.path.join(hopperdir,f)
+            if f[-4:] == '.zip':
+                # A zip file downloaded again gets a new job
+                key = '{0}:{1}'.format(f,int(os.path.getmtime(path)))
+                add_job(conn,'unzip',key,dict(config,zipname=path))
+            elif f[-5:] == '.SAFE' and os.path.isdir(path):
+                add_job(conn,'distribute',f,dict(config,safedir=path))
+
+def count_jobs(conn):
+    return dict(conn.execute('SELECT status, count(*) FROM jobs GROUP BY status').fetchall())
+
+def run_daemon(hopperdir,config,workers,interval=10.,once=False):
+    """
+    Polls hopperdir every interval seconds and runs the queued jobs of each
+    stage on its own pool of workers, until interrupted, or until no jobs are
+    left if once is True. Returns the number of failed jobs
+    """
+    conn = init_queue(hopperdir)
+    pools = dict((stage, Pool(workers[stage],init_worker,maxtasksperchild=TASKS_PER_WORKER[stage])) 
+                 for stage in STAGES)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    running = {}
+    lastscan = 0
+    try:
+        while True:
+            if time.time()-lastscan >= interval:
+                scan_hopper(conn,hopperdir,config)
+                lastscan = time.time()
+            for jobid, (stage, key, grp, result) in running.items():
+                if result.ready():
+                    status, message, followups, elapsed = result.get()
+                    status = finish_job(conn,jobid,status,message,followups)
+                    del running[jobid]
+                    print '{0:10s} {1:60s} {2:8.1f}s  {3}'.format(stage,key,elapsed,
+                                                                 status if not message else status+', '+message)
+            for stage in STAGES:
+                busy = set(grp for s, k, grp, r in running.values() if s == stage and grp)
+                while sum(1 for s, k, g, r in running.values() if s == stage) < workers[stage]:
+                    job = claim_job(conn,stage,busy)
+                    if job is None:
+                        break
+                    jobid, key, grp, args = job
+                    running[jobid] = (stage, key, grp,
+                                      pools[stage].apply_async(run_job,(stage,args)))
+                    if grp:
+                        busy.add(grp)
+            if once and not running and not count_jobs(conn).get('todo'):
+                break
+            time.sleep(TICK)
+    except (KeyboardInterrupt, SystemExit):
+        print 'Stopping, {0} running jobs will be started again on the next run'.format(len(running))
+        for pool in pools.values():
+            pool.terminate()
+        with conn:
+            for jobid in running:
+                conn.execute("UPDATE jobs SET status = 'todo', tries = tries-1 WHERE id = ?",(jobid,))
+    else:
+        for pool in pools.values():
+            pool.close()
+            pool.join()
+    counts = count_jobs(conn)
+    conn.close()
+    print '\nJobs in queue: {0}'.format(', '.join('{0} {1}'.format(n,s) for s, n in sorted(counts.items())))
+    return counts.get('failed',0)
+
+def init_worker():
+    # Workers, including those replacing a worker after its last task, ignore
+    # SIGINT and do not inherit the SIGTERM handler of the daemon, which
+    # stops them itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def run_job(stage,args):
+    """
+    Runs a single job of stage in a worker process, catching any error.
+    Returns the status, a message, the follow-up jobs as (stage, key, args,
+    group) and the elapsed time
+    """
+    t1 = time.time()
+    try:
+        status, message, followups = STAGE_JOBS[stage](args)
+    except Exception, err:
+        status, message, followups = 'failed', '{0}: {1}'.format(type(err).__name__,str(err).split('\n')[0]), []
+    # Workers of the other stages live as long as the daemon
+    clear_history()
+    return status, message, followups, time.time()-t1
+
+def ingest_followup(args,safedir,track):
+    safeargs = dict(args,safedir=safedir,track=track)
+    return ('ingest',os.path.basename(safedir),safeargs,None)
+
+def unzip_job(args):
+    zipname, status, safedir, track, complete = extract_zip((args['zipname'],args['datadir'],args['pol']))
+    if status not in ('done', 'exists'):
+        return 'failed', status[len('failed, '):], []
+    archive_zip(zipname,complete)
+    message = 'already in {0}'.format(os.path.dirname(safedir)) if status == 'exists' else None
+    return 'done', message, [ingest_followup(args,safedir,track)]
+
+def distribute_job(args):
+    safedir, track = move_safe(args['datadir'],args['safedir'])
+    return 'done', None, [ingest_followup(args,safedir,track)]
+
+def ingest_job(args):
+    conn = sqlite3.connect(args['dbfile'])
+    try:
+        c = conn.cursor()
+        date = db_insert(args['safedir'],c,conn)
+        procdirs = get_procdirs(c,args['track']) if args['procflag'] and date else []
+    finally:
+        conn.close()
+    followups = [('image','{0}:{1}'.format(procdir,date),dict(args,procdir=procdir,date=date),None)
+                 for procdir in procdirs]
+    return 'done', None, followups
+
+def image_job(args):
+    conn = sqlite3.connect(args['dbfile'])
+    try:
+        res = setup_image(args['procdir'],args['date'],conn.cursor(),args['orbitdbfile'])
+    finally:
+        conn.close()
+    if not res:
+        return 'skipped', 'missing bursts', []
+    key = '{0}:{1}'.format(args['procdir'],args['date'])
+    return 'done', None, [('coreg',key,args,args['procdir'])]
+
+def coreg_job(args):
+    coreg_image(args['procdir'],args['date'])
+    return 'done', None, []
+
+STAGE_JOBS = {'unzip': unzip_job, 'distribute': distribute_job, 'ingest': ingest_job,
+              'image': image_job, 'coreg': coreg_job}
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,6 +7,10 @@ Overview
 
 Small script which extracts relevant information from Sentinal-1 .SAFE directories, and inserts it into the given SQLite database. The database consists of two tables (files and bursts) and a relation table. The files table contains all the measurement files and associated information like acquisition date, polarisation, swath, pass direction, etc. The bursts table contain information about each burst, mainly location information. The relation table provides information about which bursts are present in each file, and vice versa. Entries already in the database will be ignored.
 
+By default every file and burst is inserted and committed separately. With the -b option the script runs in bulk mode: the annotation files of a number of .SAFE directories are parsed first, after which all files, bursts and relations are written using executemany in a single transaction per batch. Both modes result in identical database entries.
+
+With the -j option the manifest and annotation files are parsed by a pool of worker processes, which pass plain records back to the main process. The main process is the only one holding a connection to the database, so SQLite only ever sees a single writer.
+
 Functions
 =========
 
@@ -15,6 +19,23 @@ Main functions
   db_insert:
     Handles the insertion of all measurement files contained in the given
     .SAFE directory
+  db_insert_bulk:
+    Inserts the measurement files of a list of .SAFE directories in a single
+    transaction
+  insert_records:
+    Writes records returned by read_safe to the database in a single
+    transaction
+
+Aux functions
+-------------
+  read_safe:
+    Extracts file and burst information from all measurement files in a
+    .SAFE directory
+  read_annotation:
+    Extracts file and burst information from a single annotation file, using
+    the streaming reader in S1_annotation
+  get_orbit:
+    Reads the relative orbit number from the manifest file
 
 Contributors
 ============
@@ -26,10 +47,14 @@ October 2015: Original implementation
 Usage
 =====
 
-python S1_insert_db.py -d </path/to/.SAFE/directory/> -o </path/to/database/file>
+python S1_insert_db.py -d </path/to/.SAFE/directory/> -o </path/to/database/file> [-b <no of .SAFE directories per transaction>] [-j <no of parsing processes>]
 
     -d         Defines path to .SAFE directory containing measurement files to               be inserted
     -o         Defines location and name of SQLite database file to be used
+    -b         Use bulk mode, committing the given number of .SAFE directories
+               in a single transaction
+    -j         Parse .SAFE directories using the given number of worker
+               processes
 
 """
 
@@ -38,10 +63,15 @@ import getopt
 import os
 import shutil
 import subprocess as subp
+import time
+import bisect
+from multiprocessing import Pool
 import h5py as h5
 import numpy as np
 import sqlite3
 import matplotlib.pyplot as plt
+from RIMoDe.Sentinel import S1_annotation
+from RIMoDe.Sentinel.S1_db_schema import migrate, MigrationError
 
 try:
     import xml.etree.cElementTree as ET
@@ -58,9 +88,12 @@ def main(argv=None):
     if argv == None:
         argv = sys.argv
 
+    batchsize = 0
+    nproc = 1
+
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hd:o:", ["help"])
+            opts, args = getopt.getopt(argv[1:], "hd:o:b:j:", ["help"])
         except getopt.error, msg:
             raise Usage(msg)
         for o, a in opts:
@@ -71,8 +104,26 @@ def main(argv=None):
                 datadir = a
             elif o == '-o':
                 dbfilename = a
+            elif o == '-b':
+                try:
+                    batchsize = int(a)
+                except ValueError:
+                    raise Usage('Batch size {0} given with -b is not an integer.'.format(a))
+                if batchsize < 1:
+                    raise Usage('Batch size given with -b should be at least 1.')
+            elif o == '-j':
+                try:
+                    nproc = int(a)
+                except ValueError:
+                    raise Usage('Number of processes {0} given with -j is not an integer.'.format(a))
+                if nproc < 1:
+                    raise Usage('Number of processes given with -j should be at least 1.')
         
         conn = sqlite3.connect(dbfilename)
+        try:
+            migrate(conn,wal=False)
+        except MigrationError, err:
+            raise Usage(err.msg)
         c = conn.cursor()
 
         if not os.path.exists(datadir):
@@ -88,25 +139,42 @@ def main(argv=None):
 
     dirlist = os.listdir(datadir)
     dirlist.sort()
-    for d in dirlist:
-        if os.path.isdir(os.path.join(datadir,d)) and d[-5:] == '.SAFE':
-            db_insert(os.path.join(datadir,d),c,conn)
+    safelist = [os.path.join(datadir,d) for d in dirlist 
+                if os.path.isdir(os.path.join(datadir,d)) and d[-5:] == '.SAFE']
+    if nproc > 1:
+        # Workers only parse, results come back in order of safelist
+        pool = Pool(nproc)
+        recordlist = pool.imap(read_safe,safelist)
+    else:
+        pool = None
+        recordlist = (read_safe(d) for d in safelist)
+
+    t1 = time.time()
+    if batchsize:
+        nrows = 0
+        batch = []
+        for i, records in enumerate(recordlist):
+            batch.extend(records)
+            if (i+1) % batchsize == 0 or i == len(safelist)-1:
+                nrows += insert_records(batch,c,conn)
+                batch = []
+        elapsed = time.time()-t1
+        print 'Inserted {0} rows in {1:.2f} seconds ({2:.1f} rows per second)'.format(nrows,elapsed,nrows/max(elapsed,1e-6))
+    else:
+        for d, records in zip(safelist,recordlist):
+            db_insert(d,c,conn,records)
+    if pool:
+        pool.close()
+        pool.join()
     conn.close()
 
-def db_insert(S1dir,c,conn):
-    filelist = os.listdir(os.path.join(S1dir,'measurement'))
-    orbitno = get_orbit(S1dir)
-    for f in filelist:
-        if f[-4:] != 'tiff':
-            continue
- 
-        annotfilename = os.path.join(S1dir,'annotation',f.split('.')[0]+'.xml')
-        root = ET.ElementTree(file=annotfilename)
-        polid = root.find('adsHeader').find('polarisation').text
-        swathid = root.find('adsHeader').find('swath').text
-        orbitdir = root.find('generalAnnotation').find('productInformation').find('pass').text
-        sensdate = root.find('adsHeader').find('startTime').text[:10].split('-')
-        sensdate = sensdate[0]+sensdate[1]+sensdate[2]
+def db_insert(S1dir,c,conn,records=None):
+    if records is None:
+        records = read_safe(S1dir)
+    sensdate = None
+    for rec in records:
+        f = rec['id']
+        sensdate = rec['date']
 
         # Check if file is in database already
         c.execute('SELECT * FROM files WHERE id=\"{0}\"'.format(f))
@@ -118,92 +186,47 @@ def db_insert(S1dir,c,conn):
         exe_str = 'INSERT INTO files '+\
                   '(id, directory, track, '+\
                   'orbit_direction, swath, pol, date) '+\
-                  'VALUES (\"{m}\", \"{di}\", {tr}, \"{od}\", {sw}, \"{pol}\", {date})'.format(m=f,di=S1dir,tr=orbitno,od=orbitdir,sw=swathid[-1],pol=polid, date=sensdate)
+                  'VALUES (\"{m}\", \"{di}\", {tr}, \"{od}\", {sw}, \"{pol}\", {date})'.format(m=f,di=rec['directory'],tr=rec['track'],od=rec['orbit_direction'],sw=rec['swath'],pol=rec['pol'], date=sensdate)
              
         c.execute(exe_str)
 
-        linesPerBurst = np.int(root.find('swathTiming').find('linesPerBurst').text)
-        pixelsPerBurst = np.int(root.find('swathTiming').find('samplesPerBurst').text)
-        burstlist = root.find('swathTiming').find('burstList')
-        noBurst = np.int(burstlist.attrib['count'])
-        geolocGrid = root.find('geolocationGrid')[0]
-        first = {}
-        last = {}
-
-        # Get burst corner geolocation info
-        for geoPoint in geolocGrid:
-            if geoPoint.find('pixel').text == '0':
-                first[geoPoint.find('line').text] = np.float32([geoPoint.find('latitude').text,geoPoint.find('longitude').text])
-            elif geoPoint.find('pixel').text == str(pixelsPerBurst-1):
-                last[geoPoint.find('line').text] = np.float32([geoPoint.find('latitude').text,geoPoint.find('longitude').text])
-
-        for i, b in enumerate(burstlist):
-            firstline = str(i*linesPerBurst)
-            lastline = str((i+1)*linesPerBurst)
-            aziAnxTime = np.float32(b.find('azimuthAnxTime').text)
-            burstid = np.int32(np.round(aziAnxTime*10))
-            # first and lastline sometimes shifts by 1 for some reason?
-            try:
-                firstthis = first[firstline]
-            except:
-                firstline = str(int(firstline)-1)
-                try:
-                    firstthis = first[firstline]
-                except:
-                    print 'First line not found in {0}'.format(annotfilename)
-                    firstthis = []
-            try:
-                lastthis = last[lastline]
-            except:
-                lastline = str(int(lastline)-1)
-                try:
-                    lastthis = last[lastline]
-                except:
-                    print 'Last line not found in {0}'.format(annotfilename)
-                    lastthis = []
-            corners = np.zeros([4,2],dtype=np.float32)
-
-            # Had missing info for 1 burst in a file, hence the check
-            if len(firstthis) > 0 and len(lastthis) > 0:
-                corners[0] = first[firstline]
-                corners[1] = last[firstline]
-                corners[3] = first[lastline]
-                corners[2] = last[lastline]
-                corners2 = corners[np.argsort(corners[:,1],axis=0),:]
-                centercoord = (corners2[0,:]+corners2[3,:])/2
+        for i, b in enumerate(rec['bursts']):
+            burstid = b['burstid']
+            corners = b['corners']
 
             # Check if burst is already in database, checking 10 seconds in
             # time forward and back for burstid, might be better to check 
             # less?
-            c.execute('SELECT id, burstid FROM bursts WHERE track = {tn} AND swath = {sn} AND burstid > {bl} AND burstid < {bu}'.format(tn=orbitno,sn=swathid[-1],bl=burstid-10,bu=burstid+10))
+            c.execute('SELECT id, burstid FROM bursts WHERE track = {tn} AND swath = {sn} AND burstid > {bl} AND burstid < {bu} ORDER BY rowid'.format(tn=rec['track'],sn=rec['swath'],bl=burstid-10,bu=burstid+10))
             burst_res = c.fetchall()
             if burst_res: # Already in db
                 burstdbid = burst_res[0][0] 
-                burstid = burst_res[0][1]
-            elif len(firstthis) > 0 and len(lastthis) > 0: # Missing geoloc check again. 
-                burstdbid = 'T'+str(orbitno)+'-'+str(swathid)+'-'+str(burstid)
+            elif corners: # Missing geoloc check again. 
+                burstdbid = b['id']
                 exe_str = 'INSERT INTO bursts '+\
                           '(id, track, orbit_direction, swath, burstid, '+\
                           'center_lat, center_lon, corner1_lat, corner1_lon, '+\
                           'corner2_lat, corner2_lon, corner3_lat, '+\
                           'corner3_lon, corner4_lat, corner4_lon)'+\
                           'VALUES (\"{0}\", {1}, \"{2}\", '.format(burstdbid,
-                                                                   orbitno,
-                                                                   orbitdir)+\
-                          '{0}, {1}, {2}, {3}, '.format(swathid[-1],
+                                                                   rec['track'],
+                                                                   rec['orbit_direction'])+\
+                          '{0}, {1}, {2}, {3}, '.format(rec['swath'],
                                                         burstid,
-                                                        centercoord[0],
-                                                        centercoord[1])+\
-                          '{0}, {1}, {2}, {3}, '.format(corners[0,0],
-                                                        corners[0,1],
-                                                        corners[1,0],
-                                                        corners[1,1])+\
-                          '{0}, {1}, {2}, {3})'.format(corners[2,0],
-                                                       corners[2,1],
-                                                       corners[3,0],
-                                                       corners[3,1])
+                                                        b['center'][0],
+                                                        b['center'][1])+\
+                          '{0}, {1}, {2}, {3}, '.format(corners[0][0],
+                                                        corners[0][1],
+                                                        corners[1][0],
+                                                        corners[1][1])+\
+                          '{0}, {1}, {2}, {3})'.format(corners[2][0],
+                                                       corners[2][1],
+                                                       corners[3][0],
+                                                       corners[3][1])
                 c.execute(exe_str)
-                
+            else:
+                print 'Burst {0} in {1} not in database and has no geolocation, skipping...'.format(i+1,f)
+                continue
          
             exe_str = 'INSERT INTO files_bursts '+\
                       '(file_id, burst_id, burst_no) '+\
@@ -213,6 +236,155 @@ def db_insert(S1dir,c,conn):
             conn.commit()
     
     return sensdate
+
+def db_insert_bulk(S1dirs,c,conn):
+    t1 = time.time()
+    records = []
+    for S1dir in S1dirs:
+        records.extend(read_safe(S1dir))
+    print 'Parsed {0} files from {1} .SAFE directories in {2:.2f} seconds'.format(len(records),len(S1dirs),time.time()-t1)
+    return insert_records(records,c,conn)
+
+def insert_records(records,c,conn):
+    t1 = time.time()
+
+    # Resolve all files already in the database with a single query per 500 ids
+    fileids = [rec['id'] for rec in records]
+    known_files = set()
+    for i in range(0,len(fileids),500):
+        chunk = fileids[i:i+500]
+        c.execute('SELECT id FROM files WHERE id IN ({0})'.format(','.join('?'*len(chunk))),chunk)
+        known_files.update(r[0] for r in c.fetchall())
+
+    # Load the bursts of every track/swath combination in this batch once,
+    # sorted on burstid so that nearby bursts can be found with bisect
+    known_bursts = {}
+    for key in set((int(rec['track']),int(rec['swath'])) for rec in records):
+        c.execute('SELECT burstid, rowid, id FROM bursts WHERE track = ? AND swath = ? ORDER BY burstid, rowid',key)
+        known_bursts[key] = c.fetchall()
+
+    file_rows = []
+    burst_rows = []
+    relation_rows = []
+    for rec in records:
+        f = rec['id']
+        if f in known_files:
+            print 'File {0} already in database, skipping...'.format(f)
+            continue
+        known_files.add(f)
+        file_rows.append((f, rec['directory'], int(rec['track']),
+                          rec['orbit_direction'], int(rec['swath']),
+                          rec['pol'], int(rec['date'])))
+        bursts = known_bursts[(int(rec['track']),int(rec['swath']))]
+        for i, b in enumerate(rec['bursts']):
+            burstid = b['burstid']
+            corners = b['corners']
+            # Same +-10 window as db_insert, taking the earliest inserted match
+            lo = bisect.bisect_right(bursts,(burstid-10,float('inf')))
+            hi = bisect.bisect_left(bursts,(burstid+10,))
+            if hi > lo:
+                burstdbid = min(bursts[lo:hi],key=lambda r: r[1])[2]
+            elif corners:
+                burstdbid = b['id']
+                bisect.insort(bursts,(burstid,sys.maxint+len(burst_rows),burstdbid))
+                burst_rows.append((burstdbid, int(rec['track']),
+                                   rec['orbit_direction'], int(rec['swath']),
+                                   burstid, b['center'][0], b['center'][1],
+                                   corners[0][0], corners[0][1],
+                                   corners[1][0], corners[1][1],
+                                   corners[2][0], corners[2][1],
+                                   corners[3][0], corners[3][1]))
+            else:
+                print 'Burst {0} in {1} not in database and has no geolocation, skipping...'.format(i+1,f)
+                continue
+            relation_rows.append((f, burstdbid, i+1))
+
+    c.executemany('INSERT INTO files '+
+                  '(id, directory, track, orbit_direction, swath, pol, date) '+
+                  'VALUES (?, ?, ?, ?, ?, ?, ?)',file_rows)
+    c.executemany('INSERT INTO bursts '+
+                  '(id, track, orbit_direction, swath, burstid, '+
+                  'center_lat, center_lon, corner1_lat, corner1_lon, '+
+                  'corner2_lat, corner2_lon, corner3_lat, '+
+                  'corner3_lon, corner4_lat, corner4_lon) '+
+                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',burst_rows)
+    c.executemany('INSERT INTO files_bursts '+
+                  '(file_id, burst_id, burst_no) '+
+                  'VALUES (?, ?, ?)',relation_rows)
+    conn.commit()
+    elapsed = time.time()-t1
+
+    nrows = len(file_rows)+len(burst_rows)+len(relation_rows)
+    print 'Inserted {0} rows from {1} files in {2:.2f} seconds ({3:.1f} rows per second)'.format(nrows,len(records),elapsed,nrows/max(elapsed,1e-6))
+    return nrows
+
+def read_safe(S1dir):
+    filelist = os.listdir(os.path.join(S1dir,'measurement'))
+    orbitno = get_orbit(S1dir)
+    records = []
+    for f in filelist:
+        if f[-4:] != 'tiff':
+            continue
+        annotfilename = os.path.join(S1dir,'annotation',f.split('.')[0]+'.xml')
+        rec = read_annotation(annotfilename,orbitno)
+        rec['id'] = f
+        rec['directory'] = S1dir
+        records.append(rec)
+    return records
+
+def read_annotation(annotfilename,orbitno):
+    # Coordinates are stored as the text the float32 values format to, so
+    # that parameterized and formatted inserts put identical values in the 
+    # database
+    annot = S1_annotation.read_annotation(annotfilename)
+    swathid = annot['swath']
+    sensdate = annot['start_time'][:10].split('-')
+    sensdate = sensdate[0]+sensdate[1]+sensdate[2]
+
+    linesPerBurst = annot['lines_per_burst']
+    first = dict(zip(annot['first_line'],annot['first_latlon']))
+    last = dict(zip(annot['last_line'],annot['last_latlon']))
+    burstids = np.int32(np.round(annot['azimuth_anx_time']*10))
+
+    bursts = []
+    for i, burstid in enumerate(burstids):
+        firstline = i*linesPerBurst
+        lastline = (i+1)*linesPerBurst
+        # first and lastline sometimes shifts by 1 for some reason?
+        if firstline not in first:
+            firstline -= 1
+            if firstline not in first:
+                print 'First line not found in {0}'.format(annotfilename)
+                firstline = None
+        if lastline not in last:
+            lastline -= 1
+            if lastline not in last:
+                print 'Last line not found in {0}'.format(annotfilename)
+                lastline = None
+
+        burst = {'id': 'T'+str(orbitno)+'-'+str(swathid)+'-'+str(burstid),
+                 'burstid': int(burstid),
+                 'corners': [],
+                 'center': []}
+        # Had missing info for 1 burst in a file, hence the check
+        if firstline is not None and lastline is not None:
+            corners = np.zeros([4,2],dtype=np.float32)
+            corners[0] = first[firstline]
+            corners[1] = last[firstline]
+            corners[3] = first[lastline]
+            corners[2] = last[lastline]
+            corners2 = corners[np.argsort(corners[:,1],axis=0),:]
+            centercoord = (corners2[0,:]+corners2[3,:])/2
+            burst['corners'] = [[float('{0}'.format(v)) for v in cc] for cc in corners]
+            burst['center'] = [float('{0}'.format(v)) for v in centercoord]
+        bursts.append(burst)
+
+    return {'track': orbitno,
+            'orbit_direction': annot['pass'],
+            'swath': swathid[-1],
+            'pol': annot['polarisation'],
+            'date': sensdate,
+            'bursts': bursts}
                        
 def get_orbit(datadir):
     manifestfile = os.path.join(datadir,'manifest.safe')
@@ -5,13 +5,21 @@ Insert Sentinel orbit files into database
 Overview
 ========
 
-Script that takes sentinel precise or restituted orbit files and inserts relevant information into a database. This information is then used during processing of Sentinel SLC data to correct the annotated orbits.
+Script that takes sentinel precise or restituted orbit files and inserts relevant information into a database. This information is then used during processing of Sentinel SLC data to correct the annotated orbits. The database is created or migrated to the latest orbit schema first (see S1_db_schema.py), and the validity of each file is stored as unix epochs as well, for the lookup in S1_orbit.py.
+
+With the -b option the script runs in bulk mode, for building or updating a database from a large archive of orbit files. The directory is listed once and compared with the orbit files already in the database using a single query, after which all new files are inserted using executemany in a single transaction. With the -r option orbit files in subdirectories are included as well, for archives organised by year and month.
 
 Functions
 ========
 
   db_insert:
     Inserts Sentinel EOF orbit files into the database
+  db_insert_bulk:
+    Inserts all new orbit files in a single transaction
+  list_orbit_files:
+    Lists the orbit files in a directory, optionally recursively
+  parse_orbit_name:
+    Derives the orbit type and validity from the name of an orbit file
 
 Contributors
 ============
@@ -23,22 +31,28 @@ October 2015: Original implementation
 Usage
 =====
 
-S1_insert_orbit_db.py -d </path/to/orbit/files/> -o </path/to/orbit/database/file>
+S1_insert_orbit_db.py -d </path/to/orbit/files/> -o </path/to/orbit/database/file> [-b] [-r]
 
     -d        Defines path to directory containing EOF orbit files
     -o        Defines path and name of SQLite database file to be used
+    -b        Use bulk mode, inserting all new files in a single transaction
+    -r        Include orbit files in all subdirectories of the given directory
 """
 
 import sys
 import re
 import getopt
 import os
+import time
+import calendar
 import shutil
 import subprocess as subp
 import h5py as h5
 import numpy as np
 import sqlite3
 
+from RIMoDe.Sentinel.S1_db_schema import migrate, ORBIT_MIGRATIONS
+
 import pdb
 
 class Usage(Exception):
@@ -49,9 +63,12 @@ def main(argv=None):
     if argv == None:
         argv = sys.argv
 
+    bulk = False
+    recursive = False
+
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hd:o:", ["help"])
+            opts, args = getopt.getopt(argv[1:], "hd:o:br", ["help"])
         except getopt.error, msg:
             raise Usage(msg)
         for o, a in opts:
@@ -62,8 +79,13 @@ def main(argv=None):
                 datadir = a
             elif o == '-o':
                 dbfilename = a
+            elif o == '-b':
+                bulk = True
+            elif o == '-r':
+                recursive = True
 
         conn = sqlite3.connect(dbfilename)
+        migrate(conn,ORBIT_MIGRATIONS,wal=False)
         c = conn.cursor()
 
     except Usage, err:
@@ -72,19 +94,84 @@ def main(argv=None):
         print >>sys.stderr, "\nFor help, use -h or --help.\n"
         return 2
 
-    filelist = os.listdir(datadir)
-    for f in filelist:
-        if f[-4:] == '.EOF':
-            db_insert(datadir,f,c,conn)
+    filelist = list_orbit_files(datadir,recursive)
+    if bulk:
+        t1 = time.time()
+        nrows = db_insert_bulk(filelist,c,conn)
+        elapsed = time.time()-t1
+        print 'Inserted {0} of {1} orbit files in {2:.2f} seconds'.format(nrows,len(filelist),elapsed)
+    else:
+        for d, f in filelist:
+            db_insert(d,f,c,conn)
     conn.close()
 
-def db_insert(orbitdir,orbitfile,c,conn):
+def list_orbit_files(datadir,recursive=False):
+    """
+    Returns (directory, filename) of the .EOF files in datadir, and in all
+    its subdirectories if recursive is True
+    """
+    if not recursive:
+        return [(datadir,f) for f in sorted(os.listdir(datadir)) if f[-4:] == '.EOF']
+    filelist = []
+    for d, dirs, files in os.walk(datadir):
+        dirs.sort()
+        filelist.extend((d,f) for f in sorted(files) if f[-4:] == '.EOF')
+    return filelist
+
+def parse_orbit_name(orbitfile):
+    """
+    Returns the table, validity begin and end times and their unix epochs of
+    an orbit file, from its name. Returns None if it is not a precise or
+    restituted orbit file
+    """
     if orbitfile.split('_')[3] == 'POEORB':
         table = 'porbits'
     elif orbitfile.split('_')[3] == 'RESORB':
         table = 'rorbits'
     else:
-        return;
+        return None
+
+    begin, end = re.split('[_.]',orbitfile)[-3:-1]
+    begin = begin[1:]
+    # Validity as unix epochs as well, converted once here for the lookup
+    begin_epoch = calendar.timegm(time.strptime(begin,'%Y%m%dT%H%M%S'))
+    end_epoch = calendar.timegm(time.strptime(end,'%Y%m%dT%H%M%S'))
+
+    begin = '{0}-{1}-{2}:{3}:{4}'.format(begin[:4],begin[4:6],begin[6:11],begin[11:13],begin[13:])
+    end = '{0}-{1}-{2}:{3}:{4}'.format(end[:4],end[4:6],end[6:11],end[11:13],end[13:])
+    return table, begin, end, begin_epoch, end_epoch
+
+def db_insert_bulk(filelist,c,conn):
+    """
+    Inserts the orbit files in filelist, given as (directory, filename), that
+    are not yet in the database in a single transaction. Returns the number
+    of files inserted
+    """
+    c.execute('SELECT id FROM porbits UNION ALL SELECT id FROM rorbits')
+    existing = set(r[0] for r in c.fetchall())
+    rows = {'porbits': [], 'rorbits': []}
+    for d, f in filelist:
+        if f in existing:
+            continue
+        parsed = parse_orbit_name(f)
+        if parsed is None:
+            continue
+        table, begin, end, begin_epoch, end_epoch = parsed
+        rows[table].append((f,d,begin,end,begin_epoch,end_epoch))
+        # The same file may be found in several directories
+        existing.add(f)
+    with conn:
+        for table in rows:
+            c.executemany('INSERT INTO {0} '.format(table)+
+                          '(id, directory, begintime, endtime, begin_epoch, end_epoch) '+
+                          'VALUES (?, ?, ?, ?, ?, ?)',rows[table])
+    return sum(len(r) for r in rows.values())
+
+def db_insert(orbitdir,orbitfile,c,conn):
+    parsed = parse_orbit_name(orbitfile)
+    if parsed is None:
+        return
+    table, begin, end, begin_epoch, end_epoch = parsed
 
     c.execute('SELECT * FROM {1} WHERE id=\"{0}\"'.format(orbitfile,table))
     res = c.fetchall()
@@ -95,16 +182,9 @@ def db_insert(orbitdir,orbitfile,c,conn):
     else:
         print orbitfile
 
-    begin, end = re.split('[_.]',orbitfile)[-3:-1]
-    begin = begin[1:]
-
-    begin = '{0}-{1}-{2}:{3}:{4}'.format(begin[:4],begin[4:6],begin[6:11],begin[11:13],begin[13:])
-    end = '{0}-{1}-{2}:{3}:{4}'.format(end[:4],end[4:6],end[6:11],end[11:13],end[13:])
-
-    exe_str = 'INSERT INTO {0} '.format(table)+\
-              '(id, directory, begintime, endtime) '+\
-              'VALUES (\"{0}\", \"{1}\", \"{2}\", \"{3}\");'.format(orbitfile,orbitdir,begin,end)
-    c.execute(exe_str)
+    c.execute('INSERT INTO {0} '.format(table)+
+              '(id, directory, begintime, endtime, begin_epoch, end_epoch) '+
+              'VALUES (?, ?, ?, ?, ?, ?)',(orbitfile,orbitdir,begin,end,begin_epoch,end_epoch))
     conn.commit()
     return
 
@@ -0,0 +1,259 @@
+"""
+
+Looks up Sentinel-1 orbit files, and reads and interpolates their state vectors
+
+Overview
+========
+
+Finds the orbit file to use for a given acquisition time and mission (S1A, S1B) in the orbit database (see S1_insert_orbit_db.py). Precise orbits (POEORB) are used if available, restituted orbits (RESORB) otherwise. If several files cover the same time, the most recently produced one is used, according to the production time in its name.
+
+The lookup uses the validity of each orbit file as integer unix epochs, which are indexed (see S1_db_schema.py), instead of converting the time strings of every row. As the index can only be used for the begin of the validity, only files starting at most the longest validity in the table before the acquisition time are considered. An OrbitResolver keeps its connection to the database open, and looks up any number of acquisition times in a single query. One resolver per database and process is kept by get_resolver.
+
+The state vectors of an orbit file (time, position and velocity, every 10 seconds for precise orbits) are parsed from the EOF file once, and stored as arrays in an .npz file next to it, or in a given cache directory. Later reads load the .npz file instead of parsing the XML again, as long as it is newer than the EOF file. If the cache can not be written, the state vectors are only cached in memory. Times are UTC unix epochs in seconds.
+
+An OrbitInterpolator returns the position and velocity at any number of times at once. By default it uses cubic Hermite interpolation between the two surrounding state vectors, which uses the velocities as well as the positions and is accurate to well below a millimetre for 10 second spacing. Lagrange interpolation over a window of state vectors is available as well. Times outside the state vectors give NaN.
+
+Functions
+=========
+
+Main functions
+--------------
+
+  OrbitResolver:
+    Looks up the orbit files of a batch of acquisition times
+  get_resolver:
+    Returns the resolver of an orbit database for the current process
+  read_state_vectors:
+    Returns the state vectors of an orbit file, using the .npz cache
+  OrbitInterpolator:
+    Interpolates position and velocity at arbitrary times
+  interpolate_orbit:
+    Interpolates the state vectors of an orbit file at arbitrary times
+
+Aux functions
+-------------
+
+  get_epoch:
+    Converts a date and time to a unix epoch
+  parse_eof:
+    Parses the state vectors of an EOF file
+
+"""
+
+import os
+import time
+import calendar
+import sqlite3
+import numpy as np
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+from RIMoDe.Sentinel.S1_db_schema import migrate, ORBIT_MIGRATIONS
+
+# Orbit tables in order of preference
+ORBIT_TABLES = ['porbits', 'rorbits']
+
+# Mission and production time in orbit file names, e.g.
+# S1A_OPER_AUX_POEORB_OPOD_20150101T122119_V20141210T225944_20141212T005944.EOF
+ORBIT_MISSION = 'substr({0}.id, 1, 3)'
+ORBIT_PRODUCED = 'substr({0}.id, 26, 15)'
+
+# Resolvers per (orbit database, process id)
+resolvers = {}
+
+# State vectors per orbit file, with the modification time of the file
+state_vectors = {}
+
+def get_epoch(date, time_of_day='000000'):
+    """Converts date (yyyymmdd) and time_of_day (hhmmss) in UTC to a unix epoch"""
+    return calendar.timegm(time.strptime(date+time_of_day[:6], '%Y%m%d%H%M%S'))
+
+def get_resolver(orbitdb):
+    """
+    Returns the OrbitResolver of orbitdb for this process. Connections can
+    not be shared with forked worker processes, so each gets its own
+    """
+    key = (os.path.abspath(orbitdb), os.getpid())
+    if key not in resolvers:
+        resolvers[key] = OrbitResolver(orbitdb)
+    return resolvers[key]
+
+class OrbitResolver(object):
+    """
+    Looks up orbit files in orbitdb, keeping a single connection open. The
+    database is migrated to the latest orbit schema if needed
+    """
+    def __init__(self, orbitdb):
+        self.orbitdb = orbitdb
+        self.conn = sqlite3.connect(orbitdb, timeout=60)
+        migrate(self.conn, ORBIT_MIGRATIONS, wal=False)
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (ix INTEGER PRIMARY KEY, epoch INTEGER, mission TEXT)')
+        self.maxspan = {}
+        for table in ORBIT_TABLES:
+            res = self.conn.execute('SELECT max(end_epoch-begin_epoch) FROM {0}'.format(table)).fetchone()
+            self.maxspan[table] = res[0] or 0
+
+    def resolve(self, epochs, missions=None):
+        """
+        Returns the full path of the orbit file covering each unix epoch in
+        epochs, or None if there is none. Only orbit files of the mission
+        (S1A, S1B) of each epoch are used, given as a list or as a single
+        mission for all epochs. If missions is None, any mission is used
+        """
+        epochs = [int(e) for e in epochs]
+        if not epochs:
+            return []
+        if missions is None or isinstance(missions, basestring):
+            missions = [missions]*len(epochs)
+        missions = [m.upper() if m else None for m in missions]
+        queries = []
+        for rank, table in enumerate(ORBIT_TABLES):
+            queries.append('SELECT lookup.ix, {0}, {3}, {1}.id, {1}.directory FROM lookup '
+                           'JOIN {1} ON {1}.begin_epoch BETWEEN lookup.epoch-{2} AND lookup.epoch '
+                           'AND {1}.end_epoch >= lookup.epoch '
+                           'AND (lookup.mission IS NULL OR {4} = lookup.mission)'.format(rank, table, self.maxspan[table],
+                                                                                     ORBIT_PRODUCED.format(table),
+                                                                                     ORBIT_MISSION.format(table)))
+        with self.conn:
+            self.conn.execute('DELETE FROM lookup')
+            self.conn.executemany('INSERT INTO lookup VALUES (?,?,?)',
+                                  [(ix, e, m) for ix, (e, m) in enumerate(zip(epochs, missions))])
+            rows = self.conn.execute(' UNION ALL '.join(queries)+' ORDER BY 1, 2, 3 DESC').fetchall()
+        orbitfiles = [None]*len(epochs)
+        for ix, rank, produced, orbitfile, directory in rows:
+            if orbitfiles[ix] is None:
+                orbitfiles[ix] = os.path.join(directory, orbitfile)
+        return orbitfiles
+
+    def close(self):
+        self.conn.close()
+
+def parse_utc(text):
+    """Converts an EOF time (UTC=yyyy-mm-ddThh:mm:ss.ffffff) to a unix epoch"""
+    text = text.split('=')[-1]
+    seconds, sep, fraction = text.partition('.')
+    return calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S'))+float('0.'+(fraction or '0'))
+
+def parse_eof(eoffile):
+    """
+    Parses the state vectors of eoffile incrementally. Returns a dictionary
+    with the times (unix epochs), positions (m) and velocities (m/s)
+    """
+    times = []
+    vectors = []
+    for event, elem in ET.iterparse(eoffile):
+        if elem.tag != 'OSV':
+            continue
+        times.append(parse_utc(elem.findtext('UTC')))
+        vectors.append([float(elem.findtext(k)) for k in ('X', 'Y', 'Z', 'VX', 'VY', 'VZ')])
+        elem.clear()
+    vectors = np.array(vectors, dtype=np.float64).reshape(-1, 6)
+    return {'time': np.array(times, dtype=np.float64),
+            'position': vectors[:, :3].copy(),
+            'velocity': vectors[:, 3:].copy()}
+
+def read_state_vectors(eoffile, cachedir=None):
+    """
+    Returns the state vectors of eoffile (see parse_eof), from memory or from
+    the .npz cache in cachedir (default: the directory of eoffile) if that is
+    newer than eoffile. Otherwise the EOF file is parsed and the cache written
+    """
+    path = os.path.abspath(eoffile)
+    mtime = os.path.getmtime(path)
+    cached = state_vectors.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    cachefile = os.path.join(cachedir or os.path.dirname(path), os.path.basename(path)+'.npz')
+    orbit = None
+    if os.path.exists(cachefile) and os.path.getmtime(cachefile) >= mtime:
+        try:
+            with np.load(cachefile) as npz:
+                orbit = dict((k, npz[k]) for k in ('time', 'position', 'velocity'))
+        except (IOError, KeyError, ValueError):
+            orbit = None
+    if orbit is None:
+        orbit = parse_eof(path)
+        tmpfile = '{0}.{1}.tmp.npz'.format(cachefile[:-4], os.getpid())
+        try:
+            np.savez(tmpfile, **orbit)
+            os.rename(tmpfile, cachefile)
+        except (IOError, OSError):
+            # Read-only orbit archive, keep the state vectors in memory only
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+    state_vectors[path] = (mtime, orbit)
+    return orbit
+
+class OrbitInterpolator(object):
+    """
+    Interpolates positions and velocities, given at the increasing times
+    (unix epochs) in the arrays time (n), position (n,3) and velocity (n,3).
+    Method is 'hermite' (cubic, using velocities) or 'lagrange', using
+    npoints state vectors around each time
+    """
+    def __init__(self, time, position, velocity, method='hermite', npoints=8):
+        if method not in ('hermite', 'lagrange'):
+            raise ValueError('Unknown interpolation method {0}'.format(method))
+        self.t0 = float(time[0])
+        # Relative to the first state vector, for precision
+        self.time = np.asarray(time, dtype=np.float64)-self.t0
+        self.position = np.asarray(position, dtype=np.float64)
+        self.velocity = np.asarray(velocity, dtype=np.float64)
+        self.method = method
+        self.npoints = min(npoints, len(self.time))
+        if len(self.time) < 2:
+            raise ValueError('At least two state vectors are needed for interpolation')
+
+    def __call__(self, times):
+        """
+        Returns the positions and velocities at times (any shape), as arrays
+        of shape times.shape+(3,). Times outside the state vectors give NaN
+        """
+        times = np.asarray(times, dtype=np.float64)
+        t = times.ravel()-self.t0
+        if self.method == 'hermite':
+            pos, vel = self.hermite(t)
+        else:
+            pos, vel = self.lagrange(t)
+        outside = (t < self.time[0]) | (t > self.time[-1])
+        pos[outside] = np.nan
+        vel[outside] = np.nan
+        return pos.reshape(times.shape+(3,)), vel.reshape(times.shape+(3,))
+
+    def hermite(self, t):
+        i = np.clip(np.searchsorted(self.time, t)-1, 0, len(self.time)-2)
+        h = (self.time[i+1]-self.time[i])[:, None]
+        s = ((t-self.time[i])[:, None])/h
+        p0, p1 = self.position[i], self.position[i+1]
+        m0, m1 = self.velocity[i]*h, self.velocity[i+1]*h
+        s2 = s*s
+        s3 = s2*s
+        pos = (2*s3-3*s2+1)*p0+(s3-2*s2+s)*m0+(-2*s3+3*s2)*p1+(s3-s2)*m1
+        vel = ((6*s2-6*s)*p0+(3*s2-4*s+1)*m0+(-6*s2+6*s)*p1+(3*s2-2*s)*m1)/h
+        return pos, vel
+
+    def lagrange(self, t):
+        n = self.npoints
+        start = np.clip(np.searchsorted(self.time, t)-n//2, 0, len(self.time)-n)
+        window = start[:, None]+np.arange(n)
+        tw = self.time[window]
+        pos = np.zeros((len(t), 3))
+        vel = np.zeros((len(t), 3))
+        for j in range(n):
+            w = np.ones(len(t))
+            for k in range(n):
+                if k != j:
+                    w *= (t-tw[:, k])/(tw[:, j]-tw[:, k])
+            pos += w[:, None]*self.position[window[:, j]]
+            vel += w[:, None]*self.velocity[window[:, j]]
+        return pos, vel
+
+def interpolate_orbit(eoffile, times, method='hermite', cachedir=None):
+    """
+    Returns the positions and velocities from eoffile at times (unix epochs)
+    """
+    orbit = read_state_vectors(eoffile, cachedir)
+    return OrbitInterpolator(orbit['time'], orbit['position'], orbit['velocity'], method)(times)
@@ -7,19 +7,55 @@ Overview
 
 This program cycles through all slave images in turn, coregisters them using cross correlation and spectral diversity, and forms the interferograms. The slave dates are determined either based on a list of dates specified by the user, or if omitted, by all dates present in the processing directory besides the chosen master. 
 
+Slaves are scheduled on a pool of worker processes, set with the -j option. Slaves within 60 days of the master do not need an auxiliary image and start right away. For all other slaves the auxiliary image is chosen up front, and the slave only waits for that specific date to finish. The auxiliary images form a minimum spanning tree of the distances between all dates, grown from the master and the slaves within 60 days of it, so each slave uses the closest date that connects it to the master. To bound the time a slave waits for its auxiliary images, the length of the chains of auxiliary images can be limited with the -c option. A slave then uses the closest date that is not at the end of a full chain, which may be further away; the master is never used as auxiliary image. The tree is computed once before processing starts, and its independent branches are processed in parallel, starting with the slaves that have the longest chain of slaves depending on them. Slaves are ordered by a distance combining their temporal and perpendicular baselines to the master, computed for the whole stack from the .slc.par files and cached in the processing directory (see S1_baseline.py). If the state vectors are not available, temporal baselines are used only. Each slave keeps its SLC_tab files in its own scratch directory tmp/<slavedate> in the processing directory, in which the Gamma spectral diversity programs are run as well. A report with the status of each slave is printed at the end, and failed slaves are written to failed_slave.list.
+
+Every finished step of a slave is recorded in the checkpoint manifest of the processing directory (see S1_checkpoint.py), with the size and modification time of its output files. When the program is rerun, each slave resumes from its first step that is not finished, or whose output files have changed since. Finished slaves are skipped. Use the -f option to reprocess all slaves from scratch.
+
 Functions
 =========
 
 Main functions
 --------------
 
+  process_slave:
+    Coregisters a single slave and forms its interferogram
+  schedule_slaves:
+    Processes all slaves in parallel, respecting auxiliary image dependencies
+
 
 Aux functions
 -------------
 
   get_swath_pol:
     Retrieves the swath numbers and polarisation of data in the given list
-
+  plan_auxdates:
+    Chooses the auxiliary image of each slave before processing starts
+  get_heights:
+    Returns the longest chain of slaves depending on each slave
+  get_branches:
+    Splits the slaves into independent branches of auxiliary images
+  get_tabdir:
+    Returns the scratch directory holding the SLC_tab files of a slave
+  make_slave_tabs:
+    Writes the SLC_tab files of a slave to its scratch directory
+  get_slave_steps:
+    Returns the processing steps of a slave with their output files
+  resume_slave:
+    Determines the first unfinished step of a slave from the manifest
+
+Usage
+=====
+
+S1_process_slaves.py -d </path/to/processing/directory> [-s </path/to/slave/list>] [-j <no of processes>] [-c <max chain>] [-f]
+
+    -d      Defines path to processing directory
+    -s      File containing the slave dates to process, defaults to all
+            dates in the SLC directory
+    -j      Number of slaves to process at the same time, default 1
+    -c      Maximum number of slaves in a chain of auxiliary images, 
+            default no maximum
+    -f      Reprocess all steps of the slaves, even if they are finished
+            according to the checkpoint manifest
 """
 
 
@@ -32,25 +68,21 @@ import subprocess as subp
 import h5py as h5
 import numpy as np
 import datetime as dt
-from RIMoDe.utils import grep
-from RIMoDe.Sentinel.S1_setup_images import make_SLC_tab, multi_TOPS, get_par_data
+import time
+import Queue
+from multiprocessing import Pool
+from RIMoDe.utils import read_par, makedirs
+from RIMoDe.Sentinel.S1_setup_images import make_SLC_tab, multi_TOPS
+from RIMoDe.runner import run
+from RIMoDe.steplog import open_log, step
+from RIMoDe.Sentinel.S1_checkpoint import init_manifest, get_done, record_step, clear_steps, unchanged
+from RIMoDe.Sentinel.S1_baseline import get_baselines, date_distance, distance_matrix, baseline_tree
 
 import pdb
 
 class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
-class cd:
-    """Context manager for changing the current working directory"""
-    def __init__(self, newPath):
-        self.newPath = os.path.expanduser(newPath)
-
-    def __enter__(self):
-        self.savedPath = os.getcwd()
-        os.chdir(self.newPath)
-
-    def __exit__(self, etype, value, traceback):
-        os.chdir(self.savedPath)
 
 
 
@@ -61,10 +93,13 @@ def main(argv=None):
     
     datadir = []
     slavelistname = []
+    nproc = 1
+    force = False
+    maxchain = None
         
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hd:s:", ["help"])
+            opts, args = getopt.getopt(argv[1:], "hd:s:j:fc:", ["help"])
         except getopt.error, msg:
             raise Usage(msg)
         for o, a in opts:
@@ -75,6 +110,22 @@ def main(argv=None):
                 datadir = a
             elif o == '-s':
                 slavelistname = a
+            elif o == '-f':
+                force = True
+            elif o == '-j':
+                try:
+                    nproc = int(a)
+                except ValueError:
+                    raise Usage('Number of processes {0} given with -j is not an integer.'.format(a))
+                if nproc < 1:
+                    raise Usage('Number of processes given with -j should be at least 1.')
+            elif o == '-c':
+                try:
+                    maxchain = int(a)
+                except ValueError:
+                    raise Usage('Maximum chain length {0} given with -c is not an integer.'.format(a))
+                if maxchain < 1:
+                    raise Usage('Maximum chain length given with -c should be at least 1.')
         
         if not datadir:
             raise Usage('No data directory given, -d option is not optional!')
@@ -111,39 +162,250 @@ def main(argv=None):
     masterdate = dt.datetime(int(str(masterdate)[:4]),int(str(masterdate)[4:6]),int(str(masterdate)[6:]))
 
     tempbaseline = [abs(masterdate-sd) for sd in slavelist] 
-    sortix = np.argsort(tempbaseline)
+    try:
+        table = get_baselines(datadir,masterdate.strftime('%Y%m%d'))
+    except (KeyError, ValueError, IOError), err:
+        print 'No perpendicular baselines available ({0}: {1}), using temporal baselines only'.format(type(err).__name__,err)
+        table = None
+    distance = date_distance(table)
+    sortix = np.argsort([distance(masterdate.strftime('%Y%m%d'),sd.strftime('%Y%m%d')) for sd in slavelist],kind='mergesort')
     swathlist, pol = get_swath_pol(datadir,masterdate.strftime('%Y%m%d'))
-    res = grep('range_samples',os.path.join(datadir,'SLC',masterdate.strftime('%Y%m%d'),'{md}.mli.par'.format(md=masterdate.strftime('%Y%m%d'))))
-    mliwidth = np.int32(res.split(':')[1].strip())
-
-    for i in sortix:
-        process_slave(datadir,masterdate.strftime('%Y%m%d'),slavelist[i].strftime('%Y%m%d'),tempbaseline[i],swathlist,pol,mliwidth)
-
-
-def process_slave(datadir,masterdate,slavedate,masterbaseline,swathlist,pol,mliwidth):
-    derive_lut(datadir,masterdate,slavedate,swathlist,pol)
-    calc_offset(datadir,masterdate,slavedate,'')
-    calc_offset(datadir,masterdate,slavedate,1)
+    mliwidth = np.int32(read_par(os.path.join(datadir,'SLC',masterdate.strftime('%Y%m%d'),'{md}.mli.par'.format(md=masterdate.strftime('%Y%m%d'))))['range_samples'])
+
+    slaves = [(slavelist[i].strftime('%Y%m%d'),tempbaseline[i]) for i in sortix]
+    logfile = open_log(datadir,'process_slaves')
+    if force:
+        manifest = init_manifest(datadir)
+        for sd, bl in slaves:
+            clear_steps(manifest,sd)
+    results = schedule_slaves(datadir,masterdate.strftime('%Y%m%d'),slaves,swathlist,pol,mliwidth,nproc,table,maxchain)
+
+    print '\nSlave:      Time:        Status:'
+    print '--------------------------------'
+    for slavedate, baseline in slaves:
+        status, elapsed = results[slavedate]
+        print '{0}    {1:8.1f}s    {2}'.format(slavedate,elapsed,status)
+    failed = [sd for sd, bl in slaves if results[sd][0] != 'done']
+    with open(os.path.join(datadir,'failed_slave.list'),'w') as f:
+        for sd in failed:
+            f.write('{0}\n'.format(sd))
+    print '\nTiming of all steps is logged in {0}, summarise with steplog.py -l {0}'.format(logfile)
+    if failed:
+        print '\n{0} slaves failed, these are listed in {1}'.format(len(failed),os.path.join(datadir,'failed_slave.list'))
+        return 1
+
+
+def schedule_slaves(datadir,masterdate,slaves,swathlist,pol,mliwidth,nproc,table=None,maxchain=None):
+    """
+    Processes the slaves, given as (slavedate, temporal baseline) in order of
+    baseline, using nproc processes. A slave is started as soon as its 
+    auxiliary image, if any, has been processed. Auxiliary images are chosen
+    using the baselines in table, if given (see S1_baseline.py), in chains of
+    at most maxchain slaves if given. Returns a
+    dictionary with the status and processing time of each slave
+    """
+    auxdates = plan_auxdates(datadir,masterdate,slaves,table,maxchain)
+    branches = get_branches(auxdates)
+    print '{0} slaves in {1} independent branches, longest chain of auxiliary images {2}'.format(
+        len(slaves),len(branches),max([depth for root, dates, depth in branches] or [0]))
+    # Start the slaves with the longest chain depending on them first
+    height = get_heights(auxdates)
+    waiting = sorted([sd for sd, bl in slaves],key=lambda sd: -height[sd])
+    baselines = dict(slaves)
+    results = {}
+    finished = Queue.Queue()
+    pool = Pool(nproc)
+    running = 0
+    while waiting or running:
+        for sd in list(waiting):
+            aux = auxdates[sd]
+            if aux in results and results[aux][0] != 'done':
+                results[sd] = ('failed, auxiliary image {0} failed'.format(aux), 0.)
+                waiting.remove(sd)
+            elif not aux in baselines or aux in results:
+                # No auxiliary image, an existing one, or one that is finished
+                pool.apply_async(process_slave_job,
+                                 ((datadir,masterdate,sd,baselines[sd],swathlist,pol,mliwidth,aux),),
+                                 callback=finished.put)
+                waiting.remove(sd)
+                running += 1
+        if running:
+            sd, status, elapsed = finished.get()
+            results[sd] = (status, elapsed)
+            running -= 1
+    pool.close()
+    pool.join()
+    return results
+
+def process_slave_job(args):
+    """
+    Runs process_slave for a single slave, catching any error. Returns the 
+    slave date, status and elapsed time
+    """
+    slavedate = args[2]
+    t1 = time.time()
+    try:
+        process_slave(*args)
+        status = 'done'
+    except Exception, err:
+        status = 'failed, {0}: {1}'.format(type(err).__name__,str(err).split('\n')[0])
+    return slavedate, status, time.time()-t1
+
+def plan_auxdates(datadir,masterdate,slaves,table=None,maxchain=None):
+    """
+    Chooses the auxiliary image of each slave as its parent in the minimum
+    spanning tree of the distances between the master, the slaves and the
+    dates already present in the RSLC directory. The tree is grown from the
+    master, the existing dates and the slaves within 60 days of the master,
+    which need no auxiliary image. The master itself is only used as
+    auxiliary image if there is no other date to start from. If maxchain is given, slaves at the end of a chain of
+    maxchain slaves are not used as auxiliary image either, so the closest
+    other date is used. Distances combine temporal and
+    perpendicular baselines if table is given, see S1_baseline.py. An empty
+    string means no auxiliary image is used
+    """
+    slavedates = [sd for sd, bl in slaves]
+    procdates = []
+    rslcdir = os.path.join(datadir,'RSLC')
+    if os.path.exists(rslcdir):
+        procdates = [l for l in os.listdir(rslcdir) 
+                     if len(l) == 8 and l[0] == '2' and l not in slavedates and l != masterdate]
+    dates = [masterdate]+procdates+slavedates
+    # Master and existing dates are the bases of the tree, slaves within 60
+    # days of the master are attached to it already
+    depth = [0]*(len(procdates)+1)
+    depth += [1 if baseline <= dt.timedelta(days=60) else -1 for sd, baseline in slaves]
+    parent, depth = baseline_tree(distance_matrix(dates,table),depth,maxchain,exclude=[0])
+    auxdates = {}
+    for i, sd in enumerate(slavedates):
+        p = parent[len(procdates)+1+i]
+        auxdates[sd] = dates[p] if p > 0 else ''
+    return auxdates
+
+def get_heights(auxdates):
+    """
+    Returns the length of the longest chain of slaves using each slave as
+    (indirect) auxiliary image, including the slave itself
+    """
+    height = dict((sd, 1) for sd in auxdates)
+    for sd in auxdates:
+        # Walk up to the root, raising the height of every ancestor
+        h, aux = 1, auxdates[sd]
+        while aux in auxdates and height[aux] <= h:
+            h += 1
+            height[aux] = h
+            aux = auxdates[aux]
+    return height
+
+def get_branches(auxdates):
+    """
+    Splits the slaves into branches that can be processed independently. 
+    Returns a list of (root, slave dates, depth), where root is the date of
+    the slave that starts the branch, slave dates are in processing order
+    and depth is the length of the longest chain of auxiliary images
+    """
+    children = {}
+    for sd, aux in sorted(auxdates.items()):
+        children.setdefault(aux if aux in auxdates else None,[]).append(sd)
+    branches = []
+    for root in children.get(None,[]):
+        dates, level, depth = [], [root], 0
+        while level:
+            dates += level
+            depth += 1
+            level = [c for sd in level for c in children.get(sd,[])]
+        branches.append((root,dates,depth))
+    return branches
+
+def get_tabdir(datadir,slavedate):
+    # Absolute, as spectral diversity is run from within this directory
+    tabdir = os.path.abspath(os.path.join(datadir,'tmp',slavedate))
+    makedirs(tabdir)
+    return tabdir
+
+@step
+def process_slave(datadir,masterdate,slavedate,masterbaseline,swathlist,pol,mliwidth,auxdate=None):
     if masterbaseline <= dt.timedelta(days=60):
         #No auxiliary image used if tempbaseline is less than 60 days
-        coreg_overlap(datadir,masterdate,slavedate,[],1)
-        coreg_overlap(datadir,masterdate,slavedate,[],2)
+        auxtab = []
     else:
-        auxtab = get_auxtab(datadir,slavedate,masterdate,swathlist,pol)
-        coreg_overlap(datadir,masterdate,slavedate,auxtab,1)
-        coreg_overlap(datadir,masterdate,slavedate,auxtab,2)
-    multilook_rslc(datadir,slavedate,mliwidth)
-    make_ifg(datadir,masterdate,slavedate,mliwidth)
-
+        auxtab = get_auxtab(datadir,slavedate,masterdate,swathlist,pol,auxdate)
+    make_slave_tabs(datadir,masterdate,slavedate,swathlist,pol)
+    steps = get_slave_steps(datadir,masterdate,slavedate,mliwidth,auxtab)
+    manifest = init_manifest(datadir)
+    first = resume_slave(manifest,datadir,masterdate,slavedate,steps)
+    rslcfiles = get_rslc_files(datadir,slavedate)
+    for seq in range(first,len(steps)):
+        name, func, args, outputs, offfile = steps[seq]
+        func(*args)
+        if offfile:
+            outputs = outputs+rslcfiles
+        record_step(manifest,slavedate,name,seq,outputs)
+
+def get_slave_steps(datadir,masterdate,slavedate,mliwidth,auxtab):
+    """
+    Returns the processing steps of a slave in order, as (name, function, 
+    arguments, output files, offset file). Steps with an offset file leave 
+    the resampled slave in the state given by SLC_interp with that file
+    """
+    pair = os.path.join(datadir,'RSLC','{0}_{1}'.format(masterdate,slavedate))
+    rslc = os.path.join(datadir,'RSLC',slavedate,slavedate)
+    ifg = os.path.join(datadir,'IFG','{0}_{1}'.format(masterdate,slavedate))
+    return [('derive_lut',derive_lut,(datadir,masterdate,slavedate),
+             [os.path.join(datadir,'RSLC',slavedate+'.mli.lut')],'-'),
+            ('calc_offset',calc_offset,(datadir,masterdate,slavedate,''),
+             [pair+'.off'],pair+'.off'),
+            ('calc_offset1',calc_offset,(datadir,masterdate,slavedate,1),
+             [pair+'.off1'],pair+'.off1'),
+            ('coreg_overlap1',coreg_overlap,(datadir,masterdate,slavedate,auxtab,1),
+             [pair+'.off.cor1'],pair+'.off.cor1'),
+            ('coreg_overlap2',coreg_overlap,(datadir,masterdate,slavedate,auxtab,2),
+             [pair+'.off.cor2'],pair+'.off.cor2'),
+            ('multilook_rslc',multilook_rslc,(datadir,slavedate,mliwidth),
+             [rslc+'.mli',rslc+'.mli.par'],None),
+            ('make_ifg',make_ifg,(datadir,masterdate,slavedate,mliwidth),
+             [ifg+'.sim_unw',ifg+'.diff'],None)]
+
+def get_rslc_files(datadir,slavedate):
+    rslc = os.path.join(datadir,'RSLC',slavedate,slavedate)
+    return [rslc+'.rslc',rslc+'.rslc.par']
+
+def resume_slave(manifest,datadir,masterdate,slavedate,steps):
+    """
+    Returns the number of the first step of the slave that is not finished
+    according to the checkpoint manifest, or whose output files changed since.
+    Later steps are removed from the manifest. If the resampled slave was 
+    changed by an interrupted step, it is restored by resampling with the 
+    offset file of the last finished step
+    """
+    done = get_done(manifest,slavedate)
+    first = 0
+    while first < len(steps) and steps[first][0] in done and \
+          unchanged(done[steps[first][0]],steps[first][3]):
+        first += 1
+    clear_steps(manifest,slavedate,first)
+    if first == len(steps):
+        print 'Slave {0} is already finished, skipping...'.format(slavedate)
+        return first
+    rslcsteps = [seq for seq in range(first) if steps[seq][4]]
+    if rslcsteps:
+        seq = rslcsteps[-1]
+        name, offfile = steps[seq][0], steps[seq][4]
+        rslcfiles = get_rslc_files(datadir,slavedate)
+        if not unchanged(done[name],rslcfiles):
+            print 'Restoring resampled slave {0} after {1}'.format(slavedate,name)
+            SLC_interp(datadir,masterdate,slavedate,offfile)
+            record_step(manifest,slavedate,name,seq,steps[seq][3]+rslcfiles)
+    if first > 0:
+        print 'Resuming slave {0} from {1}'.format(slavedate,steps[first][0])
+    return first
+
+@step
 def multilook_rslc(datadir,slavedate,mliwidth):
     rslcdir = os.path.join(datadir,'RSLC',slavedate)
-    rslcwidth = get_par_data(os.path.join(rslcdir,slavedate+'.rslc.par'),'range_samples')
-    exe_str = 'multi_look {rd}/{sld}.rslc {rd}/{sld}.rslc.par {rd}/{sld}.mli {rd}/{sld}.mli.par 5 1'.format(rd=rslcdir,sld=slavedate)
-    os.system(exe_str)
-    exe_str = 'raspwr {rd}/{sld}.mli {mw}'.format(rd=rslcdir,
-                                                  sld=slavedate,
-                                                  mw=mliwidth)
-    os.system(exe_str)
+    rslc = os.path.join(rslcdir,slavedate)
+    run(['multi_look',rslc+'.rslc',rslc+'.rslc.par',rslc+'.mli',rslc+'.mli.par',5,1])
+    run(['raspwr',rslc+'.mli',mliwidth])
 
 def get_slave_list(datadir,masterdate):
     slavelist = []
@@ -152,91 +414,58 @@ def get_slave_list(datadir,masterdate):
                 slavelist.append(dt.datetime(int(l[:4]),int(l[4:6]),int(l[6:])))
     return slavelist
 
-def get_auxtab(datadir,slavedate,masterdate,swathlist,pol):
-    procslavelist = []
-    slavedate_dt = dt.datetime(int(slavedate[:4]),int(slavedate[4:6]),int(slavedate[6:]))
-    masterdate_dt = dt.datetime(int(masterdate[:4]),int(masterdate[4:6]),int(masterdate[6:]))
-    for l in os.listdir(os.path.join(datadir,'RSLC')):
-        if len(l) == 8 and l != slavedate and l[0] == '2':
-            procslavelist.append(dt.datetime(int(l[:4]),int(l[4:6]),int(l[6:])))
-    
-    procbaseline = [abs(slavedate_dt-sd) for sd in procslavelist]
-    if min(procbaseline) < abs(slavedate_dt-masterdate_dt):
-        auxdate = procslavelist[np.argsort(procbaseline)[0]]
-        auxtab = os.path.join(datadir,'RSLC3_tab')
-        make_SLC_tab(os.path.join(datadir,'RSLC3_tab'),
-                     os.path.join(datadir,'RSLC',
-                                  auxdate.strftime('%Y%m%d'),
-                                  auxdate.strftime('%Y%m%d')),
+def get_auxtab(datadir,slavedate,masterdate,swathlist,pol,auxdate=None):
+    # auxdate None: pick the closest date in the RSLC directory, '': none
+    if auxdate is None:
+        todate = lambda d: dt.datetime(int(d[:4]),int(d[4:6]),int(d[6:]))
+        baseline = abs(todate(slavedate)-todate(masterdate))
+        auxdate = plan_auxdates(datadir,masterdate,[(slavedate,baseline)])[slavedate]
+    if auxdate:
+        auxtab = os.path.join(get_tabdir(datadir,slavedate),'RSLC3_tab')
+        make_SLC_tab(auxtab,
+                     os.path.join(datadir,'RSLC',auxdate,auxdate),
                      swathlist,pol)
     else:
         auxtab = []
     return auxtab
 
+@step
 def make_ifg(datadir,masterdate,slavedate,mliwidth):
     slcdir = os.path.join(datadir,'SLC')
     rslcdir = os.path.join(datadir,'RSLC')
     geodir = os.path.join(datadir,'Geo')
     ifgdir = os.path.join(datadir,'IFG')
-    if not os.path.exists(ifgdir):
-        os.mkdir(ifgdir)
-    exe_str = 'phase_sim_orb {sd}/{md}/{md}.slc.par {sd}/{sld}/{sld}.slc.par '.format(sd=slcdir,
-                                                                                      md=masterdate,
-                                                                                      sld=slavedate)
-    exe_str += '{rd}/{md}_{sld}.off {gd}/{md}.hgt {ifd}/{md}_{sld}.sim_unw '.format(rd=rslcdir,
-                                                                                   md=masterdate,
-                                                                                   sld=slavedate,
-                                                                                   gd=geodir,
-                                                                                   ifd=ifgdir)
-    exe_str += '{sd}/{md}/{md}.slc.par - - 1 1'.format(sd=slcdir,
-                                                       md=masterdate)
-    os.system(exe_str)
-    
-    exe_str = 'SLC_diff_intf {sd}/{md}/{md}.slc {rd}/{sld}/{sld}.rslc '.format(sd=slcdir,
-                                                                               md=masterdate,
-                                                                               rd=rslcdir,
-                                                                               sld=slavedate)
-    exe_str += '{sd}/{md}/{md}.slc.par {rd}/{sld}/{sld}.rslc.par '.format(sd=slcdir,
-                                                                          md=masterdate,
-                                                                          rd=rslcdir,
-                                                                          sld=slavedate)
-    exe_str += '{rd}/{md}_{sld}.off.cor2 {ifd}/{md}_{sld}.sim_unw '.format(rd=rslcdir,
-                                                                          md=masterdate,
-                                                                          sld=slavedate,
-                                                                          ifd=ifgdir)
-    exe_str += '{ifd}/{md}_{sld}.diff 5 1 0 0 0.2 1 1'.format(ifd=ifgdir,
-                                                              md=masterdate,
-                                                              sld=slavedate)
-
-    os.system(exe_str)
-    exe_str = 'rasmph_pwr {ifd}/{md}_{sld}.diff {sd}/{md}/{md}.mli {mw}'.format(ifd=ifgdir,
-                                                                                md=masterdate,
-                                                                                sld=slavedate,
-                                                                                sd=slcdir,
-                                                                                mw=mliwidth)
-    os.system(exe_str)
+    makedirs(ifgdir)
+    master = os.path.join(slcdir,masterdate,masterdate)
+    slave = os.path.join(slcdir,slavedate,slavedate)
+    rslc = os.path.join(rslcdir,slavedate,slavedate)
+    pair = '{0}_{1}'.format(masterdate,slavedate)
+    run(['phase_sim_orb',master+'.slc.par',slave+'.slc.par',
+         os.path.join(rslcdir,pair+'.off'),os.path.join(geodir,masterdate+'.hgt'),
+         os.path.join(ifgdir,pair+'.sim_unw'),master+'.slc.par','-','-',1,1])
+    run(['SLC_diff_intf',master+'.slc',rslc+'.rslc',master+'.slc.par',rslc+'.rslc.par',
+         os.path.join(rslcdir,pair+'.off.cor2'),os.path.join(ifgdir,pair+'.sim_unw'),
+         os.path.join(ifgdir,pair+'.diff'),5,1,0,0,0.2,1,1])
+    run(['rasmph_pwr',os.path.join(ifgdir,pair+'.diff'),master+'.mli',mliwidth])
                                                                           
 
+@step
 def coreg_overlap(datadir,masterdate,slavedate,auxtab,specdivno):
     slcdir = os.path.join(datadir,'SLC')
-    rslcdir = os.path.join(datadir,'RSLC')
+    rslcdir = os.path.abspath(os.path.join(datadir,'RSLC'))
     if specdivno == 1:
         cor='1'
     else:
         cor = '.cor{0}'.format(specdivno-1)
-    exe_str = 'S1_coreg_overlap {dd}/SLC1_tab {dd}/RSLC2_tab {md}_{sld} '.format(dd=datadir,
-                                                                            md=masterdate,
-                                                                       sld=slavedate)
-    exe_str += '{rd}/{md}_{sld}.off{c} {rd}/{md}_{sld}.off.cor{sn} '.format(rd=rslcdir,
-                                                                            md=masterdate,
-                                                                            sld=slavedate,
-                                                                            c=cor,
-                                                                            sn=specdivno)
-    exe_str += '0.8 0.01 0.8 1'
+    tabdir = get_tabdir(datadir,slavedate)
+    pair = os.path.join(rslcdir,'{0}_{1}'.format(masterdate,slavedate))
+    argv = ['S1_coreg_overlap',tabdir+'/SLC1_tab',tabdir+'/RSLC2_tab',
+            '{0}_{1}'.format(masterdate,slavedate),pair+'.off'+cor,
+            pair+'.off.cor{0}'.format(specdivno),0.8,0.01,0.8,1]
     if auxtab:
-        exe_str += ' '+auxtab
-    with cd(datadir):
-        os.system(exe_str)
+        argv.append(auxtab)
+    # Spectral diversity writes its intermediate files in the working directory
+    run(argv,cwd=tabdir)
     
     SLC_interp(datadir,masterdate,slavedate,'{rd}/{md}_{sld}.off.cor{sn}'.format(rd=rslcdir,
                                                                                  md=masterdate,
@@ -244,45 +473,20 @@ def coreg_overlap(datadir,masterdate,slavedate,auxtab,specdivno):
                                                                                  sn=specdivno))
             
 
+@step
 def calc_offset(datadir,masterdate,slavedate,offno):
     slcdir = os.path.join(datadir,'SLC')
     rslcdir = os.path.join(datadir,'RSLC')    
 
-    exe_str = 'create_offset {sd}/{md}/{md}.slc.par '.format(sd=slcdir,
-                                                             md=masterdate)
-    exe_str += '{sd}/{sld}/{sld}.slc.par {rd}/{md}_{sld}.off{on} 1 5 1 0'.format(sd=slcdir,
-                                                                                 sld=slavedate,
-                                                                                 rd=rslcdir,
-                                                                                 md=masterdate,
-                                                                                 on=offno)                                                                             
-    os.system(exe_str)
-
-    exe_str = 'offset_pwr {sd}/{md}/{md}.slc {rd}/{sld}/{sld}.rslc '.format(sd=slcdir,
-                                                                            md=masterdate,
-                                                                            rd=rslcdir,
-                                                                            sld=slavedate)
-    exe_str += '{sd}/{md}/{md}.slc.par {rd}/{sld}/{sld}.rslc.par '.format(sd=slcdir,
-                                                                          md=masterdate,
-                                                                          rd=rslcdir,
-                                                                          sld=slavedate)
-    exe_str += '{rd}/{md}_{sld}.off{on} {rd}/{md}_{sld}.offs '.format(rd=rslcdir,
-                                                                      md=masterdate,
-                                                                      sld=slavedate,
-                                                                      on=offno)
-    exe_str += '{rd}/{md}_{sld}.snr 256 64 - 1 64 64 7.0 4 0 0'.format(rd=rslcdir,
-                                                                       md=masterdate,
-                                                                       sld=slavedate)
-
-    os.system(exe_str)
-
-    exe_str = 'offset_fit {rd}/{md}_{sld}.offs {rd}/{md}_{sld}.snr '.format(rd=rslcdir,
-                                                                            md=masterdate,
-                                                                            sld=slavedate)
-    exe_str += '{rd}/{md}_{sld}.off{on} - - 10.0 1 0'.format(rd=rslcdir,
-                                                             md=masterdate,
-                                                             sld=slavedate,
-                                                             on=offno)
-    os.system(exe_str)
+    master = os.path.join(slcdir,masterdate,masterdate)
+    rslc = os.path.join(rslcdir,slavedate,slavedate)
+    pair = os.path.join(rslcdir,'{0}_{1}'.format(masterdate,slavedate))
+    off = '{0}.off{1}'.format(pair,offno)
+    run(['create_offset',master+'.slc.par',
+         os.path.join(slcdir,slavedate,slavedate+'.slc.par'),off,1,5,1,0])
+    run(['offset_pwr',master+'.slc',rslc+'.rslc',master+'.slc.par',rslc+'.rslc.par',
+         off,pair+'.offs',pair+'.snr',256,64,'-',1,64,64,7.0,4,0,0])
+    run(['offset_fit',pair+'.offs',pair+'.snr',off,'-','-',10.0,1,0])
     SLC_interp(datadir,masterdate,slavedate,'{rd}/{md}_{sld}.off{on}'.format(rd=rslcdir,
                                                                              md=masterdate,
                                                                              sld=slavedate,
@@ -296,54 +500,45 @@ def get_swath_pol(datadir,masterdate):
     return set(swathlist), pol
 
 
-def derive_lut(datadir,masterdate,slavedate,swathlist,pol):
+@step
+def derive_lut(datadir,masterdate,slavedate):
     slcdir = os.path.join(datadir,'SLC')
     geodir = os.path.join(datadir,'Geo')
     rslcdir = os.path.join(datadir,'RSLC')
-    if not os.path.exists(rslcdir):
-        os.mkdir(rslcdir)
-    if not os.path.exists(os.path.join(rslcdir,slavedate)):
-        os.mkdir(os.path.join(rslcdir,slavedate))
-    exe_str = 'rdc_trans {sd}/{md}/{md}.mli.par {gd}/{md}.hgt '.format(sd=slcdir,
-                                                                       md=masterdate,
-                                                                       gd=geodir)
-    exe_str += '{sd}/{sld}/{sld}.mli.par {rd}/{sld}.mli.lut'.format(sd=slcdir,
-                                                                    sld=slavedate,
-                                                                    rd=rslcdir)
-    os.system(exe_str)
-    make_SLC_tab(os.path.join(datadir,'SLC1_tab'),
+    run(['rdc_trans',os.path.join(slcdir,masterdate,masterdate+'.mli.par'),
+         os.path.join(geodir,masterdate+'.hgt'),
+         os.path.join(slcdir,slavedate,slavedate+'.mli.par'),
+         os.path.join(rslcdir,slavedate+'.mli.lut')])
+    SLC_interp(datadir,masterdate,slavedate,'-')
+
+def make_slave_tabs(datadir,masterdate,slavedate,swathlist,pol):
+    slcdir = os.path.join(datadir,'SLC')
+    rslcdir = os.path.join(datadir,'RSLC')
+    makedirs(os.path.join(rslcdir,slavedate))
+    tabdir = get_tabdir(datadir,slavedate)
+    make_SLC_tab(os.path.join(tabdir,'SLC1_tab'),
                  os.path.join(slcdir,masterdate,masterdate),
                  swathlist,pol)
-    make_SLC_tab(os.path.join(datadir,'SLC2_tab'),
+    make_SLC_tab(os.path.join(tabdir,'SLC2_tab'),
                  os.path.join(slcdir,slavedate,slavedate),
                  swathlist,pol)
-    make_SLC_tab(os.path.join(datadir,'RSLC2_tab'),
+    make_SLC_tab(os.path.join(tabdir,'RSLC2_tab'),
                  os.path.join(rslcdir,slavedate,slavedate),
                  swathlist,pol)
-    SLC_interp(datadir,masterdate,slavedate,'-')
 
+@step
 def SLC_interp(datadir,masterdate,slavedate,offfile):
     slcdir = os.path.join(datadir,'SLC')
     rslcdir = os.path.join(datadir,'RSLC')
     
-    exe_str = 'SLC_interp_lt_S1_TOPS {dd}/SLC2_tab {sd}/{sld}/{sld}.slc.par '.format(dd=datadir,
-                                                                                     sd=slcdir,
-                                                                                     sld=slavedate)
-    exe_str += '{dd}/SLC1_tab {sd}/{md}/{md}.slc.par {rd}/{sld}.mli.lut '.format(dd=datadir,
-                                                                                 sd=slcdir,
-                                                                                 md=masterdate,
-                                                                            rd=rslcdir,
-                                                                            sld=slavedate)
-    exe_str += '{sd}/{md}/{md}.mli.par {sd}/{sld}/{sld}.mli.par '.format(sd=slcdir,
-                                                                         md=masterdate,
-                                                                         sld=slavedate)
-    exe_str += '{off} {dd}/RSLC2_tab {rd}/{sld}/{sld}.rslc '.format(dd=datadir,
-                                                                    off=offfile,
-                                                                    rd=rslcdir,
-                                                                    sld=slavedate)
-    exe_str += '{rd}/{sld}/{sld}.rslc.par'.format(rd=rslcdir,
-                                                  sld=slavedate)
-    os.system(exe_str)
+    tabdir = get_tabdir(datadir,slavedate)
+    master = os.path.join(slcdir,masterdate,masterdate)
+    slave = os.path.join(slcdir,slavedate,slavedate)
+    rslc = os.path.join(rslcdir,slavedate,slavedate)
+    run(['SLC_interp_lt_S1_TOPS',tabdir+'/SLC2_tab',slave+'.slc.par',
+         tabdir+'/SLC1_tab',master+'.slc.par',os.path.join(rslcdir,slavedate+'.mli.lut'),
+         master+'.mli.par',slave+'.mli.par',offfile,tabdir+'/RSLC2_tab',
+         rslc+'.rslc',rslc+'.rslc.par'])
     
                                                                    
 
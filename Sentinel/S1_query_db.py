@@ -5,7 +5,7 @@ Search local database for available data
 Overview
 ========
 
-Allows the user to search the database for available data. The initial search is done using parameters from a .qry file. The user is then presented with a map of all available data, and is asked to pick a track. Two files are created based on the users choice. One file is called burstid.list, and contains the burstids of all bursts in the search area. The second file is called dates.list, and contains the acquisition dates of available images. These files can be adjusted to fine-tune the processing, for example by removing bursts covering only water. 
+Allows the user to search the database for available data. The initial search is done using parameters from a .qry file. The user is then presented with a map of all available data, and is asked to pick a track. Two files are created based on the users choice. One file is called burstid.list, and contains the burstids of all bursts whose footprint intersects the search area. The second file is called dates.list, and contains the acquisition dates of available images. These files can be adjusted to fine-tune the processing, for example by removing bursts covering only water. 
 
 Functions
 =========
@@ -16,12 +16,17 @@ Main functions
   do_query:
     Reads parameters from .qry file and searches database, outputting burstids and dates 
     available
+  get_coverage:
+    Retrieves which files cover each combination of burst id and date, using a
+    single query
 
 Aux functions
 -------------
 
   plot_query:
     Plots the outlines of the available data, to allow user to make a choice
+  polygons_intersect:
+    Tests whether a burst footprint intersects the search polygon
 
 Contributors
 ============
@@ -52,6 +57,7 @@ import sqlite3
 import matplotlib.pyplot as plt
 from multiprocessing import Process
 from scipy.spatial import ConvexHull
+from RIMoDe.Sentinel.S1_db_schema import RTREE_JOIN, migrate, MigrationError
 
 import pdb
 
@@ -87,6 +93,10 @@ def main(argv=None):
             raise Usage('No SQLite database file name give, -d option is not optional!')     
         if os.path.exists(dbfilename):
             conn = sqlite3.connect(dbfilename)
+            try:
+                migrate(conn,wal=False)
+            except MigrationError, err:
+                raise Usage(err.msg)
             c = conn.cursor()
         else:
             raise Usage('SQLite database {0} does not seem to exist?'.format(dbfilename))
@@ -124,7 +134,7 @@ def main(argv=None):
 def do_query(queryfile, c):
 
     query = 'SELECT bursts.id, bursts.track, bursts.swath, bursts.orbit_direction, bursts.burstid, bursts.corner1_lat, bursts.corner1_lon, bursts.corner2_lat, bursts.corner2_lon, bursts.corner3_lat, bursts.corner3_lon, bursts.corner4_lat, bursts.corner4_lon '
-    query += 'FROM bursts WHERE '
+    query += 'FROM bursts_rtree, bursts WHERE '+RTREE_JOIN+' AND '
 
     datequery = ''
     with open(queryfile) as f:
@@ -142,8 +152,9 @@ def do_query(queryfile, c):
                 poly = np.float32(ls[1].strip().split(' '))
                 lat = sorted([poly[1],poly[3]])
                 lon = sorted([poly[0],poly[2]])
-                query += 'center_lon > {0} AND center_lon < {1} AND '.format(lon[0],lon[1])
-                query += 'center_lat > {0} AND center_lat < {1} AND '.format(lat[0],lat[1])
+                # Bounding box intersection using the R*Tree, refined below
+                query += 'bursts_rtree.max_lon >= {0} AND bursts_rtree.min_lon <= {1} AND '.format(lon[0],lon[1])
+                query += 'bursts_rtree.max_lat >= {0} AND bursts_rtree.min_lat <= {1} AND '.format(lat[0],lat[1])
                 querybox = np.array( ( (lon[0], lat[0]) , (lon[1], lat[0]) ,
                                        (lon[1], lat[1]) , (lon[0], lat[1]) ,
                                        (lon[0], lat[0]) ) )
@@ -159,10 +170,14 @@ def do_query(queryfile, c):
 #        query += datequery
     
     if query[-4:] == 'AND ':
-        query = query[:-5]+';'
+        query = query[:-5]
+    # R*Tree results come in node order, the bursts of a track are grouped below
+    query += ' ORDER BY bursts.track, bursts.swath, bursts.burstid;'
         
     c.execute(query)
-    result = c.fetchall()
+    result = [r for r in c.fetchall() 
+              if polygons_intersect(querybox[:-1],np.array(((r[6],r[5]),(r[8],r[7]),
+                                                            (r[10],r[9]),(r[12],r[11]))))]
     ids = []
     tracks = []
     swaths = []
@@ -273,16 +288,95 @@ def do_query(queryfile, c):
 
     print '\n{0} images have polarisation HH, {1} images have polarisation VV, using polarisation {2}: '.format(hhcount,vvcount,polchoice)
     
-    querythis = query+'files.pol = \"{0}\" AND '.format(polchoice)
-    querythis += 'bursts.id = "{0}";'.format(id_choice[0])
-    c.execute(querythis)
-    res = c.fetchall()
-    datelist = []
-    for d in res:
-        datelist.append(d[1])
+    # Only dates for which all bursts are available
+    coverage = get_coverage(c,id_choice,pols=(polchoice,))
+    datelist = list(coverage['dates'][coverage['complete']])
+    print '{0} of {1} dates cover all {2} bursts'.format(len(datelist),len(coverage['dates']),len(id_choice))
 
     return id_choice,datelist
 
+def get_coverage(c, burstidlist, datelist=None, pols=('HH','VV')):
+    """
+    Returns a dictionary describing which file covers each burst in
+    burstidlist for every date, with:
+
+      dates:
+        Sorted integer array of all dates covering any of the bursts, or
+        datelist if given
+      burstids:
+        The burst ids, in order of burstidlist
+      complete:
+        Boolean array, True for dates covering all bursts
+      covered:
+        Boolean array of shape (no of dates, no of bursts)
+      file, directory, swath, burst_no:
+        Arrays of shape (no of dates, no of bursts) with the file covering the
+        burst, its .SAFE directory, swath and the burst number in the file.
+        Empty/zero where the burst is not covered
+    
+    If a burst is contained in more than one file on a date, the file sorting 
+    first is used.
+    """
+    burstidlist = list(burstidlist)
+    burstix = dict((b,i) for i,b in enumerate(burstidlist))
+    rows = []
+    # Stay below the SQLite limit on the number of parameters
+    for i in range(0,len(burstidlist),500):
+        chunk = burstidlist[i:i+500]
+        query = 'SELECT files.date, files_bursts.burst_id, files.id, files.directory, files.swath, files_bursts.burst_no '
+        query += 'FROM files_bursts, files '
+        query += 'WHERE files.id = files_bursts.file_id AND '
+        query += 'files.pol IN ({0}) AND '.format(','.join('?'*len(pols)))
+        query += 'files_bursts.burst_id IN ({0})'.format(','.join('?'*len(chunk)))
+        args = list(pols)+chunk
+        if datelist is not None:
+            query += ' AND files.date >= ? AND files.date <= ?'
+            args += [min(int(d) for d in datelist), max(int(d) for d in datelist)]
+        c.execute(query,args)
+        rows.extend(c.fetchall())
+
+    if datelist is None:
+        dates = np.array(sorted(set(r[0] for r in rows)),dtype=np.int32)
+    else:
+        dates = np.array([int(d) for d in datelist],dtype=np.int32)
+    dateix = dict((d,i) for i,d in enumerate(dates))
+    shape = (len(dates),len(burstidlist))
+    coverage = {'dates': dates,
+                'burstids': burstidlist,
+                'covered': np.zeros(shape,dtype=bool),
+                'file': np.zeros(shape,dtype=object),
+                'directory': np.zeros(shape,dtype=object),
+                'swath': np.zeros(shape,dtype=np.int32),
+                'burst_no': np.zeros(shape,dtype=np.int32)}
+    coverage['file'][:] = ''
+    coverage['directory'][:] = ''
+    for r in sorted(rows,key=lambda r: r[2],reverse=True):
+        if r[0] not in dateix:
+            continue
+        ix = (dateix[r[0]],burstix[r[1]])
+        coverage['covered'][ix] = True
+        coverage['file'][ix] = r[2]
+        coverage['directory'][ix] = r[3]
+        coverage['swath'][ix] = r[4]
+        coverage['burst_no'][ix] = r[5]
+    coverage['complete'] = coverage['covered'].all(axis=1)
+    return coverage
+
+def polygons_intersect(poly1, poly2):
+    """
+    Separating axis test for two convex polygons, given as (n,2) arrays of 
+    vertices in order
+    """
+    for poly in (poly1, poly2):
+        edges = np.roll(poly,-1,axis=0)-poly
+        normals = np.column_stack((-edges[:,1],edges[:,0]))
+        proj1 = np.dot(poly1,normals.T)
+        proj2 = np.dot(poly2,normals.T)
+        if np.any((proj1.max(axis=0) < proj2.min(axis=0)) | 
+                  (proj2.max(axis=0) < proj1.min(axis=0))):
+            return False
+    return True
+
 def plot_query(querybox, points, convhull,tracks, no_date):
     colours = ['r','b','g','y','m','c']
     coast = np.loadtxt('/nfs/a1/homes/eekhs/GMTplots/mapdata/is_coast.xy',delimiter=' ')
@@ -7,6 +7,8 @@ Overview
 
 This script extracts bursts contained in burstid.list into a new SLC image, ready to be processed further. It tries all dates contained in date.list, and extracts the data if all bursts are available for that date. If all bursts are not available, the date is skipped. The script performs the mli-mosaicing and the slc-mosaicing as well, and outputs a bmp preview of the mli-mosaic. To adjust the image coverage, the burstid.list file can be adjusted. This script uses the Gamma software package.
 
+With the -j option several dates are prepared at the same time. Each date uses its own scratch directory tmp/<date> in the processing directory for its SLC_tab files, which is removed once the date is finished. At the end a report is printed with the status and processing time of each date, and the dates that failed are written to failed_date.list in the processing directory.
+
 Functions
 =========
 
@@ -15,6 +17,8 @@ Main functions
 
   make_image:
     Main script handling the image creation
+  make_image_job:
+    Runs make_image for one date in a worker process, reporting its status
   par_s1_slc:
     Generates Gamma SLC parameter and image files from Sentinel SLC files
   copy_bursts:
@@ -39,8 +43,6 @@ Aux functions
     Removes SLC, SLC_par and TOPS_par files
   parse_slc_tab:
     Extract relevant information from SLC_tab
-  get_par_data:
-    Extract line containing search string from slc_par file
 
 Contributors
 ============
@@ -52,10 +54,11 @@ October 2015: Original Implementation
 Usage
 =====
 
-S1_setup_image.py -d </path/to/database/file> -o </path/to/processing/directory>
+S1_setup_image.py -d </path/to/database/file> -o </path/to/processing/directory> [-j <no of processes>]
 
     -d         Defines path and name of local database file
     -o         Defines path to output processing directory
+    -j         Number of dates to prepare at the same time, default 1
 """
 
 
@@ -69,8 +72,14 @@ import h5py as h5
 import numpy as np
 import sqlite3
 import matplotlib.pyplot as plt
-from multiprocessing import Process
+import time
+from multiprocessing import Process, Pool
 from scipy.spatial import ConvexHull
+from RIMoDe.Sentinel.S1_query_db import get_coverage
+from RIMoDe.Sentinel.S1_orbit import get_resolver, get_epoch
+from RIMoDe.utils import read_par, makedirs
+from RIMoDe.runner import run, run_parallel
+from RIMoDe.steplog import open_log, step
 
 import pdb
 
@@ -84,12 +93,13 @@ def main(argv=None):
 
     dbfilename = []
     outputdir = []
+    nproc = 1
     # BEWARE: Orbit database file hardcoded for now!!!!!!
     orbitdb = '/nfs/a1/raw/sentinel/iceland/S1_orbits.sql'
 
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hd:o:", ["help"])
+            opts, args = getopt.getopt(argv[1:], "hd:o:j:", ["help"])
         except getopt.error, msg:
             raise Usage(msg)
         for o, a in opts:
@@ -100,6 +110,13 @@ def main(argv=None):
                 dbfilename = a
             elif o == '-o':
                 outputdir = a
+            elif o == '-j':
+                try:
+                    nproc = int(a)
+                except ValueError:
+                    raise Usage('Number of processes {0} given with -j is not an integer.'.format(a))
+                if nproc < 1:
+                    raise Usage('Number of processes given with -j should be at least 1.')
         
         if not dbfilename:
             raise Usage('No SQLite database file name give, -d option is not optional!')     
@@ -128,54 +145,69 @@ def main(argv=None):
         for l in f.read().strip().split('\n'):
             datelist.append(l)
 
-    for date in datelist:
-        make_image(outputdir, burstidlist,date,c, orbitdb)
+    logfile = open_log(outputdir,'setup_images')
+
+    # Coverage of all bursts for all dates, retrieved in a single query
+    coverage = get_coverage(c,burstidlist,datelist)
+    conn.close()
+    jobs = [(outputdir,burstidlist,date,dbfilename,orbitdb,coverage) for date in datelist]
+    if nproc > 1:
+        pool = Pool(nproc)
+        results = pool.map(make_image_job,jobs,chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = [make_image_job(j) for j in jobs]
+
+    print '\nDate:       Time:        Status:'
+    print '--------------------------------'
+    for date, status, elapsed in results:
+        print '{0}    {1:8.1f}s    {2}'.format(date,elapsed,status)
+    failed = [date for date, status, elapsed in results if status.startswith('failed')]
+    with open(os.path.join(outputdir,'failed_date.list'),'w') as f:
+        for date in failed:
+            f.write('{0}\n'.format(date))
+    print '\nTiming of all steps is logged in {0}, summarise with steplog.py -l {0}'.format(logfile)
+    if failed:
+        print '\n{0} dates failed, these are listed in {1}'.format(len(failed),os.path.join(outputdir,'failed_date.list'))
+        return 1
     
 
 
-def make_image(destdir, burstidlist, date, c, orbitdb):
+@step
+def make_image(destdir, burstidlist, date, c, orbitdb, coverage=None):
+    if coverage is None:
+        coverage = get_coverage(c,burstidlist,[date])
+    dateix = np.flatnonzero(coverage['dates'] == int(date))
+    if len(dateix) == 0 or not coverage['complete'][dateix[0]]:
+        print 'Missing bursts from date {0}? Skipping...'.format(date)
+        return False
+    dateix = dateix[0]
+
     slcdir = os.path.join(destdir,"SLC")
     datedir = os.path.join(slcdir,date)
-    if not os.path.exists(slcdir):
-        os.mkdir(slcdir)
-    if not os.path.exists(datedir):
-        os.mkdir(datedir)
-
-    
-    query = 'SELECT files.id, files.directory, files.swath, files_bursts.burst_no '
-    query += 'FROM files, files_bursts, bursts '
-    query += 'WHERE bursts.id = files_bursts.burst_id AND '
-    query += 'files.id = files_bursts.file_id AND '
-    query += '(files.pol = "HH" OR files.pol = "VV") AND '
-    query += 'files.date = {0} AND '.format(date)
-
-    filelist = []
-    dirlist = []
-    swathlist = []
-    burstnolist = []
-    
-    for bi in burstidlist:
-        querythis = query+'bursts.id = \"{0}\";'.format(bi)
-        c.execute(querythis)
-        res = c.fetchall()
-        if res:
-            filelist.append(res[0][0])
-            dirlist.append(res[0][1])
-            swathlist.append(res[0][2])
-            burstnolist.append(res[0][3])
-        else:
-            os.rmdir(datedir)
-            print 'Missing bursts from date {0}? Skipping...'.format(date)
-            return
+    # Scratch directory for the SLC_tab files of this date only, so that 
+    # several dates can be prepared at the same time
+    tabdir = os.path.join(destdir,'tmp',date)
+    for d in (datedir, tabdir):
+        makedirs(d)
+
+    # Group burst numbers per swath and file
+    swathfiles = {}
+    for f, d, swath, bn in zip(coverage['file'][dateix],coverage['directory'][dateix],
+                               coverage['swath'][dateix],coverage['burst_no'][dateix]):
+        swathfiles.setdefault(swath,{}).setdefault(f,(d,[]))[1].append(bn)
+    swathlist = sorted(swathfiles)
 
     for swath in range(1,4):
-        if swath in swathlist:
-            filesthis = [ f for f, s  in zip(filelist,swathlist) if s == swath ]
-            for i, f in enumerate(sorted(set(filesthis))): # Sort important to ensure slices are processed in order of acquisition!
-                burstnothis = np.array([ bn for bn, sl, fl  in zip(burstnolist,swathlist, filelist) if sl == swath and fl == f])
-                dirthis = [ d for d, sl, fl  in zip(dirlist,swathlist, filelist) if sl == swath and fl == f ][0]
+        if swath in swathfiles:
+            for i, f in enumerate(sorted(swathfiles[swath])): # Sort important to ensure slices are processed in order of acquisition!
+                dirthis, burstnothis = swathfiles[swath][f]
+                burstnothis = np.array(burstnothis)
                 tiffthis = os.path.join(dirthis,'measurement',f)
                 timethis = tiffthis.split('t')[-2].split('-')[0]
+                # Measurement files start with the mission, e.g. s1a-iw1-slc-...
+                mission = f[:3].upper()
                 annotfile = '{0}xml'.format(f[:-4])
                 annotthis = os.path.join(dirthis,'annotation',annotfile)
                 calibfile = 'calibration-{0}'.format(annotfile)
@@ -185,106 +217,97 @@ def make_image(destdir, burstidlist, date, c, orbitdb):
                 slcthis = os.path.join(slcdir,date,'{0}_{1}'.format(date,i))
 
                 pol = par_s1_slc(tiffthis,annotthis,calibthis,noisethis,slcthis)
-                tabname = os.path.join(destdir,'SLC{0}_tab'.format(i))
+                tabname = os.path.join(tabdir,'SLC{0}_tab'.format(i))
                 filename = os.path.join(slcdir,date,'{0}_tmp'.format(date))
                 make_SLC_tab(tabname,slcthis,[swath],pol)
-                make_SLC_tab(os.path.join(destdir,'SLCtmp_tab'),filename,[swath],pol)
-                copy_bursts(tabname,os.path.join(destdir,'SLCtmp_tab'),burstnothis.min(),burstnothis.max())
+                make_SLC_tab(os.path.join(tabdir,'SLCtmp_tab'),filename,[swath],pol)
+                copy_bursts(tabname,os.path.join(tabdir,'SLCtmp_tab'),burstnothis.min(),burstnothis.max())
             if i == 0:
-                tabname = os.path.join(destdir,'SLC_tab')
+                tabname = os.path.join(tabdir,'SLC_tab')
                 filename = os.path.join(slcdir,date,'{0}'.format(date))
                 make_SLC_tab(tabname,filename,[swath],pol)
-                rename_slc(os.path.join(destdir,'SLC0_tab'),
-                               os.path.join(destdir,'SLC_tab'))
+                rename_slc(os.path.join(tabdir,'SLC0_tab'),
+                               os.path.join(tabdir,'SLC_tab'))
             else:
-                tabname = os.path.join(destdir,'SLCtmp_tab')
+                tabname = os.path.join(tabdir,'SLCtmp_tab')
                 filename = os.path.join(slcdir,date,'{0}_tmp'.format(date))
                 make_SLC_tab(tabname,filename,[swath],pol)
-                tabname = os.path.join(destdir,'SLC_tab')
+                tabname = os.path.join(tabdir,'SLC_tab')
                 filename = os.path.join(slcdir,date,'{0}'.format(date))
                 make_SLC_tab(tabname,filename,[swath],pol)
                 for ix in range(i):
-                    slc_cat(os.path.join(destdir,'SLC{0}_tab'.format(ix)),
-                            os.path.join(destdir,'SLC{0}_tab'.format(ix+1)),
-                            os.path.join(destdir,'SLC{0}_tab'.format('tmp')))
-                    remove_slc(os.path.join(destdir,'SLC{0}_tab'.format(ix)))
-                    remove_slc(os.path.join(destdir,'SLC{0}_tab'.format(ix+1)))
+                    slc_cat(os.path.join(tabdir,'SLC{0}_tab'.format(ix)),
+                            os.path.join(tabdir,'SLC{0}_tab'.format(ix+1)),
+                            os.path.join(tabdir,'SLC{0}_tab'.format('tmp')))
+                    remove_slc(os.path.join(tabdir,'SLC{0}_tab'.format(ix)))
+                    remove_slc(os.path.join(tabdir,'SLC{0}_tab'.format(ix+1)))
                     if ix < i-1:
-                        rename_slc(os.path.join(destdir,'SLC{0}_tab'.format('tmp')),
-                                   os.path.join(destdir,'SLC{0}_tab'.format(ix+1)))
+                        rename_slc(os.path.join(tabdir,'SLC{0}_tab'.format('tmp')),
+                                   os.path.join(tabdir,'SLC{0}_tab'.format(ix+1)))
                     else:
-                        try:
-                            rename_slc(os.path.join(destdir,'SLCtmp_tab'),
-                                       os.path.join(destdir,'SLC_tab'))
-                        except:
-                            pdb.set_trace()
+                        rename_slc(os.path.join(tabdir,'SLCtmp_tab'),
+                                   os.path.join(tabdir,'SLC_tab'))
                     
                             
                 
                 
-    make_SLC_tab(tabname,filename,sorted(set(swathlist)),pol)
+    make_SLC_tab(tabname,filename,swathlist,pol)
     multi_TOPS(tabname,filename,5,1)
     mosaic_TOPS(tabname,filename,5,1)
-    apply_precise_orbit(filename,orbitdb,date,timethis)
+    apply_precise_orbit(filename,orbitdb,date,timethis,mission)
+    shutil.rmtree(tabdir)
+    return True
+
+def make_image_job(args):
+    """
+    Runs make_image for a single date with its own database connection, 
+    catching any error. Returns the date, status and elapsed time
+    """
+    destdir, burstidlist, date, dbfilename, orbitdb, coverage = args
+    t1 = time.time()
+    try:
+        conn = sqlite3.connect(dbfilename)
+        try:
+            res = make_image(destdir,burstidlist,date,conn.cursor(),orbitdb,coverage)
+        finally:
+            conn.close()
+        status = 'done' if res else 'skipped, missing bursts'
+    except Exception, err:
+        status = 'failed, {0}: {1}'.format(type(err).__name__,str(err).split('\n')[0])
+    return date, status, time.time()-t1
 
         
 
-def apply_precise_orbit(filename,orbitdb,date,time):
-    conn = sqlite3.connect(orbitdb)
-    c = conn.cursor()
-    datetime = '{0}-{1}-{2}T{3}:{4}:{5}'.format(date[:4],date[4:6],date[6:],time[:2],time[2:4],time[4:])
-
-    exe_str = 'SELECT id, directory FROM porbits '+\
-              'WHERE strftime(\'%s\',\"{0}\") BETWEEN strftime(\'%s\',begintime) AND strftime(\'%s\', endtime);'.format(datetime)
-
-    c.execute(exe_str)
-    res = c.fetchall()
-    if res:
-        orbitfile = os.path.join(res[0][1],res[0][0])
-    else:
-        exe_str = 'SELECT id, directory FROM rorbits '+\
-              'WHERE strftime(\'%s\',\"{0}\") BETWEEN strftime(\'%s\',begintime) AND strftime(\'%s\', endtime);'.format(datetime)
-        c.execute(exe_str)
-        res = c.fetchall()
-        if res:
-            orbitfile = os.path.join(res[0][1],res[0][0])
-        else:
-            print 'No orbit file found for time {0}'.format(datetime)
-            pdb.set_trace()
-            return
+@step
+def apply_precise_orbit(filename,orbitdb,date,time,mission=None):
+    orbitfile = get_resolver(orbitdb).resolve([get_epoch(date,time)],mission)[0]
+    if not orbitfile:
+        print 'No {6} orbit file found for time {0}-{1}-{2}T{3}:{4}:{5}'.format(date[:4],date[4:6],date[6:],
+                                                                             time[:2],time[2:4],time[4:6],
+                                                                             mission or 'S1')
+        return
     
-    comm = 'S1_OPOD_vec {0}.mli.par {1}'.format(filename,orbitfile)
-    os.system(comm)
-    comm = 'S1_OPOD_vec {0}.slc.par {1}'.format(filename,orbitfile)
-    os.system(comm)
+    run_parallel([['S1_OPOD_vec',filename+'.mli.par',orbitfile],
+                  ['S1_OPOD_vec',filename+'.slc.par',orbitfile]])
  
+@step
 def copy_bursts(SLCtab,SLCnewtab,minburst,maxburst):
-    comm = 'SLC_copy_S1_TOPS {0} {1} 1 {2} 1 {3}'.format(SLCtab,SLCnewtab,minburst,maxburst)
-    os.system(comm)
+    run(['SLC_copy_S1_TOPS',SLCtab,SLCnewtab,1,minburst,1,maxburst])
     rename_slc(SLCnewtab,SLCtab)
 
+@step
 def mosaic_TOPS(tab,slcname,azml,rgml):
-    comm = 'SLC_mosaic_S1_TOPS {0} {1}.slc {1}.slc.par {2} {3}'.format(tab,slcname,azml,rgml)
-    os.system(comm)
+    run(['SLC_mosaic_S1_TOPS',tab,slcname+'.slc',slcname+'.slc.par',azml,rgml])
 
+@step
 def multi_TOPS(tab,mliname,azml,rgml):
-    comm = 'multi_S1_TOPS {0} {1}.mli {1}.mli.par {2} {3}'.format(tab,mliname,azml,rgml)
-    os.system(comm)
-    mli_width = get_par_data(mliname+'.mli.par','range_samples')
-    comm = 'raspwr {0}.mli {1}'.format(mliname,mli_width)
-    os.system(comm)
-
-def get_par_data(parfile,searchstring):
-    with open(parfile) as f:
-        for l in f:
-            ll = l.strip().split(':')
-            if len(ll) > 1:
-                if searchstring in ll[0]:
-                    return ll[1].strip()
+    run(['multi_S1_TOPS',tab,mliname+'.mli',mliname+'.mli.par',azml,rgml])
+    mli_width = read_par(mliname+'.mli.par')['range_samples']
+    run(['raspwr',mliname+'.mli',mli_width])
 
+@step
 def slc_cat(tab1,tab2,tab3):
-    comm = 'SLC_cat_S1_TOPS {0} {1} {2}'.format(tab1,tab2,tab3)
-    os.system(comm)
+    run(['SLC_cat_S1_TOPS',tab1,tab2,tab3])
 
 def make_SLC_tab(tabname,filename,swath,pol):
     with open(tabname,'w') as f:
@@ -310,11 +333,13 @@ def parse_slc_tab(slctab):
         slc, slc_par, tops_par = f.read().strip().split(' ')
     return slc, slc_par, tops_par
 
+@step
 def par_s1_slc(geotiff,annotation,calibration,noise,slc):
     swath = geotiff[-65:-62]
     pol = geotiff[-57:-55]
-    comm = 'par_S1_SLC {0} {1} {2} {3} {4}.{5}.{6}.slc.par {4}.{5}.{6}.slc {4}.{5}.{6}.TOPS_par'.format(geotiff,annotation,calibration,noise,slc,swath,pol)
-    os.system(comm)
+    name = '{0}.{1}.{2}'.format(slc,swath,pol)
+    run(['par_S1_SLC',geotiff,annotation,calibration,noise,
+         name+'.slc.par',name+'.slc',name+'.TOPS_par'])
     return pol
 
 if __name__ == "__main__":
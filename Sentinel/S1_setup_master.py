@@ -5,7 +5,7 @@ Performs the geocoding of the master
 Overview
 ========
 
-This script performs the geocoding of the master using an external DEM. Uses the Gamma software package
+This script performs the geocoding of the master using an external DEM. Uses the Gamma software package, run through runner.py. Steps that do not depend on each other (geocoding of the look angles, coordinates and heights) are run concurrently. The longitude and latitude grids of the DEM are written block by block, so memory use does not depend on the extent of the DEM (see -b).
 
 Functions
 =========
@@ -28,6 +28,12 @@ Main functions
   get_look_vector:
     Calculates the angles of the look vector
 
+Aux functions
+-------------
+
+  write_latlon_grids:
+    Writes longitude and latitude rasters of the DEM grid block by block
+
 Contributors
 ============
 
@@ -38,11 +44,13 @@ October 2015: Original implementation
 Usage
 =====
 
-S1_setup_master.py -d </path/to/processing/directory> -m <masterdate> -e </path/to/dem>
+S1_setup_master.py -d </path/to/processing/directory> -m <masterdate> -e </path/to/dem> [-b <block size in MB>]
 
     -d      Defines path to processing directory
     -m      The masterdate chosen by the user, in the format <YYYYMMDD>
     -e      Path and filename of external DEM
+    -b      Memory in MB used per block when writing the longitude and 
+            latitude grids of the DEM, default 64
 """
   
 
@@ -54,7 +62,9 @@ import shutil
 import subprocess as subp
 import h5py as h5
 import numpy as np
-from RIMoDe.utils import grep
+from RIMoDe.utils import read_par
+from RIMoDe.runner import run, run_parallel
+from RIMoDe.steplog import open_log, step
 
 import pdb
 
@@ -69,10 +79,11 @@ def main(argv=None):
     datadir = []
     masterdate = []
     demname = []
+    blocksize = 64
         
     try:
         try:
-            opts, args = getopt.getopt(argv[1:], "hd:m:e:", ["help"])
+            opts, args = getopt.getopt(argv[1:], "hd:m:e:b:", ["help"])
         except getopt.error, msg:
             raise Usage(msg)
         for o, a in opts:
@@ -85,6 +96,11 @@ def main(argv=None):
                 masterdate = a
             elif o == '-e':
                 demname = a
+            elif o == '-b':
+                try:
+                    blocksize = float(a)
+                except ValueError:
+                    raise Usage('Block size {0} given with -b is not a number.'.format(a))
         
         if not datadir:
             raise Usage('No data directory given, -d option is not optional!')
@@ -111,64 +127,48 @@ def main(argv=None):
         for l in slavelist:
             f.write('{0}\n'.format(l))
     
+    logfile = open_log(datadir,'setup_master')
     calc_dem_lut(datadir,masterdate,demname)
     calc_terrain_norm(datadir,masterdate)
     get_offset(datadir,masterdate)
     dem_width = calc_fine_dem_lut(datadir,masterdate)
     geocode_dem(datadir,masterdate,dem_width)
-    mliwidth, mlilength = geocode_mli(datadir,masterdate,dem_width)
+    mliwidth, mlilength = geocode_mli(datadir,masterdate,dem_width,blocksize)
     get_look_vector(datadir,masterdate,dem_width,mliwidth,mlilength)
+    print 'Timing of all steps is logged in {0}, summarise with steplog.py -l {0}'.format(logfile)
 
+@step
 def get_look_vector(datadir,masterdate,dem_width,mliwidth,mlilength):
     geodir = os.path.join(datadir,'Geo') 
     slcdir = os.path.join(datadir,'SLC')
 
-    exe_str = 'look_vector {sd}/{md}/{md}.mli.par - {gd}/{md}.dem.par '.format(sd=slcdir,
-                                                                          md=masterdate,
-                                                                          gd=geodir)
-    exe_str += '{gd}/{md}.dem {gd}/theta {gd}/phi'.format(gd=geodir,
-                                                          md=masterdate)
-    os.system(exe_str)
-    
-    exe_str = 'geocode {gd}/{md}.lut_fine {gd}/theta {dw} '.format(gd=geodir,
-                                                                   md=masterdate,
-                                                                   dw=dem_width)
-    exe_str += '{gd}/theta_ifg {mw} {ml}'.format(gd=geodir,
-                                                 mw=mliwidth,
-                                                 ml=mlilength)
-    os.system(exe_str)
-
-    exe_str = 'geocode {gd}/{md}.lut_fine {gd}/phi {dw} '.format(gd=geodir,
-                                                                 md=masterdate,
-                                                                 dw=dem_width)
-    exe_str += '{gd}/phi_ifg {mw} {ml}'.format(gd=geodir,
-                                               mw=mliwidth,
-                                               ml=mlilength)
-    os.system(exe_str)
+    md = os.path.join(geodir,masterdate)
+    run(['look_vector',os.path.join(slcdir,masterdate,masterdate+'.mli.par'),'-',
+         md+'.dem.par',md+'.dem',geodir+'/theta',geodir+'/phi'])
+
+    # Theta and phi are geocoded independently
+    run_parallel([['geocode',md+'.lut_fine',geodir+'/'+angle,dem_width,
+                   geodir+'/'+angle+'_ifg',mliwidth,mlilength]
+                  for angle in ('theta','phi')])
 
     
                                                                   
     
 
-def geocode_mli(datadir,masterdate,dem_width):
+@step
+def geocode_mli(datadir,masterdate,dem_width,blocksize=64):
     geodir = os.path.join(datadir,'Geo')
     dempar = os.path.join(geodir,masterdate+'.dem.par')
-    res = grep('corner_lat',dempar)
-    demlat = np.float32(res.split(':')[1].strip().split(' ')[0])
-    res = grep('corner_lon',dempar)
-    demlon = np.float32(res.split(':')[1].strip().split(' ')[0])
-    res = grep('post_lat',dempar) 
-    latstep = np.float32(res.split(':')[1].strip().split(' ')[0])
-    res = grep('post_lon',dempar) 
-    lonstep = np.float32(res.split(':')[1].strip().split(' ')[0])
-    res = grep('nlines',dempar) 
-    dem_length = np.int32(res.split(':')[1].strip())
-
-    mlipar = os.path.join(datadir,'SLC',masterdate,masterdate+'.mli.par')
-    res = grep('range_samples',mlipar)
-    mliwidth = np.int32(res.split(':')[1].strip())
-    res = grep('azimuth_lines',mlipar)
-    mlilength = np.int32(res.split(':')[1].strip())    
+    dem = read_par(dempar)
+    demlat = np.float32(dem['corner_lat'])
+    demlon = np.float32(dem['corner_lon'])
+    latstep = np.float32(dem['post_lat'])
+    lonstep = np.float32(dem['post_lon'])
+    dem_length = np.int32(dem['nlines'])
+
+    mli = read_par(os.path.join(datadir,'SLC',masterdate,masterdate+'.mli.par'))
+    mliwidth = np.int32(mli['range_samples'])
+    mlilength = np.int32(mli['azimuth_lines'])
     
     lat = np.arange(demlat,demlat+dem_length*latstep,latstep)
     lat = lat[:dem_length]
@@ -176,136 +176,100 @@ def geocode_mli(datadir,masterdate,dem_width):
     lon = np.arange(demlon,demlon+dem_width*lonstep,lonstep)
     lon = lon[:dem_width]
 
-    LON,LAT = np.meshgrid(lon,lat)
-    
-    np.float32(LON).byteswap().tofile(geodir+'/lon_dem')
-    np.float32(LAT).byteswap().tofile(geodir+'/lat_dem')
-    exe_str = 'geocode {0}/{1}.lut_fine {0}/lon_dem {2} {0}/lon_mli {3} {4}'.format(geodir,
-                                                                                   masterdate,
-                                                                                   dem_width,
-                                                                                   mliwidth,
-                                                                                   mlilength)
-    os.system(exe_str)
-    exe_str = 'geocode {0}/{1}.lut_fine {0}/lat_dem {2} {0}/lat_mli {3} {4}'.format(geodir,
-                                                                                   masterdate,
-                                                                                   dem_width,
-                                                                                   mliwidth,
-                                                                                   mlilength)
-    os.system(exe_str)
+    write_latlon_grids(geodir+'/lon_dem',geodir+'/lat_dem',lon,lat,blocksize)
+    run_parallel([['geocode',os.path.join(geodir,masterdate+'.lut_fine'),
+                   geodir+'/'+coord+'_dem',dem_width,geodir+'/'+coord+'_mli',
+                   mliwidth,mlilength]
+                  for coord in ('lon','lat')])
     return mliwidth, mlilength
 
 
 
+def write_latlon_grids(lonfile,latfile,lon,lat,blocksize=64):
+    """
+    Writes the longitude and latitude of each pixel of the grid given by the
+    lon and lat vectors as big-endian float32 rasters, in blocks of lines of
+    at most blocksize MB per raster
+    """
+    width = len(lon)
+    blocklines = max(1,int(blocksize*2**20//(4*width)))
+    lonline = np.asarray(lon,dtype='>f4')
+    lat = np.asarray(lat,dtype='>f4')
+    lonblock = np.empty((min(blocklines,len(lat)),width),dtype='>f4')
+    lonblock[:] = lonline
+    latblock = np.empty_like(lonblock)
+    with open(lonfile,'wb') as flon, open(latfile,'wb') as flat:
+        for l0 in range(0,len(lat),blocklines):
+            n = min(blocklines,len(lat)-l0)
+            latblock[:n] = lat[l0:l0+n,np.newaxis]
+            lonblock[:n].tofile(flon)
+            latblock[:n].tofile(flat)
+
+@step
 def geocode_dem(datadir,masterdate,dem_width):
     mli = os.path.join(datadir,'SLC',masterdate,masterdate+'.mli')
     geodir=os.path.join(datadir,'Geo')
-    res = grep('range_samples','{mli}.par'.format(mli=mli))
-    width = np.int32(res.split(':')[1].strip())
-    res = grep('nlines','{gd}/{md}.dem.par'.format(gd=geodir,md=masterdate))
-    dem_length = np.int32(res.split(':')[1].strip())
-    res = grep('azimuth_lines','{mli}.par'.format(mli=mli))
-    length = np.int32(res.split(':')[1].strip())
-    
-    exe_str = 'geocode_back {mli} {w} {gd}/{md}.lut_fine '.format(mli=mli,
-                                                                   w=width,
-                                                                   gd=geodir,
-                                                                   md=masterdate)
-    exe_str += '{gd}/DEM.{md}.mli {dw} {dl} 2 0'.format(gd=geodir,
-                                                        md=masterdate,
-                                                        dw=dem_width,
-                                                        dl=dem_length)
-    os.system(exe_str)
+    mlipar = read_par(mli+'.par')
+    width = np.int32(mlipar['range_samples'])
+    length = np.int32(mlipar['azimuth_lines'])
+    dem_length = np.int32(read_par(os.path.join(geodir,masterdate+'.dem.par'))['nlines'])
     
-    exe_str = 'geocode {gd}/{md}.lut_fine {gd}/{md}.dem '.format(gd=geodir,
-                                                                 md=masterdate)
-    exe_str += '{wd} {gd}/{md}.hgt {w} {l} 2 0'.format(wd=dem_width,
-                                                       gd=geodir,
-                                                       md=masterdate,
-                                                       w=width,
-                                                       l=length)
-    os.system(exe_str)
-    
-    exe_str = 'rashgt {gd}/{md}.hgt {mli} {w} - - - - - 500'.format(gd=geodir,
-                                                                    md=masterdate,
-                                                                    mli=mli,
-                                                                    w=width)
-    os.system(exe_str)
-    
-    exe_str = 'rashgt {gd}/{md}.dem {gd}/DEM.{md}.mli {wd} - - - - - 500'.format(gd=geodir,
-                                                                                  md=masterdate,
-                                                                                  wd=dem_width)
-    os.system(exe_str)
-
+    md = os.path.join(geodir,masterdate)
+    # The backward and forward geocoding, and the two rasters, are independent
+    run_parallel([['geocode_back',mli,width,md+'.lut_fine',
+                   geodir+'/DEM.'+masterdate+'.mli',dem_width,dem_length,2,0],
+                  ['geocode',md+'.lut_fine',md+'.dem',dem_width,md+'.hgt',
+                   width,length,2,0]])
+    run_parallel([['rashgt',md+'.hgt',mli,width,'-','-','-','-','-',500],
+                  ['rashgt',md+'.dem',geodir+'/DEM.'+masterdate+'.mli',dem_width,
+                   '-','-','-','-','-',500]])
+
+@step
 def calc_fine_dem_lut(datadir,masterdate):
     mli = os.path.join(datadir,'SLC',masterdate,masterdate+'.mli')
     geodir=os.path.join(datadir,'Geo')
-    res = grep('width','{gd}/{md}.dem.par'.format(gd=geodir,md=masterdate))
-    dem_width = np.int32(res.split(':')[1].strip())
+    dem_width = np.int32(read_par(os.path.join(geodir,masterdate+'.dem.par'))['width'])
     
-    exe_str = 'gc_map_fine {gd}/{md}.lut {dw} '.format(gd=geodir,
-                                                       md=masterdate,
-                                                       dw=dem_width)
-    exe_str += '{gd}/{md}.diff.par {gd}/{md}.lut_fine 1'.format(gd=geodir,
-                                                                md=masterdate)
-
-    os.system(exe_str)
+    md = os.path.join(geodir,masterdate)
+    run(['gc_map_fine',md+'.lut',dem_width,md+'.diff.par',md+'.lut_fine',1])
     return dem_width        
     
     
 
+@step
 def get_offset(datadir,masterdate):
     mli = os.path.join(datadir,'SLC',masterdate,masterdate+'.mli')
     geodir=os.path.join(datadir,'Geo')
     
-    exe_str = 'offset_pwrm {gd}/pix_sigma0 {mli} '.format(gd=geodir,
-                                                          mli=mli)
-    exe_str += '{gd}/{md}.diff.par {gd}/{md}.offs '.format(gd=geodir,
-                                                           md=masterdate)
-    exe_str += '{gd}/{md}.snr 512 512 - 2 128 128 7.0'.format(gd=geodir,
-                                                              md=masterdate)
-
-    os.system(exe_str)
-    
-    exe_str = 'offset_fitm {gd}/{md}.offs {gd}/{md}.snr '.format(gd=geodir,
-                                                                 md=masterdate)
-    exe_str += '{gd}/{md}.diff.par - - 7.0 1'.format(gd=geodir,
-                                                     md=masterdate)
-    os.system(exe_str)
+    md = os.path.join(geodir,masterdate)
+    run(['offset_pwrm',geodir+'/pix_sigma0',mli,md+'.diff.par',md+'.offs',
+         md+'.snr',512,512,'-',2,128,128,7.0])
+    run(['offset_fitm',md+'.offs',md+'.snr',md+'.diff.par','-','-',7.0,1])
 
+@step
 def calc_dem_lut(datadir,masterdate,demfile):
     mlipar = os.path.join(datadir,'SLC',masterdate,masterdate+'.mli.par')
     geodir=os.path.join(datadir,'Geo')
     if not os.path.exists(geodir):
         os.mkdir(geodir)
                           
-    exe_str = 'gc_map {mli} - {dem}.par {dem} '.format(mli=mlipar,
-                                                       dem=demfile)
-    exe_str += '{gd}/{md}.dem.par {gd}/{md}.dem '.format(gd=geodir,
-                                                         md=masterdate)
-    exe_str += '{gd}/{md}.lut 4 5 {gd}/{md}.sim_sar '.format(gd=geodir,
-                                                             md=masterdate)
-    exe_str += '{gd}/u {gd}/v {gd}/inc {gd}/psi {gd}/pix {gd}/ls_map - 2'.format(gd=geodir)
-
-    os.system(exe_str)
+    md = os.path.join(geodir,masterdate)
+    run(['gc_map',mlipar,'-',demfile+'.par',demfile,md+'.dem.par',md+'.dem',
+         md+'.lut',4,5,md+'.sim_sar']+
+        [os.path.join(geodir,f) for f in ('u','v','inc','psi','pix','ls_map')]+
+        ['-',2])
 
+@step
 def calc_terrain_norm(datadir,masterdate):
     mlipar = os.path.join(datadir,'SLC',masterdate,masterdate+'.mli.par')
     geodir=os.path.join(datadir,'Geo')
     
-    exe_str = 'pixel_area {mli} {gd}/{md}.dem.par '.format(mli=mlipar,
-                                                           gd=geodir,
-                                                           md=masterdate)
-    exe_str += '{gd}/{md}.dem {gd}/{md}.lut {gd}/ls_map '.format(gd=geodir,
-                                                                md=masterdate)
-    exe_str += '{gd}/inc {gd}/pix_sigma0 {gd}/pix_gamma0'.format(gd=geodir)
- 
-    os.system(exe_str)
-
-    exe_str = 'create_diff_par {mli} - {gd}/{md}.diff.par 1 0'.format(mli=mlipar,
-                                                                      gd=geodir,
-                                                                      md=masterdate)
-    
-    os.system(exe_str)
+    md = os.path.join(geodir,masterdate)
+    # The diff par does not depend on the normalisation areas
+    run_parallel([['pixel_area',mlipar,md+'.dem.par',md+'.dem',md+'.lut',
+                   geodir+'/ls_map',geodir+'/inc',geodir+'/pix_sigma0',
+                   geodir+'/pix_gamma0'],
+                  ['create_diff_par',mlipar,'-',md+'.diff.par',1,0]])
     
 
 
@@ -0,0 +1,433 @@
+"""
+
+Benchmarks for performance critical parts of the processing chain
+
+Overview
+========
+
+Runs timing benchmarks on synthetic data, comparing the current implementation of a function with the one it replaced. Each benchmark prints its results to screen.
+
+Functions
+=========
+
+  bench_db_indexes:
+    Query latency on a synthetic burst catalogue, before and after migrating
+    the database to the indexed schema
+  bench_multilook:
+    Time and peak memory of multilooking a raster file with the previous
+    in-memory multilook and the current block-wise one
+  bench_ll2xy:
+    Time and peak memory of converting a longitude/latitude grid to local
+    coordinates with the previous ll2xy and with LocalProjector
+  bench_orbit_lookup:
+    Time to find the orbit files of a number of acquisition times, with the
+    previous lookup in apply_precise_orbit and with OrbitResolver
+
+Usage
+=====
+
+benchmarks.py -t <benchmark> [-n <size>] [-o </path/to/scratch/directory>]
+
+    -t        Name of the benchmark to run, one of: db_indexes, multilook,
+              ll2xy, orbit_lookup
+    -n        Size of the synthetic data set, meaning depends on benchmark
+              (db_indexes: number of bursts, default 1000000, multilook:
+              number of lines of a raster 4 times as wide, default 4000,
+              ll2xy: number of lines of a square grid, default 10000,
+              orbit_lookup: number of precise orbit files, default 20000)
+    -o        Directory for scratch files, defaults to the current directory
+"""
+
+import sys
+import getopt
+import os
+import time
+import sqlite3
+import calendar
+import resource
+import numpy as np
+from multiprocessing import Pool
+
+from RIMoDe.Sentinel.S1_db_schema import migrate
+from RIMoDe.utils import multilook, LocalProjector, deg2rad
+from RIMoDe.Sentinel.S1_orbit import OrbitResolver
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv
+
+    benchmark = []
+    size = []
+    scratchdir = os.getcwd()
+
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "ht:n:o:", ["help"])
+        except getopt.error, msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print __doc__
+                return 0
+            elif o == '-t':
+                benchmark = a
+            elif o == '-n':
+                size = int(a)
+            elif o == '-o':
+                scratchdir = a
+
+        if benchmark not in BENCHMARKS:
+            raise Usage('Unknown benchmark {0}, choose from: {1}'.format(benchmark,', '.join(sorted(BENCHMARKS))))
+        if not os.path.isdir(scratchdir):
+            raise Usage('Scratch directory {0} does not exist.'.format(scratchdir))
+
+    except Usage, err:
+        print >>sys.stderr, "\nWoops, something went wrong:"
+        print >>sys.stderr, "  "+str(err.msg)
+        print >>sys.stderr, "\nFor help, use -h or --help.\n"
+        return 2
+
+    if size:
+        BENCHMARKS[benchmark](scratchdir,size)
+    else:
+        BENCHMARKS[benchmark](scratchdir)
+
+def time_calls(func,args,repeat=1):
+    """Returns the mean wall time in seconds of func over all args"""
+    t1 = time.time()
+    for r in range(repeat):
+        for a in args:
+            func(*a)
+    return (time.time()-t1)/(repeat*len(args))
+
+def make_catalogue(dbfilename,nbursts,ndates=4,burstsperfile=10):
+    """
+    Fills a version 1 (unindexed) database with nbursts bursts on
+    consecutive tracks, covered by ndates acquisitions in files of
+    burstsperfile bursts each
+    """
+    conn = sqlite3.connect(dbfilename)
+    migrate(conn,target=1,wal=False)
+    c = conn.cursor()
+    nperswath = 500
+    rng = np.random.RandomState(0)
+    dates = [20150101+100*m for m in range(ndates)]
+    burst_rows = []
+    file_rows = []
+    relation_rows = []
+    for b in range(nbursts):
+        track = b//(3*nperswath)+1
+        swath = (b//nperswath)%3+1
+        burstid = 10000+(b%nperswath)*28
+        lat = -80+160*((b%nperswath)/float(nperswath))
+        lon = -180+(track*2.05+swath*0.7)%360
+        corners = lat+rng.rand(4)*0.2, lon+rng.rand(4)*0.9
+        burstdbid = 'T{0}-IW{1}-{2}'.format(track,swath,burstid)
+        burst_rows.append((burstdbid,track,'Descending',swath,burstid,
+                           lat+0.1,lon+0.45,
+                           corners[0][0],corners[1][0],corners[0][1],corners[1][1],
+                           corners[0][2],corners[1][2],corners[0][3],corners[1][3]))
+        for d in dates:
+            fileid = 's1a-iw{0}-slc-vv-{1}-t{2}-{3}.tiff'.format(swath,d,track,b//burstsperfile)
+            if b%burstsperfile == 0:
+                file_rows.append((fileid,'/data/{0}.SAFE'.format(fileid),track,
+                                  'Descending',swath,'VV',d))
+            relation_rows.append((fileid,burstdbid,b%burstsperfile+1))
+        if len(relation_rows) > 100000 or b == nbursts-1:
+            c.executemany('INSERT INTO bursts VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',burst_rows)
+            c.executemany('INSERT INTO files VALUES (?,?,?,?,?,?,?)',file_rows)
+            c.executemany('INSERT INTO files_bursts VALUES (?,?,?)',relation_rows)
+            burst_rows = []
+            file_rows = []
+            relation_rows = []
+    conn.commit()
+    conn.close()
+    return dates
+
+def bench_db_indexes(scratchdir,nbursts=1000000):
+    dbfilename = os.path.join(scratchdir,'bench_db_indexes.sql')
+    if os.path.exists(dbfilename):
+        os.remove(dbfilename)
+    t1 = time.time()
+    dates = make_catalogue(dbfilename,nbursts)
+    print 'Created synthetic catalogue of {0} bursts in {1:.1f} seconds'.format(nbursts,time.time()-t1)
+
+    conn = sqlite3.connect(dbfilename)
+    c = conn.cursor()
+    ntracks = max(nbursts//1500,1)
+    rng = np.random.RandomState(1)
+    def run(sql):
+        return lambda *args: c.execute(sql,args).fetchall()
+
+    queries = [
+        ('insert: burst lookup',
+         run('SELECT id, burstid FROM bursts WHERE track = ? AND swath = ? AND burstid > ? AND burstid < ?'),
+         [(t,s,b-10,b+10) for t,s,b in zip(rng.randint(1,ntracks+1,20),
+                                           rng.randint(1,4,20),
+                                           10000+28*rng.randint(0,500,20))]),
+        ('insert: file lookup',
+         run('SELECT * FROM files WHERE id = ?'),
+         [('s1a-iw1-slc-vv-{0}-t{1}-{2}.tiff'.format(dates[0],t,(t-1)*150),) for t in rng.randint(1,ntracks+1,20)]),
+        ('query: AOI',
+         run('SELECT id FROM bursts WHERE center_lon > ? AND center_lon < ? AND center_lat > ? AND center_lat < ?'),
+         [(lo,lo+1,la,la+1) for lo,la in zip(rng.uniform(-180,179,20),rng.uniform(-80,79,20))]),
+        ('setup images: burst/date',
+         run('SELECT files.id, files.directory, files.swath, files_bursts.burst_no '
+             'FROM files, files_bursts, bursts '
+             'WHERE bursts.id = files_bursts.burst_id AND files.id = files_bursts.file_id AND '
+             '(files.pol = "HH" OR files.pol = "VV") AND files.date = ? AND bursts.id = ?'),
+         [(dates[rng.randint(len(dates))],'T{0}-IW{1}-{2}'.format(t,s,b))
+          for t,s,b in zip(rng.randint(1,ntracks+1,20),rng.randint(1,4,20),10000+28*rng.randint(0,500,20))]),
+    ]
+
+    before = [time_calls(f,args) for name,f,args in queries]
+    conn.close()
+    t1 = time.time()
+    conn = sqlite3.connect(dbfilename)
+    migrate(conn,wal=False)
+    print 'Migrated catalogue in {0:.1f} seconds'.format(time.time()-t1)
+    c = conn.cursor()
+    after = [time_calls(f,args,repeat=10) for name,f,args in queries]
+    conn.close()
+
+    print '\nQuery:                          Before (ms):   After (ms):   Speedup:'
+    print '---------------------------------------------------------------------'
+    for (name,f,args), b, a in zip(queries,before,after):
+        print '{0:32s}{1:12.3f}{2:14.3f}{3:11.0f}x'.format(name,b*1000,a*1000,b/a)
+    os.remove(dbfilename)
+
+def multilook_old(im,fa,fr):
+    """utils.multilook before block-wise processing, with integer sizes"""
+    nr = int(np.floor(len(im[0,:])/float(fr))*fr)
+    na = int(np.floor(len(im[:,0])/float(fa))*fa)
+    im = im[:na,:nr]
+    im[np.where(np.isnan(im))] = 0
+    aa = np.zeros((na/fa,nr))
+    for k in range(fa) :
+        aa = aa+im[k::fa,:]
+    imout=np.zeros((na/fa,nr/fr))
+    for k in range(fr) :
+        imout = imout+aa[:,k::fr]
+    return imout/fa/fr
+
+def measure(args):
+    """
+    Runs one multilook variant on a raster file, returns wall time and the
+    increase of peak memory in MB. Run in a fresh process for each variant.
+    Pages of the memory mapped file count towards the peak resident memory,
+    but are page cache the kernel can reclaim, so these are subtracted
+    """
+    variant, filename, length, width, fa, fr = args
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-file_rss()
+    t1 = time.time()
+    if variant == 'old':
+        im = np.fromfile(filename,dtype='>f4').astype(np.float32).reshape(length,width)
+        res = multilook_old(im,fa,fr)
+    else:
+        im = np.memmap(filename,dtype='>f4',mode='r',shape=(length,width))
+        res = multilook(im,fa,fr)
+    elapsed = time.time()-t1
+    return elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-file_rss()-rss)/1024.
+
+def file_rss():
+    """Returns the resident file-backed memory in kB (Linux only, else 0)"""
+    try:
+        with open('/proc/self/status') as f:
+            for l in f:
+                if l.startswith('RssFile:'):
+                    return int(l.split()[1])
+    except IOError:
+        pass
+    return 0
+
+def bench_multilook(scratchdir,length=4000):
+    width = 4*length
+    fa, fr = 5, 20
+    filename = os.path.join(scratchdir,'bench_multilook.mli')
+    rng = np.random.RandomState(0)
+    with open(filename,'wb') as f:
+        for l0 in range(0,length,500):
+            block = rng.rand(min(500,length-l0),width).astype('>f4')
+            block[block < 0.01] = np.nan
+            block.tofile(f)
+    print 'Created {0}x{1} big-endian float32 raster ({2:.0f} MB)'.format(length,width,length*width*4/1024.**2)
+
+    results = []
+    for variant in ('old','new'):
+        pool = Pool(1)
+        results.append(pool.apply(measure,((variant,filename,length,width,fa,fr),)))
+        pool.close()
+        pool.join()
+    print '\nThe old multilook averages NaNs as zeros, the new one ignores them.'
+    print '\nVariant:                     Time (s):   Peak memory (MB):'
+    print '----------------------------------------------------------'
+    for name, (elapsed, mem) in zip(('old (read + multilook)','new (memmap, blocks)'),results):
+        print '{0:28s}{1:10.2f}{2:20.0f}'.format(name,elapsed,mem)
+    os.remove(filename)
+
+def ll2xy_old(lon,lat,lon_orig,lat_orig):
+    """utils.ll2xy before LocalProjector, works on 1-D arrays only"""
+    a = 6378137.0
+    e = 0.08209443794970
+
+    x = np.zeros_like(lon)
+    y = np.zeros_like(lat)
+
+    lon = deg2rad(lon)
+    lat = deg2rad(lat)
+    lon_orig = deg2rad(lon_orig)
+    lat_orig = deg2rad(lat_orig)
+
+    nonzeroix = lat != 0
+    dlambda = lon[nonzeroix]-lon_orig
+
+    M = a*((1-e**2/4-3*e**4/64-5*e**6/256)*lat[nonzeroix] -
+           (3*e**2/8+3*e**4/32+45*e**6/1024)*np.sin(2*lat[nonzeroix]) + 
+           (15*e**4/256 +45*e**6/1024)*np.sin(4*lat[nonzeroix]) - 
+           (35*e**6/3072)*np.sin(6*lat[nonzeroix]))
+
+    M0 = a*((1-e**2/4-3*e**4/64-5*e**6/256)*lat_orig -
+           (3*e**2/8+3*e**4/32+45*e**6/1024)*np.sin(2*lat_orig) + 
+           (15*e**4/256 +45*e**6/1024)*np.sin(4*lat_orig) - 
+           (35*e**6/3072)*np.sin(6*lat_orig));
+   
+    N = a/np.sqrt(1-e**2*np.sin(lat[nonzeroix])**2)
+    E = dlambda*np.sin(lat[nonzeroix])
+
+    x[nonzeroix] = N/np.tan(lat[nonzeroix])*np.sin(E)
+    y[nonzeroix] = M-M0+N/np.tan(lat[nonzeroix])*(1-np.cos(E))
+
+    x[~nonzeroix] = a*dlambda[~nonzeroix]
+    y[~nonzeroix] = -M0
+
+    return x, y
+
+def measure_ll2xy(args):
+    """
+    Runs one ll2xy variant on a float32 grid of length lines, returns wall
+    time, the increase of peak memory in MB and the result for some pixels
+    """
+    variant, length = args
+    lon, lat = np.meshgrid(np.linspace(-19,-17,length).astype(np.float32),
+                           np.linspace(65,64,length).astype(np.float32))
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t1 = time.time()
+    if variant == 'old':
+        x, y = ll2xy_old(lon.ravel(),lat.ravel(),-18.,64.5)
+    else:
+        x, y = LocalProjector(-18.,64.5,dtype=variant).forward(lon,lat)
+    elapsed = time.time()-t1
+    sample = np.float64(x.ravel()[::length*length//100+1]), np.float64(y.ravel()[::length*length//100+1])
+    return elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-rss)/1024., sample
+
+def bench_ll2xy(scratchdir,length=10000):
+    print 'Converting a {0}x{0} float32 grid'.format(length)
+    results = []
+    for variant in ('old',np.float64,np.float32):
+        pool = Pool(1)
+        results.append(pool.apply(measure_ll2xy,((variant,length),)))
+        pool.close()
+        pool.join()
+    # The old ll2xy computes in the precision of its input, here float32
+    ref = results[1][2]
+
+    print '\nDifferences are relative to LocalProjector, which computes in float64.'
+    print '\nVariant:                     Time (s):   Peak memory (MB):   Max diff (m):'
+    print '--------------------------------------------------------------------------'
+    for name, (elapsed, mem, sample) in zip(('old ll2xy','LocalProjector','LocalProjector float32'),results):
+        diff = max(np.abs(sample[0]-ref[0]).max(),np.abs(sample[1]-ref[1]).max())
+        print '{0:28s}{1:10.2f}{2:20.0f}{3:16.3f}'.format(name,elapsed,mem,diff)
+
+def orbit_lookup_old(orbitdb,datetime):
+    """Orbit file lookup of apply_precise_orbit before OrbitResolver"""
+    conn = sqlite3.connect(orbitdb)
+    c = conn.cursor()
+    for table in ('porbits','rorbits'):
+        c.execute('SELECT id, directory FROM {0} '.format(table)+
+                  'WHERE strftime(\'%s\',\"{0}\") BETWEEN strftime(\'%s\',begintime) AND strftime(\'%s\', endtime);'.format(datetime))
+        res = c.fetchall()
+        if res:
+            conn.close()
+            return os.path.join(res[0][1],res[0][0])
+    conn.close()
+
+def make_orbit_catalogue(orbitdb,nfiles):
+    """
+    Creates an orbit database in the original schema with nfiles daily
+    precise orbit files, and restituted orbit files for the last 10 percent
+    of the days. Returns the epoch of the first day
+    """
+    conn = sqlite3.connect(orbitdb)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),'Sentinel','init_orbit_db.sql')) as f:
+        conn.executescript(f.read())
+    t0 = calendar.timegm((2014,10,1,0,0,0))
+    fmt = lambda t: time.strftime('%Y-%m-%dT%H:%M:%S',time.gmtime(t))
+    fname = lambda kind, b, e: 'S1A_OPER_AUX_{0}_OPOD_{1}_V{2}_{3}.EOF'.format(kind,time.strftime('%Y%m%dT%H%M%S',time.gmtime(e+20*86400)),
+                                                                              time.strftime('%Y%m%dT%H%M%S',time.gmtime(b)),
+                                                                              time.strftime('%Y%m%dT%H%M%S',time.gmtime(e)))
+    rows = []
+    for i in range(nfiles):
+        b, e = t0+i*86400-3600, t0+(i+1)*86400+3600
+        rows.append(('porbits',fname('POEORB',b,e),fmt(b),fmt(e)))
+    for i in range(nfiles-nfiles//10,nfiles+nfiles//10):
+        for j in range(8):
+            b = t0+i*86400+j*10800-1800
+            e = b+10800+3600
+            rows.append(('rorbits',fname('RESORB',b,e),fmt(b),fmt(e)))
+    with conn:
+        for table in ('porbits','rorbits'):
+            conn.executemany('INSERT INTO {0} VALUES (?, \'/orbits\', ?, ?)'.format(table),
+                             [r[1:] for r in rows if r[0] == table])
+    conn.close()
+    return t0
+
+def bench_orbit_lookup(scratchdir,nfiles=20000):
+    orbitdb = os.path.join(scratchdir,'bench_orbit_lookup.sql')
+    if os.path.exists(orbitdb):
+        os.remove(orbitdb)
+    t0 = make_orbit_catalogue(orbitdb,nfiles)
+    print 'Created synthetic orbit database of {0} precise orbit files'.format(nfiles)
+    rng = np.random.RandomState(1)
+    # Acquisition times, some of which are only covered by restituted orbits
+    epochs = t0+rng.randint(0,(nfiles+nfiles//10)*86400,100)
+    datetimes = [time.strftime('%Y-%m-%dT%H:%M:%S',time.gmtime(e)) for e in epochs]
+
+    t1 = time.time()
+    old = [orbit_lookup_old(orbitdb,d) for d in datetimes]
+    told = time.time()-t1
+    t1 = time.time()
+    resolver = OrbitResolver(orbitdb)
+    print 'Migrated orbit database in {0:.1f} seconds'.format(time.time()-t1)
+    t1 = time.time()
+    single = [resolver.resolve([e])[0] for e in epochs]
+    tsingle = time.time()-t1
+    t1 = time.time()
+    batch = resolver.resolve(epochs)
+    tbatch = time.time()-t1
+    resolver.close()
+
+    # The old lookup takes any covering file, the resolver the newest one
+    covered = lambda f, e: f is not None and calendar.timegm(time.strptime(f.split('_')[-2][1:],'%Y%m%dT%H%M%S')) <= e
+    print '\nLookup of {0} acquisition times:'.format(len(epochs))
+    print '\nMethod:                        Total (ms):   Per time (ms):'
+    print '-----------------------------------------------------------'
+    for name, elapsed in (('old, one connection per time',told),('OrbitResolver, per time',tsingle),
+                          ('OrbitResolver, batch',tbatch)):
+        print '{0:32s}{1:10.1f}{2:16.3f}'.format(name,elapsed*1000,elapsed*1000/len(epochs))
+    print '\nSame kind of orbit found for {0} of {1} times, all found files cover their time: {2}'.format(
+        sum((o is None) == (n is None) and (o is None or o.split('_')[3] == n.split('_')[3]) for o, n in zip(old,batch)),
+        len(epochs),all(covered(n,e) for n, e in zip(batch,epochs) if n))
+    os.remove(orbitdb)
+
+BENCHMARKS = {'db_indexes': bench_db_indexes,
+              'multilook': bench_multilook,
+              'll2xy': bench_ll2xy,
+              'orbit_lookup': bench_orbit_lookup}
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+
+Runs external (Gamma) programs
+
+Overview
+========
+
+All external programs of the processing chain are run through this module. Commands are given as argument lists and started without a shell. The exit status of every command is checked, and its output (stdout and stderr) is captured. For each command the wall time, the CPU time (user and system) and the peak resident memory of the child process are recorded in the history list of this module, together with the number of bytes read and written. The output itself is only returned to the caller; history keeps the last lines of the output of failed commands only. Callers that have used the history, such as steplog.py, can forget it with clear_history. Arguments that are existing files before the command is run are counted as input, files that are created or changed by the command as output. Files listed in *_tab arguments are included. Independent commands can be run at the same time using run_parallel.
+
+To exercise or benchmark the processing chain without a Gamma installation, a directory with stand-in Gamma programs can be created using the -f option. Once this directory is put in front of PATH, each stand-in creates the output files it is given, including the files listed in SLC_tab files and minimal .par files, and appends its command line to the file given by the FAKE_GAMMA_LOG environment variable, if set.
+
+Functions
+=========
+
+Main functions
+--------------
+
+  run:
+    Runs a single command, checks its exit status and records its resource
+    usage
+  run_parallel:
+    Runs a list of independent commands using a number of threads
+  clear_history:
+    Forgets the resource usage of commands that were run
+
+Aux functions
+-------------
+
+  make_fake_gamma:
+    Creates a directory with stand-in Gamma programs
+  stat_files:
+    Returns size and modification time of the files among the arguments of
+    a command
+
+Usage
+=====
+
+runner.py -f </path/to/fake/gamma/directory>
+
+    -f        Creates stand-in Gamma programs in the given directory
+"""
+
+import sys
+import getopt
+import os
+import stat
+import time
+import subprocess as subp
+from multiprocessing.pool import ThreadPool
+
+# Resource usage of all commands run by this process, see clear_history
+history = []
+
+# Lines of output kept in history and in the error message of failed commands
+TAIL_LINES = 10
+
+GAMMA_PROGRAMS = ['par_S1_SLC', 'SLC_copy_S1_TOPS', 'SLC_cat_S1_TOPS',
+                  'multi_S1_TOPS', 'SLC_mosaic_S1_TOPS', 'S1_OPOD_vec',
+                  'raspwr', 'rashgt', 'rasmph_pwr', 'look_vector', 'geocode',
+                  'geocode_back', 'gc_map', 'gc_map_fine', 'pixel_area',
+                  'create_diff_par', 'offset_pwrm', 'offset_fitm',
+                  'multi_look', 'phase_sim_orb', 'SLC_diff_intf',
+                  'S1_coreg_overlap', 'create_offset', 'offset_pwr',
+                  'offset_fit', 'rdc_trans', 'SLC_interp_lt_S1_TOPS']
+
+FAKE_GAMMA = '''#!{python}
+# Stand-in for a Gamma program, created by RIMoDe runner.py
+import os, sys
+log = os.environ.get('FAKE_GAMMA_LOG')
+if log:
+    with open(log, 'a') as f:
+        f.write(' '.join(sys.argv)+'\\n')
+PAR = """title: fake
+image_format: FCOMPLEX
+range_samples:   {size}
+azimuth_lines:   {size}
+width:   {size}
+nlines:   {size}
+corner_lat:   65.0000000   decimal degrees
+corner_lon:   -18.0000000   decimal degrees
+post_lat:   -1.0000000e-03   decimal degrees
+post_lon:    1.0000000e-03   decimal degrees
+"""
+def touch(path):
+    d = os.path.dirname(path)
+    if os.path.exists(path) or (d and not os.path.isdir(d)):
+        return
+    with open(path, 'w') as f:
+        if path.endswith('.par') or path.endswith('_par'):
+            f.write(PAR)
+for a in sys.argv[1:]:
+    if a == '-' or a.lstrip('-').replace('.', '', 1).isdigit():
+        continue
+    if a.endswith('_tab') and os.path.exists(a):
+        for l in open(a):
+            for name in l.split():
+                touch(name)
+    else:
+        touch(a)
+'''
+
+class CommandError(Exception):
+    def __init__(self, msg, result=None):
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.result = result
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv
+
+    fakedir = []
+
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "hf:", ["help"])
+        except getopt.error, msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print __doc__
+                return 0
+            elif o == '-f':
+                fakedir = a
+
+        if not fakedir:
+            raise Usage('No directory given, -f option is not optional!')
+
+    except Usage, err:
+        print >>sys.stderr, "\nWoops, something went wrong:"
+        print >>sys.stderr, "  "+str(err.msg)
+        print >>sys.stderr, "\nFor help, use -h or --help.\n"
+        return 2
+
+    make_fake_gamma(fakedir)
+    print 'Stand-in Gamma programs written to {0}, use with:'.format(fakedir)
+    print '  export PATH={0}:$PATH'.format(os.path.abspath(fakedir))
+
+def run(argv, cwd=None, check=True):
+    """
+    Runs argv without a shell, in directory cwd if given. Returns a dictionary
+    with the command, its return code and output, the wall time and CPU time
+    in seconds, and the peak resident memory in kB. Raises CommandError if
+    the command fails and check is True
+    """
+    argv = [str(a) for a in argv]
+    before = stat_files(argv, cwd)
+    t1 = time.time()
+    try:
+        p = subp.Popen(argv, stdout=subp.PIPE, stderr=subp.STDOUT, cwd=cwd,
+                       close_fds=True)
+    except OSError, err:
+        result = {'argv': argv, 'returncode': 127, 'output': str(err),
+                  'start': t1, 'wall': 0., 'cpu': 0., 'maxrss': 0}
+    else:
+        output = p.stdout.read()
+        p.stdout.close()
+        # wait4 instead of wait, to get the resource usage of this child only
+        pid, status, rusage = os.wait4(p.pid, 0)
+        if os.WIFEXITED(status):
+            p.returncode = os.WEXITSTATUS(status)
+        else:
+            p.returncode = -os.WTERMSIG(status)
+        result = {'argv': argv, 'returncode': p.returncode, 'output': output,
+                  'start': t1, 'wall': time.time()-t1,
+                  'cpu': rusage.ru_utime+rusage.ru_stime,
+                  'maxrss': rusage.ru_maxrss}
+    after = stat_files(argv, cwd)
+    result['in_bytes'] = sum(size for size, mtime in before.itervalues())
+    result['out_bytes'] = sum(after[f][0] for f in after if after[f] != before.get(f))
+    # The (verbose) output is not kept, except the tail of failed commands
+    record = dict((k, v) for k, v in result.iteritems() if k != 'output')
+    if result['returncode'] != 0:
+        record['tail'] = '\n'.join(result['output'].strip().split('\n')[-TAIL_LINES:])
+    history.append(record)
+
+    if check and result['returncode'] != 0:
+        tail = record['tail']
+        raise CommandError('Command {0} failed with exit status {1}:\n{2}'.format(' '.join(argv),
+                                                                                 result['returncode'],
+                                                                                 tail),
+                           result)
+    return result
+
+def run_parallel(argvs, nproc=None, cwd=None, check=True):
+    """
+    Runs the independent commands in argvs using nproc threads (default: one
+    per command). Returns the results in the order of argvs, raising a
+    CommandError for the first failed command if check is True
+    """
+    if not argvs:
+        return []
+    pool = ThreadPool(nproc or len(argvs))
+    try:
+        results = pool.map(lambda a: run(a, cwd=cwd, check=False), argvs)
+    finally:
+        pool.close()
+        pool.join()
+    if check:
+        for r in results:
+            if r['returncode'] != 0:
+                raise CommandError('Command {0} failed with exit status {1}'.format(' '.join(r['argv']),
+                                                                                   r['returncode']),
+                                   r)
+    return results
+
+def clear_history(start=0):
+    """Forgets the commands in history from number start on"""
+    del history[start:]
+
+def stat_files(argv, cwd=None):
+    """
+    Returns a dictionary with the (size, mtime) of each existing file in argv,
+    and of the files listed in the *_tab files in argv
+    """
+    files = {}
+    for a in argv[1:]:
+        path = os.path.join(cwd, a) if cwd else a
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        files[path] = (st.st_size, st.st_mtime)
+        if a.endswith('_tab'):
+            with open(path) as f:
+                names = f.read().split()
+            files.update(stat_files([None]+names, cwd))
+    return files
+
+def make_fake_gamma(fakedir, programs=GAMMA_PROGRAMS, size=100):
+    if not os.path.exists(fakedir):
+        os.makedirs(fakedir)
+    script = FAKE_GAMMA.format(python=sys.executable, size=size)
+    for prog in programs:
+        filename = os.path.join(fakedir, prog)
+        with open(filename, 'w') as f:
+            f.write(script)
+        os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
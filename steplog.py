@@ -0,0 +1,242 @@
+"""
+
+Logs and summarises the processing steps of a run
+
+Overview
+========
+
+Records every processing step of a run as one line of JSON in a log file. A step is a function decorated with step, such as calc_offset or multi_TOPS. For each step the start and end time, the date (pair) it processes, the bytes read and written and the CPU time and peak memory of the Gamma programs it ran (see runner.py), and its exit status are logged. Steps called from within another step are logged with the name of that step as parent, and inherit its date if they have none of their own. Once the outermost step is logged, the commands it ran are removed from the history of runner.py, so long runs do not accumulate them.
+
+The log of a run is opened by the main function of the processing scripts, in the log directory of the processing directory. Records are appended with a single write, so processes started by the script can write to the same log.
+
+The summary lists the slowest steps, the total time spent in each type of step, and the time and throughput per date. It can be printed using the -l option.
+
+Functions
+=========
+
+Main functions
+--------------
+
+  open_log:
+    Starts a new log file for a run
+  step:
+    Decorator logging each call of a function as a step
+  summarise:
+    Prints the slowest steps and the throughput per date
+
+Aux functions
+-------------
+
+  read_log:
+    Reads the records of one or more log files
+  get_date:
+    Returns the date (pair) processed by a function call
+
+Usage
+=====
+
+steplog.py -l </path/to/log/file> [-l </path/to/log/file>] [-n <number of steps>]
+
+    -l        Log file to summarise, can be given more than once
+    -n        Number of slowest steps to list, default 10
+"""
+
+import sys
+import getopt
+import os
+import time
+import json
+import inspect
+import functools
+
+from RIMoDe import runner
+
+# Log file of the current run, and the steps currently running in this process
+current = {'filename': None}
+stack = []
+
+DATE_ARGS = ('masterdate', 'slavedate', 'date')
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv
+
+    logfiles = []
+    nslowest = 10
+
+    try:
+        try:
+            opts, args = getopt.getopt(argv[1:], "hl:n:", ["help"])
+        except getopt.error, msg:
+            raise Usage(msg)
+        for o, a in opts:
+            if o == '-h' or o == '--help':
+                print __doc__
+                return 0
+            elif o == '-l':
+                logfiles.append(a)
+            elif o == '-n':
+                nslowest = int(a)
+
+        if not logfiles:
+            raise Usage('No log file given, -l option is not optional!')
+        for l in logfiles:
+            if not os.path.exists(l):
+                raise Usage('Log file {0} does not seem to exist?'.format(l))
+
+    except Usage, err:
+        print >>sys.stderr, "\nWoops, something went wrong:"
+        print >>sys.stderr, "  "+str(err.msg)
+        print >>sys.stderr, "\nFor help, use -h or --help.\n"
+        return 2
+
+    summarise(read_log(logfiles), nslowest)
+
+def open_log(datadir, script):
+    """
+    Starts a new log for a run of script in datadir/log, and returns its
+    filename
+    """
+    logdir = os.path.join(datadir, 'log')
+    try:
+        os.makedirs(logdir)
+    except OSError:
+        if not os.path.isdir(logdir):
+            raise
+    filename = os.path.join(logdir, '{0}_{1}_{2}.jsonl'.format(script,
+                                                              time.strftime('%Y%m%d_%H%M%S'),
+                                                              os.getpid()))
+    current['filename'] = filename
+    return filename
+
+def write_record(record):
+    if not current['filename']:
+        return
+    line = json.dumps(record, sort_keys=True)+'\n'
+    fd = os.open(current['filename'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def get_date(func, args, kwargs):
+    try:
+        callargs = inspect.getcallargs(func, *args, **kwargs)
+    except TypeError:
+        return None
+    dates = [str(callargs[a]) for a in DATE_ARGS if callargs.get(a)]
+    if dates:
+        return '_'.join(dates)
+    return None
+
+def step(func):
+    """
+    Decorator logging each call of func as a step of the current run
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not current['filename']:
+            return func(*args, **kwargs)
+        date = get_date(func, args, kwargs)
+        if date is None and stack:
+            date = stack[-1]['date']
+        record = {'step': name, 'date': date, 'pid': os.getpid(),
+                  'parent': stack[-1]['step'] if stack else None,
+                  'depth': len(stack)}
+        stack.append(record)
+        nhistory = len(runner.history)
+        record['start'] = time.time()
+        try:
+            result = func(*args, **kwargs)
+            record['status'] = 'done'
+            return result
+        except Exception, err:
+            record['status'] = 'failed, {0}: {1}'.format(type(err).__name__,
+                                                         str(err).split('\n')[0])
+            raise
+        finally:
+            record['end'] = time.time()
+            record['wall'] = record['end']-record['start']
+            commands = runner.history[nhistory:]
+            record['commands'] = len(commands)
+            record['cpu'] = sum(c['cpu'] for c in commands)
+            record['maxrss'] = max([c['maxrss'] for c in commands] or [0])
+            record['in_bytes'] = sum(c.get('in_bytes', 0) for c in commands)
+            record['out_bytes'] = sum(c.get('out_bytes', 0) for c in commands)
+            stack.pop()
+            write_record(record)
+            # Commands of a step are only needed until its outermost step
+            # is logged
+            if not stack:
+                runner.clear_history(nhistory)
+    return wrapper
+
+def read_log(logfiles):
+    records = []
+    for l in logfiles:
+        with open(l) as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+def summarise(records, nslowest=10):
+    """
+    Prints the nslowest slowest steps, the time spent per type of step and
+    the time and throughput per date. Only steps that were not called from
+    another step are counted in the totals per date
+    """
+    mb = 1024.**2
+    print '\nSlowest steps:'
+    print '\nStep:                 Date:                Wall (s):   CPU (s):  In (MB):  Out (MB):  Status:'
+    print '-'*103
+    for r in sorted(records, key=lambda r: -r['wall'])[:nslowest]:
+        print '{0:22s}{1:20s}{2:10.1f}{3:11.1f}{4:10.1f}{5:11.1f}  {6}'.format('  '*r['depth']+r['step'],
+                                                                          str(r['date']),
+                                                                          r['wall'], r['cpu'],
+                                                                          r['in_bytes']/mb,
+                                                                          r['out_bytes']/mb,
+                                                                          r['status'])
+
+    perstep = {}
+    for r in records:
+        s = perstep.setdefault(r['step'], [0, 0., 0., 0])
+        s[0] += 1
+        s[1] += r['wall']
+        s[2] += r['cpu']
+        s[3] += r['status'] != 'done'
+    print '\nTime per step:'
+    print '\nStep:                 Calls:  Total (s):   Mean (s):   CPU (s):   Failed:'
+    print '-'*73
+    for name in sorted(perstep, key=lambda n: -perstep[n][1]):
+        n, wall, cpu, failed = perstep[name]
+        print '{0:22s}{1:6d}{2:12.1f}{3:12.1f}{4:11.1f}{5:10d}'.format(name, n, wall, wall/n, cpu, failed)
+
+    perdate = {}
+    for r in records:
+        if r['depth'] == 0 and r['date']:
+            d = perdate.setdefault(r['date'], [0, 0., 0, 0, 0])
+            d[0] += 1
+            d[1] += r['wall']
+            d[2] += r['in_bytes']
+            d[3] += r['out_bytes']
+            d[4] += r['status'] != 'done'
+    print '\nThroughput per date:'
+    print '\nDate:                Steps:  Wall (s):   In (MB):  Out (MB):   MB/s:  Failed:'
+    print '-'*78
+    for date in sorted(perdate):
+        n, wall, inb, outb, failed = perdate[date]
+        rate = (inb+outb)/mb/wall if wall > 0 else 0.
+        print '{0:20s}{1:7d}{2:11.1f}{3:11.1f}{4:11.1f}{5:8.1f}{6:9d}'.format(date, n, wall, inb/mb,
+                                                                           outb/mb, rate, failed)
+    print ''
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+
+Local stand-in for the Sentinel SciHub, for testing S1_find_data.py
+
+Overview
+========
+
+HubServer serves the products in its products dictionary on 127.0.0.1, on a free port, in the same way as the OData API of the hub:
+
+  <url>/odata/v1/Products('<uuid>')/$value                  the product
+  <url>/odata/v1/Products('<uuid>')/Checksum/Value/$value   its MD5 checksum
+
+The products in its entries list, dictionaries with id, uuid, ingestiondate, beginposition and size, are searched with
+
+  <url>/search?q=<query>&start=<start>&rows=<rows>&orderby=ingestiondate%20asc
+
+which returns a page of rows entries as an Atom feed, ordered by ingestion date. The query itself is not interpreted, except for an ingestionDate:[<date>+TO+NOW] condition. Each search is recorded in searches as (q, start, rows, ids of the entries returned).
+
+Range requests (bytes=<start>-) are answered with 206 and a Content-Range header, or with 416 if start is at or beyond the end of the product. To test the handling of misbehaving hubs, the range is ignored for the products in ignore_range, the products in corrupt are served with wrong contents the given number of times, and the products in nochecksum have no checksum. Every request is recorded in requests as (path, Range header).
+
+"""
+
+import re
+import urllib
+import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
+
+PRODUCT = re.compile(r"^/dhus/odata/v1/Products\('(\w+)'\)/(\$value|Checksum/Value/\$value)$")
+SINCE = re.compile(r"ingestionDate:\[(\S+?)\+TO\+NOW\]")
+
+ENTRY = """<entry>
+<id>{uuid}</id>
+<link href="{link}"/>
+<link rel="alternative" href="{link}"/>
+<str name="identifier">{id}</str>
+<date name="ingestiondate">{ingestiondate}</date>
+<date name="beginposition">{beginposition}</date>
+<str name="size">{size}</str>
+</entry>
+"""
+
+class HubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body='', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Length', len(body))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        hub = self.server
+        hub.requests.append((self.path, self.headers.get('Range')))
+        if not self.headers.get('Authorization'):
+            return self.send(401)
+        if self.path.startswith('/dhus/search?'):
+            return self.search()
+        m = PRODUCT.match(self.path)
+        if not m or m.group(1) not in hub.products:
+            return self.send(404)
+        uuid = m.group(1)
+        data = hub.products[uuid]
+        if m.group(2) != '$value':
+            if uuid in hub.nochecksum:
+                return self.send(404)
+            return self.send(200, hashlib.md5(data).hexdigest().upper())
+        if hub.corrupt.get(uuid):
+            hub.corrupt[uuid] -= 1
+            data = ''.join(chr(ord(c) ^ 0xff) for c in data)
+        byterange = self.headers.get('Range')
+        if not byterange or uuid in hub.ignore_range:
+            return self.send(200, data)
+        start = int(byterange.split('=')[1].rstrip('-'))
+        if start >= len(data):
+            return self.send(416, headers=[('Content-Range', 'bytes */{0}'.format(len(data)))])
+        return self.send(206, data[start:],
+                         [('Content-Range', 'bytes {0}-{1}/{2}'.format(start, len(data)-1, len(data)))])
+
+    def search(self):
+        hub = self.server
+        # Not parse_qs, as + in the query stands for itself
+        params = dict(p.split('=', 1) for p in self.path.split('?', 1)[1].split('&'))
+        q = urllib.unquote(params['q'])
+        start, rows = int(params['start']), int(params['rows'])
+        entries = sorted(hub.entries, key=lambda e: e['ingestiondate'])
+        since = SINCE.search(q)
+        if since:
+            entries = [e for e in entries if e['ingestiondate'] >= since.group(1)]
+        page = entries[start:start+rows]
+        hub.searches.append((q, start, rows, [e['id'] for e in page]))
+        body = '<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+        body += ''.join(ENTRY.format(link=hub.product_link(e['uuid']), **e) for e in page)
+        body += '</feed>\n'
+        return self.send(200, body, [('Content-Type', 'application/atom+xml')])
+
+class HubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), HubHandler)
+        self.products = {}
+        self.entries = []
+        self.searches = []
+        self.ignore_range = set()
+        self.corrupt = {}
+        self.nochecksum = set()
+        self.requests = []
+        self.url = 'http://127.0.0.1:{0}/dhus'.format(self.server_port)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def product_link(self, uuid):
+        return "{0}/odata/v1/Products('{1}')/$value".format(self.url, uuid)
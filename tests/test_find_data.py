@@ -0,0 +1,145 @@
+"""
+Tests of S1_find_data.py against a local stand-in for the hub (hub_stub.py).
+Run from the directory containing RIMoDe with:
+
+  python -m unittest discover -s RIMoDe/tests -t .
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from RIMoDe.Sentinel import S1_find_data
+from RIMoDe.tests.hub_stub import HubServer
+
+AUTH = 'Basic dXNlcjpwYXNz'
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.ddir = tempfile.mkdtemp()
+        self.hub = HubServer().start()
+        self.data = os.urandom(3*2**20+123)
+        self.hub.products['u1'] = self.data
+        self.entry = {'id': 'S1A_IW_SLC__TEST', 'link': self.hub.product_link('u1')}
+        self.filename = os.path.join(self.ddir, self.entry['id']+'.zip')
+
+    def tearDown(self):
+        self.hub.stop()
+        shutil.rmtree(self.ddir)
+
+    def download(self):
+        ident, status, nbytes, elapsed = S1_find_data.download_product(self.entry, self.ddir, AUTH)
+        return status, nbytes
+
+    def write_part(self, nbytes):
+        with open(self.filename+'.part', 'wb') as f:
+            f.write(self.data[:nbytes])
+
+    def product_requests(self):
+        return [r for p, r in self.hub.requests if p.endswith(')/$value')]
+
+    def assertDownloaded(self):
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(self.filename+'.part'))
+
+    def test_fresh_download(self):
+        self.assertEqual(self.download(), ('done', len(self.data)))
+        self.assertDownloaded()
+        self.assertEqual(self.product_requests(), [None])
+
+    def test_resume(self):
+        self.write_part(1000)
+        self.assertEqual(self.download(), ('done', len(self.data)-1000))
+        self.assertDownloaded()
+        self.assertEqual(self.product_requests(), ['bytes=1000-'])
+
+    def test_resume_complete_part(self):
+        # Killed after the last write, before the rename: the hub answers 416
+        self.write_part(len(self.data))
+        self.assertEqual(self.download(), ('done', 0))
+        self.assertDownloaded()
+
+    def test_range_ignored(self):
+        self.hub.ignore_range.add('u1')
+        self.write_part(1000)
+        self.assertEqual(self.download(), ('done', len(self.data)))
+        self.assertDownloaded()
+
+    def test_checksum_mismatch(self):
+        self.hub.corrupt['u1'] = 1
+        self.assertEqual(self.download(), ('done', 2*len(self.data)))
+        self.assertDownloaded()
+        self.assertEqual(self.product_requests(), [None, None])
+
+    def test_corrupt_part(self):
+        # A complete but corrupt .part file is downloaded again
+        with open(self.filename+'.part', 'wb') as f:
+            f.write('x'*len(self.data))
+        self.assertEqual(self.download(), ('done', len(self.data)))
+        self.assertDownloaded()
+
+    def test_no_checksum(self):
+        self.hub.nochecksum.add('u1')
+        self.assertEqual(self.download(), ('done, not verified', len(self.data)))
+        self.assertDownloaded()
+
+
+class QueryTest(unittest.TestCase):
+    QUERY = '(platformname:Sentinel-1)+AND+(producttype:SLC)'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir, 'catalogue.sql')
+        self.hub = HubServer().start()
+        # Runs of equal ingestion dates, some across the page boundaries
+        self.add_entries(0, ['2016-01-01T10:00:00.000Z']*3+['2016-01-02T10:00:00.000Z']*6+
+                            ['2016-01-03T10:00:00.000Z']*12+['2016-01-04T10:00:00.000Z']*4)
+
+    def tearDown(self):
+        self.hub.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def add_entries(self, first, dates):
+        for i, date in enumerate(dates, first):
+            self.hub.entries.append({'id': 'S1A_IW_SLC__{0:04d}'.format(i), 'uuid': 'u{0}'.format(i),
+                                     'ingestiondate': date, 'beginposition': date, 'size': '4 GB'})
+
+    def query(self):
+        del self.hub.searches[:]
+        return S1_find_data.do_query(self.QUERY, self.dbfile, 'user', 'pass', self.hub.url, rows=5)
+
+    def catalogue_ids(self):
+        return [e['id'] for e in S1_find_data.get_catalogue(self.dbfile, self.QUERY)]
+
+    def test_paging(self):
+        self.assertEqual(self.query(), 25)
+        self.assertEqual([(start, rows) for q, start, rows, ids in self.hub.searches],
+                         [(0, 5), (5, 5), (10, 5), (15, 5), (20, 5), (25, 5)])
+        self.assertEqual(sorted(self.catalogue_ids()), sorted(e['id'] for e in self.hub.entries))
+
+    def test_incremental(self):
+        self.query()
+        last = max(e['ingestiondate'] for e in self.hub.entries)
+        before = set(e['id'] for e in self.hub.entries)
+        # New products, one ingested at the same time as the last one seen
+        self.add_entries(25, [last]+['2016-01-05T10:00:00.000Z']*6)
+        new = set(e['id'] for e in self.hub.entries)-before
+        self.assertEqual(self.query(), 7)
+        # Only products ingested since the last one seen are asked for
+        self.assertTrue(all('ingestionDate:[{0}+TO+NOW]'.format(last) in q
+                            for q, start, rows, ids in self.hub.searches))
+        fetched = set(i for q, start, rows, ids in self.hub.searches for i in ids)
+        self.assertEqual(fetched-new,
+                         set(e['id'] for e in self.hub.entries if e['id'] in before and e['ingestiondate'] == last))
+        ids = self.catalogue_ids()
+        self.assertEqual(len(ids), 32)
+        self.assertEqual(len(set(ids)), 32)
+        # Nothing new
+        self.assertEqual(self.query(), 0)
+        self.assertEqual(len(self.catalogue_ids()), 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
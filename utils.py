@@ -1,7 +1,9 @@
+import os
 import numpy as np
 import subprocess
 import time
 import struct as st
+from collections import OrderedDict
 
 import pdb
 
@@ -46,6 +48,15 @@ def grep(arg,file):
     res = subprocess.check_output(['grep',arg,file])
     return res
 
+def makedirs(path):
+    """Creates path and its parents, unless it exists already"""
+    try:
+        os.makedirs(path)
+    except OSError:
+        # Might have been created by another process in the meantime
+        if not os.path.isdir(path):
+            raise
+
 def count_lines(file):
     res = subprocess.check_output(['wc','-l',file]).split()[0]
     return res
@@ -62,18 +73,42 @@ def time_it(t1):
         s = '{0:.2f} seconds...'.format(elapsed)
     return s
 
-def multilook(im,fa,fr):
-    nr = np.floor(len(im[0,:])/float(fr))*fr
-    na = np.floor(len(im[:,0])/float(fa))*fa
-    im = im[:na,:nr]
-    im[np.where(np.isnan(im))] = 0
-    aa = np.zeros((na/fa,nr))
-    for k in range(fa) :
-        aa = aa+im[k::fa,:]
-    imout=np.zeros((na/fa,nr/fr))
-    for k in range(fr) :
-        imout = imout+aa[:,k::fr]
-    return imout/fa/fr
+def multilook(im,fa,fr,edges='crop',blocklines=None):
+    """
+    Averages im over fa lines (azimuth) and fr columns (range), ignoring NaNs.
+    Looks without any valid sample are NaN. im can be real or complex, and can
+    be a memory mapped array (e.g. from np.memmap), as it is processed in
+    blocks of blocklines output lines. With edges='crop' the lines and columns
+    that do not fill a complete look are dropped, with edges='partial' they
+    are averaged into a smaller look. Returns float32 or complex64, unless im
+    has a higher precision
+    """
+    length, width = im.shape
+    if edges == 'crop':
+        length = (length//fa)*fa
+        width = (width//fr)*fr
+    elif edges != 'partial':
+        raise ValueError('Unknown edges option {0}, use crop or partial'.format(edges))
+    outlength = -(-length//fa)
+    outwidth = -(-width//fr)
+    outtype = np.result_type(im.dtype.newbyteorder('='),np.float32)
+    imout = np.empty((outlength,outwidth),dtype=outtype)
+    if blocklines is None:
+        # About 4M input samples per block
+        blocklines = max(1,2**22//(fa*max(width,1)))
+    colix = np.arange(0,width,fr)
+    for l0 in range(0,outlength,blocklines):
+        l1 = min(l0+blocklines,outlength)
+        # Copies the block, converting to native byte order if needed
+        block = np.array(im[l0*fa:min(l1*fa,length),:width],dtype=outtype)
+        valid = ~np.isnan(block)
+        block[~valid] = 0
+        rowix = np.arange(0,block.shape[0],fa)
+        total = np.add.reduceat(np.add.reduceat(block,rowix,axis=0),colix,axis=1)
+        count = np.add.reduceat(np.add.reduceat(valid.astype(np.float32),rowix,axis=0),colix,axis=1)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            imout[l0:l1] = total/count
+    return imout
 
 def isnumber(s):
     try:
@@ -120,46 +155,287 @@ def read_real(l,length,width,fmt='f') :
         res = np.reshape(res,(length,width))
         return res
 
-def ll2xy(lon,lat,lon_orig,lat_orig):
+# Gamma rasters are big-endian, with format given by image_format (SLC and
+# MLI parameter files) or data_format (DEM parameter files)
+GAMMA_FORMATS = {'FCOMPLEX': np.dtype('>c8'),
+                 'SCOMPLEX': np.dtype([('re','>i2'),('im','>i2')]),
+                 'FLOAT': np.dtype('>f4'),
+                 'REAL*4': np.dtype('>f4'),
+                 'INTEGER*2': np.dtype('>i2'),
+                 'SHORT': np.dtype('>i2')}
+
+class GammaRaster(object):
     """
-    Converts latitude and longitude to local xy coordinates
+    Read-only memory mapped Gamma raster. Width, length and format are taken
+    from parfile (default filename.par), which can be an SLC, MLI or DEM
+    parameter file. Give fmt for rasters in a different format than their
+    parameter file, e.g. fmt='FCOMPLEX' for an interferogram with the MLI
+    parameter file, or for a lookup table with the DEM parameter file.
 
-    Converted from Matlab script llh2local by Peter Cervelli
+    Indexing returns a native byte order copy of the window only, SCOMPLEX
+    data is converted to complex64. The raster can be passed to multilook
     """
-    a = 6378137.0
-    e = 0.08209443794970
+    def __init__(self,filename,parfile=None,fmt=None):
+        if parfile is None:
+            parfile = filename+'.par'
+        par = read_par(parfile)
+        if 'range_samples' in par:
+            width, length = par['range_samples'], par['azimuth_lines']
+            fmt = fmt or par.get('image_format')
+        else:
+            width, length = par['width'], par['nlines']
+            fmt = fmt or par.get('data_format')
+        if fmt not in GAMMA_FORMATS:
+            raise ValueError('Unknown raster format {0} for {1}'.format(fmt,filename))
+        dtype = GAMMA_FORMATS[fmt]
+        if os.path.getsize(filename) != length*width*dtype.itemsize:
+            raise IOError('Size of data in {0} does not seem to match size {1}x{2} '
+                          'given in {3}...'.format(filename,length,width,parfile))
+        self.filename = filename
+        self.fmt = fmt
+        self.data = np.memmap(filename,dtype=dtype,mode='r',shape=(length,width))
+        self.shape = (length,width)
+        if fmt == 'SCOMPLEX':
+            self.dtype = np.dtype(np.complex64)
+        else:
+            self.dtype = dtype.newbyteorder('=')
 
-    x = np.zeros_like(lon)
-    y = np.zeros_like(lat)
+    def __len__(self):
+        return self.shape[0]
 
-    lon = deg2rad(lon)
-    lat = deg2rad(lat)
-    lon_orig = deg2rad(lon_orig)
-    lat_orig = deg2rad(lat_orig)
+    def __getitem__(self,key):
+        window = self.data[key]
+        if self.fmt == 'SCOMPLEX':
+            res = np.empty(window.shape,dtype=np.complex64)
+            res.real = window['re']
+            res.imag = window['im']
+            return res
+        return np.array(window,dtype=self.dtype)
 
-    nonzeroix = lat != 0
-    dlambda = lon[nonzeroix]-lon_orig
+def read_raster(filename,parfile=None,fmt=None,rows=slice(None),cols=slice(None)):
+    """
+    Returns the window rows, cols of a Gamma raster in native byte order,
+    see GammaRaster
+    """
+    return GammaRaster(filename,parfile,fmt)[rows,cols]
 
-    M = a*((1-e**2/4-3*e**4/64-5*e**6/256)*lat[nonzeroix] -
-           (3*e**2/8+3*e**4/32+45*e**6/1024)*np.sin(2*lat[nonzeroix]) + 
-           (15*e**4/256 +45*e**6/1024)*np.sin(4*lat[nonzeroix]) - 
-           (35*e**6/3072)*np.sin(6*lat[nonzeroix]))
+class ParDict(dict):
+    """
+    Contents of a Gamma parameter file. Numeric values are int or float, 
+    fields with several numbers (e.g. state vectors) are lists, and all other
+    values are strings. The units given after the numbers are kept in the 
+    units dictionary
+    """
+    def __init__(self,*args,**kwargs):
+        dict.__init__(self,*args,**kwargs)
+        self.units = {}
 
-    M0 = a*((1-e**2/4-3*e**4/64-5*e**6/256)*lat_orig -
-           (3*e**2/8+3*e**4/32+45*e**6/1024)*np.sin(2*lat_orig) + 
-           (15*e**4/256 +45*e**6/1024)*np.sin(4*lat_orig) - 
-           (35*e**6/3072)*np.sin(6*lat_orig));
-   
-    N = a/np.sqrt(1-e**2*np.sin(lat[nonzeroix])**2)
-    E = dlambda*np.sin(lat[nonzeroix])
+    def copy(self):
+        res = ParDict(self)
+        res.units = dict(self.units)
+        return res
 
-    x[nonzeroix] = N/np.tan(lat[nonzeroix])*np.sin(E)
-    y[nonzeroix] = M-M0+N/np.tan(lat[nonzeroix])*(1-np.cos(E))
+# Parsed parameter files by absolute path, with their mtime and size
+par_cache = {}
 
-    x[~nonzeroix] = a*dlambda[~nonzeroix]
-    y[~nonzeroix] = -M0
+def read_par(parfile):
+    """
+    Returns a ParDict with the contents of a Gamma parameter file. Results are
+    cached until the modification time or size of the file changes
+    """
+    path = os.path.abspath(parfile)
+    st = os.stat(path)
+    cached = par_cache.get(path)
+    if cached is None or cached[0] != (st.st_mtime,st.st_size):
+        cached = ((st.st_mtime,st.st_size),parse_par(path))
+        par_cache[path] = cached
+    return cached[1].copy()
+
+def parse_par(parfile):
+    par = ParDict()
+    with open(parfile) as f:
+        for l in f:
+            key, sep, value = l.partition(':')
+            if not sep:
+                continue
+            key = key.strip()
+            tokens = value.split()
+            numbers = []
+            for t in tokens:
+                try:
+                    numbers.append(int(t))
+                except ValueError:
+                    try:
+                        numbers.append(float(t))
+                    except ValueError:
+                        break
+            if not numbers:
+                par[key] = value.strip()
+                continue
+            if len(numbers) == 1:
+                par[key] = numbers[0]
+            else:
+                par[key] = numbers
+            if len(tokens) > len(numbers):
+                par.units[key] = ' '.join(tokens[len(numbers):])
+    return par
+
+# WGS84 semi-major axis and eccentricity, and the coefficients of the
+# meridian arc length series used by LocalProjector
+WGS84_A = 6378137.0
+WGS84_E = 0.08209443794970
+MERIDIAN_COEFS = (1-WGS84_E**2/4-3*WGS84_E**4/64-5*WGS84_E**6/256,
+                  3*WGS84_E**2/8+3*WGS84_E**4/32+45*WGS84_E**6/1024,
+                  15*WGS84_E**4/256+45*WGS84_E**6/1024,
+                  35*WGS84_E**6/3072)
+
+class LocalProjector(object):
+    """
+    Converts between longitude/latitude and local x/y coordinates in metres,
+    using a polyconic projection around the origin lon_orig, lat_orig.
+
+    Converted from the Matlab scripts llh2local and local2llh by Peter 
+    Cervelli. The origin constants are computed once, and arrays are 
+    converted in chunks of chunksize elements using preallocated buffers,
+    so memory use on top of the output does not depend on the array size.
+    Output is float64, or float32 if given as dtype
+    """
+    def __init__(self,lon_orig,lat_orig,chunksize=2**18,dtype=np.float64):
+        self.lon_orig = deg2rad(float(lon_orig))
+        self.lat_orig = deg2rad(float(lat_orig))
+        self.M0 = self.meridian(self.lat_orig)
+        self.chunksize = chunksize
+        self.dtype = np.dtype(dtype)
+
+    def meridian(self,lat):
+        """Meridian arc length from the equator to lat (radians)"""
+        c1, c2, c3, c4 = MERIDIAN_COEFS
+        return WGS84_A*(c1*lat-c2*np.sin(2*lat)+c3*np.sin(4*lat)-c4*np.sin(6*lat))
+
+    def forward(self,lon,lat):
+        """Returns x, y of lon, lat (degrees), arrays of any shape"""
+        lon, lat = np.broadcast_arrays(np.asarray(lon),np.asarray(lat))
+        shape = lon.shape
+        lon, lat = lon.ravel(), lat.ravel()
+        x = np.empty(lon.size,dtype=self.dtype)
+        y = np.empty(lon.size,dtype=self.dtype)
+        # At least 1, as range does not take a step of 0 for empty arrays
+        n = max(1,min(self.chunksize,lon.size))
+        phi, dlambda, sinphi, E, k, tmp = [np.empty(n) for i in range(6)]
+        a, e = WGS84_A, WGS84_E
+        c1, c2, c3, c4 = MERIDIAN_COEFS
+        # k is infinite at latitude zero, these points are set at the end
+        with np.errstate(divide='ignore',invalid='ignore'):
+            for i0 in range(0,lon.size,n):
+                i1 = min(i0+n,lon.size)
+                m = i1-i0
+                phi_, dlambda_, sinphi_, E_, k_, tmp_ = [b[:m] for b in (phi,dlambda,sinphi,E,k,tmp)]
+                np.multiply(lat[i0:i1],np.pi/180,out=phi_)
+                np.multiply(lon[i0:i1],np.pi/180,out=dlambda_)
+                dlambda_ -= self.lon_orig
+                np.sin(phi_,out=sinphi_)
+                np.multiply(dlambda_,sinphi_,out=E_)
+                # k = N/tan(lat) = a*cos(lat)/(sin(lat)*sqrt(1-e^2*sin(lat)^2))
+                np.multiply(sinphi_,sinphi_,out=k_)
+                k_ *= -e**2
+                k_ += 1
+                np.sqrt(k_,out=k_)
+                k_ *= sinphi_
+                np.cos(phi_,out=tmp_)
+                np.divide(tmp_,k_,out=k_)
+                k_ *= a
+                # x = k*sin(E)
+                np.sin(E_,out=tmp_)
+                np.multiply(k_,tmp_,out=x[i0:i1],casting='unsafe')
+                # y = M-M0+k*(1-cos(E))
+                np.cos(E_,out=E_)
+                np.subtract(1,E_,out=E_)
+                E_ *= k_
+                np.multiply(phi_,c1,out=k_)
+                for mult, coef in ((2,-c2),(4,c3),(6,-c4)):
+                    np.multiply(phi_,mult,out=tmp_)
+                    np.sin(tmp_,out=tmp_)
+                    tmp_ *= coef
+                    k_ += tmp_
+                k_ *= a
+                k_ -= self.M0
+                k_ += E_
+                y[i0:i1] = k_
+                # Latitude zero
+                zeroix = np.flatnonzero(phi_ == 0)
+                if len(zeroix):
+                    x[i0+zeroix] = a*dlambda_[zeroix]
+                    y[i0+zeroix] = -self.M0
+        return x.reshape(shape), y.reshape(shape)
+
+    def inverse(self,x,y,tol=1e-12,maxiter=100):
+        """
+        Returns lon, lat (degrees) of x, y, arrays of any shape. The latitude
+        is found by Newton iteration, until all updates are below tol radians
+        """
+        x, y = np.broadcast_arrays(np.asarray(x,dtype=np.float64),
+                                   np.asarray(y,dtype=np.float64))
+        shape = x.shape
+        x, y = x.ravel(), y.ravel()
+        lon = np.empty(x.size,dtype=self.dtype)
+        lat = np.empty(x.size,dtype=self.dtype)
+        a, e = WGS84_A, WGS84_E
+        c1, c2, c3, c4 = MERIDIAN_COEFS
+        n = max(1,min(self.chunksize,x.size))
+        for i0 in range(0,x.size,n):
+            i1 = min(i0+n,x.size)
+            xc, yc = x[i0:i1], y[i0:i1]
+            A = (self.M0+yc)/a
+            B = xc**2/a**2+A**2
+            phi = A.copy()
+            nonzero = A != 0
+            for it in range(maxiter):
+                sin2phi = np.sin(2*phi)
+                C = np.sqrt(1-e**2*np.sin(phi)**2)*np.tan(phi)
+                Ma = self.meridian(phi)/a
+                Mn = c1-2*c2*np.cos(2*phi)+4*c3*np.cos(4*phi)-6*c4*np.cos(6*phi)
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    delta = -(A*(C*Ma+1)-Ma-0.5*(Ma**2+B)*C)/ \
+                            (e**2*sin2phi*(Ma**2+B-2*A*Ma)/(4*C)+(A-Ma)*(C*Mn-2/sin2phi)-Mn)
+                delta[~nonzero] = 0
+                phi += delta
+                if np.all(np.abs(delta) < tol):
+                    break
+            else:
+                raise ValueError('Latitude did not converge within {0} iterations'.format(maxiter))
+            C = np.sqrt(1-e**2*np.sin(phi)**2)*np.tan(phi)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                lonc = np.arcsin(xc*C/a)/np.sin(phi)+self.lon_orig
+            # Latitude zero
+            lonc[~nonzero] = xc[~nonzero]/a+self.lon_orig
+            phi[~nonzero] = 0
+            lon[i0:i1] = lonc*180/np.pi
+            lat[i0:i1] = phi*180/np.pi
+        return lon.reshape(shape), lat.reshape(shape)
+
+# Projectors by origin, as ll2xy is typically called with the same origin.
+# Only the MAXPROJECTORS most recently used are kept, as callers looping over
+# many origins would otherwise grow the cache for the life of the process
+MAXPROJECTORS = 8
+projectors = OrderedDict()
+
+def ll2xy(lon,lat,lon_orig,lat_orig):
+    """
+    Converts latitude and longitude to local xy coordinates, see
+    LocalProjector. Returns float64 arrays
+    """
+    key = (float(lon_orig),float(lat_orig))
+    projector = projectors.pop(key,None)
+    if projector is None:
+        projector = LocalProjector(lon_orig,lat_orig)
+        if len(projectors) >= MAXPROJECTORS:
+            projectors.popitem(last=False)
+    projectors[key] = projector
+    return projector.forward(lon,lat)
 
-    return x, y
+def xy2ll(x,y,lon_orig,lat_orig):
+    """Converts local xy coordinates to latitude and longitude"""
+    return LocalProjector(lon_orig,lat_orig).inverse(x,y)
 
 def deg2rad(a):
     return a*np.pi/180